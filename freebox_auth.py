@@ -95,7 +95,8 @@ def save_token(app_token):
     }
 
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    token_file = os.path.join(base_dir, ".freebox_token")
+    # FREEBOX_TOKEN_PATH permet d'autoriser un second routeur (ex: FREEBOX_SITE2_TOKEN_PATH de wol_app)
+    token_file = os.environ.get('FREEBOX_TOKEN_PATH') or os.path.join(base_dir, ".freebox_token")
 
     with open(token_file, "w") as f:
         json.dump(config, f, indent=2)
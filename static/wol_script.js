@@ -25,19 +25,42 @@ function updateStatus(machineId, status, text) {
     }
 }
 
-async function checkStatus(machineId, ip) {
-    try {
-        const response = await fetch('/api/ping/' + ip);
-        const data = await response.json();
-        
-        if (data.online) {
-            updateStatus(machineId, 'online', 'En ligne');
-        } else {
-            updateStatus(machineId, 'offline', 'Hors ligne');
-        }
-    } catch (error) {
-        updateStatus(machineId, 'offline', 'Hors ligne');
+// Suivi groupé: toutes les machines affichées sont interrogées par une seule requête /api/status
+const statusWatchers = {};   // machineId -> {ip, deadline, btn} en attente de démarrage
+let pendingChecks = {};      // machineId -> ip pour les vérifications ponctuelles
+let pendingFlush = null;
+
+async function fetchStatuses(ids) {
+    const response = await fetch('/api/status?ids=' + encodeURIComponent(ids.join(',')));
+    if (!response.ok) {
+        throw new Error('HTTP ' + response.status);
     }
+    const data = await response.json();
+    return data.machines || {};
+}
+
+function checkStatus(machineId, ip) {
+    // Les appels rapprochés (un par machine au chargement) sont regroupés en une requête
+    pendingChecks[machineId] = ip;
+    if (pendingFlush) return;
+    pendingFlush = setTimeout(async function() {
+        const ids = Object.keys(pendingChecks);
+        pendingChecks = {};
+        pendingFlush = null;
+        try {
+            const machines = await fetchStatuses(ids);
+            ids.forEach(function(id) {
+                const st = machines[id];
+                if (st && st.online) {
+                    updateStatus(id, 'online', 'En ligne');
+                } else {
+                    updateStatus(id, 'offline', 'Hors ligne');
+                }
+            });
+        } catch (error) {
+            ids.forEach(function(id) { updateStatus(id, 'offline', 'Hors ligne'); });
+        }
+    }, 0);
 }
 
 async function wakeUp(machineId, mac, ip) {
@@ -80,40 +103,96 @@ async function wakeUp(machineId, mac, ip) {
     }
 }
 
-async function waitForOnline(machineId, ip, btn, attempt) {
-    if (typeof attempt === 'undefined') attempt = 0;
-    const maxAttempts = 60; // 60 secondes
-    
-    if (attempt >= maxAttempts) {
-        showAlert('Timeout: La machine na pas demarre apres 60 secondes', 'warning');
-        btn.disabled = false;
-        btn.innerHTML = 'Reveiller';
-        updateStatus(machineId, 'offline', 'Timeout');
-        return;
-    }
-    
-    try {
-        const response = await fetch('/api/ping/' + ip);
-        const data = await response.json();
-        
-        if (data.online) {
-            showAlert('Machine demarree et accessible!', 'success');
-            btn.disabled = false;
-            btn.innerHTML = 'Reveiller';
-            updateStatus(machineId, 'online', 'En ligne');
-            return;
+function createLocalPoller(opts) {
+    // Repli si wol_shared_poll.js n'est pas chargé: boucle locale avec la même interface
+    let keys = [];
+    let timer = null;
+    let attempt = 0;
+    async function tick() {
+        timer = null;
+        if (keys.length === 0) return;
+        try {
+            opts.onResult(await opts.poll(keys));
+        } catch (error) {
+            // Continue a attendre
         }
-    } catch (error) {
-        // Continue a attendre
+        attempt += 1;
+        let delay = opts.nextDelay(attempt);
+        if (typeof document !== 'undefined' && document.hidden) {
+            delay = Math.min(delay * 3, 60000);
+        }
+        timer = setTimeout(tick, delay);
     }
-    
+    return {
+        start: function(k) { keys = k; attempt = 0; if (!timer) timer = setTimeout(tick, 0); },
+        setKeys: function(k) { keys = k; if (!timer) timer = setTimeout(tick, 0); },
+        stop: function() { keys = []; if (timer) clearTimeout(timer); timer = null; }
+    };
+}
+
+// Un seul onglet interroge /api/status pour l'union des machines suivies par tous les onglets
+const statusPollerOptions = {
+    name: 'wol-dashboard',
+    poll: fetchStatuses,
+    onResult: applyStatuses,
     // Adaptive backoff: base 1s + 250ms per attempt, capped at 8s
-    let delay = Math.min(1000 + attempt * 250, 8000);
-    // If the page is hidden, reduce polling intensity
-    if (typeof document !== 'undefined' && document.hidden) {
-        delay = Math.min(delay * 3, 60000);
+    nextDelay: function(attempt) { return Math.min(1000 + attempt * 250, 8000); }
+};
+const statusPoller = (typeof WolSharedPoll !== 'undefined')
+    ? WolSharedPoll.create(statusPollerOptions)
+    : createLocalPoller(statusPollerOptions);
+let pollerStarted = false;
+let deadlineTimer = null;
+
+function waitForOnline(machineId, ip, btn) {
+    const maxWait = 60; // 60 secondes
+    statusWatchers[machineId] = { ip: ip, btn: btn, deadline: Date.now() + maxWait * 1000 };
+    if (!pollerStarted) {
+        pollerStarted = true;
+        statusPoller.start(Object.keys(statusWatchers));
+    } else {
+        statusPoller.setKeys(Object.keys(statusWatchers));
     }
-    setTimeout(function() {
-        waitForOnline(machineId, ip, btn, attempt + 1);
-    }, delay);
+    if (!deadlineTimer) deadlineTimer = setInterval(checkDeadlines, 1000);
+}
+
+function finishWatcher(machineId) {
+    const w = statusWatchers[machineId];
+    delete statusWatchers[machineId];
+    if (w && w.btn) {
+        w.btn.disabled = false;
+        w.btn.innerHTML = 'Reveiller';
+    }
+    statusPoller.setKeys(Object.keys(statusWatchers));
+    if (Object.keys(statusWatchers).length === 0) {
+        clearInterval(deadlineTimer);
+        deadlineTimer = null;
+    }
+}
+
+function checkDeadlines() {
+    const now = Date.now();
+    Object.keys(statusWatchers).forEach(function(id) {
+        if (now >= statusWatchers[id].deadline) {
+            showAlert('Timeout: La machine na pas demarre apres 60 secondes', 'warning');
+            updateStatus(id, 'offline', 'Timeout');
+            finishWatcher(id);
+        }
+    });
+}
+
+function applyStatuses(machines) {
+    // Résultats reçus du leader (ou de ce même onglet): met aussi à jour les badges affichés
+    Object.keys(machines || {}).forEach(function(id) {
+        const st = machines[id];
+        if (statusWatchers[id]) {
+            if (st && st.online) {
+                showAlert('Machine demarree et accessible!', 'success');
+                updateStatus(id, 'online', 'En ligne');
+                finishWatcher(id);
+            }
+        } else if (st) {
+            updateStatus(id, st.online ? 'online' : 'offline', st.online ? 'En ligne' : 'Hors ligne');
+        }
+    });
 }
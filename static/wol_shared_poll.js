@@ -0,0 +1,184 @@
+// Coordination multi-onglets: un seul onglet "leader" interroge le serveur et diffuse
+// les résultats aux autres via BroadcastChannel. L'élection passe par Web Locks
+// (navigator.locks) ou, à défaut, par un bail renouvelé dans localStorage.
+// Le leader suspend toute interrogation quand aucun onglet n'est visible.
+(function(global) {
+    'use strict';
+
+    const HEARTBEAT_MS = 3000;
+    const PEER_TTL_MS = 10000;
+
+    function isVisible() {
+        return typeof document === 'undefined' || !document.hidden;
+    }
+
+    // opts.name: nom du canal partagé (ex: 'wol-ping-192.168.1.10')
+    // opts.poll(keys): Promise du résultat pour l'union des clés de tous les onglets
+    // opts.onResult(data): appelé dans chaque onglet, leader compris
+    // opts.nextDelay(attempt): délai (ms) avant la prochaine interrogation
+    function createSharedPoller(opts) {
+        const tabId = Math.random().toString(36).slice(2) + Date.now().toString(36);
+        const channel = (typeof BroadcastChannel !== 'undefined') ? new BroadcastChannel(opts.name) : null;
+        const leaseKey = 'wol-leader-' + opts.name;
+        const peers = {};
+        let keys = [];
+        let running = false;
+        let leader = false;
+        let timer = null;
+        let heartbeat = null;
+        let attempt = 0;
+        let releaseLock = null;
+
+        function post(message) {
+            if (channel) channel.postMessage(message);
+        }
+
+        function announce() {
+            peers[tabId] = { keys: keys, visible: isVisible(), ts: Date.now() };
+            post({ type: 'hello', tab: tabId, keys: keys, visible: isVisible() });
+        }
+
+        function livePeers() {
+            const now = Date.now();
+            Object.keys(peers).forEach(function(id) {
+                if (id !== tabId && now - peers[id].ts > PEER_TTL_MS) delete peers[id];
+            });
+            return Object.keys(peers).map(function(id) { return peers[id]; });
+        }
+
+        function wantedKeys() {
+            const set = {};
+            livePeers().forEach(function(p) {
+                (p.keys || []).forEach(function(k) { set[k] = true; });
+            });
+            return Object.keys(set);
+        }
+
+        function anyVisible() {
+            return livePeers().some(function(p) { return p.visible; });
+        }
+
+        function schedule(delay) {
+            if (timer) clearTimeout(timer);
+            timer = (running && leader) ? setTimeout(tick, delay) : null;
+        }
+
+        async function tick() {
+            timer = null;
+            if (!running || !leader) return;
+            // tous les onglets sont cachés: pause complète jusqu'au prochain 'visible'
+            if (!anyVisible()) return;
+            const wanted = wantedKeys();
+            if (wanted.length === 0) return;
+            let data = null;
+            try {
+                data = await opts.poll(wanted);
+            } catch (error) {
+                data = null;
+            }
+            if (data !== null && running) {
+                post({ type: 'result', data: data });
+                opts.onResult(data);
+            }
+            attempt += 1;
+            schedule(opts.nextDelay ? opts.nextDelay(attempt) : 2000);
+        }
+
+        function becomeLeader() {
+            if (leader) return;
+            leader = true;
+            attempt = 0;
+            schedule(0);
+        }
+
+        function renewLease() {
+            // repli sans Web Locks: bail de PEER_TTL_MS renouvelé à chaque battement
+            try {
+                const now = Date.now();
+                const lease = JSON.parse(global.localStorage.getItem(leaseKey) || 'null');
+                if (!lease || lease.tab === tabId || lease.exp < now) {
+                    global.localStorage.setItem(leaseKey, JSON.stringify({ tab: tabId, exp: now + PEER_TTL_MS }));
+                    becomeLeader();
+                } else if (leader) {
+                    leader = false;
+                    schedule(0);
+                }
+            } catch (error) {
+                becomeLeader();
+            }
+        }
+
+        function elect() {
+            if (!channel) {
+                // pas de BroadcastChannel: chaque onglet interroge pour lui-même
+                becomeLeader();
+            } else if (global.navigator && global.navigator.locks) {
+                global.navigator.locks.request(leaseKey, function() {
+                    if (!running) return;
+                    becomeLeader();
+                    return new Promise(function(resolve) { releaseLock = resolve; });
+                });
+            } else {
+                renewLease();
+            }
+        }
+
+        if (channel) {
+            channel.onmessage = function(event) {
+                const m = event.data || {};
+                if (m.type === 'hello') {
+                    peers[m.tab] = { keys: m.keys, visible: m.visible, ts: Date.now() };
+                    if (leader && m.visible && !timer) schedule(0);
+                } else if (m.type === 'bye') {
+                    delete peers[m.tab];
+                } else if (m.type === 'result' && running) {
+                    opts.onResult(m.data);
+                }
+            };
+        }
+
+        if (typeof document !== 'undefined') {
+            document.addEventListener('visibilitychange', function() {
+                if (!running) return;
+                announce();
+                if (leader && isVisible() && !timer) schedule(0);
+            });
+        }
+
+        return {
+            start: function(initialKeys) {
+                keys = initialKeys || [];
+                running = true;
+                announce();
+                heartbeat = setInterval(function() {
+                    announce();
+                    if (channel && !(global.navigator && global.navigator.locks)) renewLease();
+                }, HEARTBEAT_MS);
+                elect();
+            },
+            setKeys: function(newKeys) {
+                keys = newKeys || [];
+                announce();
+                if (leader && !timer) schedule(0);
+            },
+            stop: function() {
+                running = false;
+                if (timer) clearTimeout(timer);
+                timer = null;
+                clearInterval(heartbeat);
+                post({ type: 'bye', tab: tabId });
+                if (releaseLock) releaseLock();
+                try {
+                    const lease = JSON.parse(global.localStorage.getItem(leaseKey) || 'null');
+                    if (lease && lease.tab === tabId) global.localStorage.removeItem(leaseKey);
+                } catch (error) {
+                    // localStorage indisponible
+                }
+                leader = false;
+            },
+            isLeader: function() { return leader; }
+        };
+    }
+
+    global.WolSharedPoll = { create: createSharedPoller };
+})(typeof window !== 'undefined' ? window : this);
@@ -0,0 +1,111 @@
+"""tools/bench_state.py
+Mesure du débit (opérations/s) des backends d'état partagé de wol_app (wol_state).
+
+Usage:
+  python3 tools/bench_state.py [--backend memory://] [--backend sqlite:///tmp/bench_state.db]
+                               [--backend redis://localhost:6379/15] [--ops 2000]
+                               [--processes 2] [--threads 4] [--json]
+
+Chaque backend est testé sur les opérations utilisées par l'application : get (lecture du cache de
+ping), set avec TTL (écriture d'un résultat), incr (compteurs de limitation de débit) et
+acquire/release de bail (superviseurs de réveil, planificateur). --processes simule les workers
+gunicorn et --threads leurs threads ; memory:// n'étant pas partagé, il n'est mesuré qu'en un
+seul processus. À lancer sur la machine cible (ex: Raspberry Pi) pour dimensionner STATE_URL.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BASE_DIR)
+
+from wol_state import open_store  # noqa: E402
+
+OPERATIONS = ('get', 'set', 'incr', 'lease')
+
+
+def run_op(store, op, worker, n):
+    key = f'bench:{worker}'
+    if op == 'get':
+        for i in range(n):
+            store.get(f'{key}:{i % 64}')
+    elif op == 'set':
+        for i in range(n):
+            store.set(f'{key}:{i % 64}', {'ts': time.time(), 'online': True, 'source': 'ping'}, ttl=60)
+    elif op == 'incr':
+        for _ in range(n):
+            store.incr('bench:counter', ttl=60)
+    elif op == 'lease':
+        for _ in range(n):
+            if store.acquire_lease('bench:lease', key, 5):
+                store.release_lease('bench:lease', key)
+
+
+def bench_process(args):
+    """One simulated worker: `threads` threads share a store and each runs `ops` operations."""
+    url, op, ops, threads, proc = args
+    store = open_store(url)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(lambda t: run_op(store, op, f'{proc}-{t}', ops), range(threads)))
+    return time.perf_counter() - start
+
+
+def bench_backend(url, ops, processes, threads):
+    if url.startswith('memory'):
+        processes = 1
+    store = open_store(url)
+    run_op(store, 'set', 'warmup', 64)  # keys read by 'get'
+    results = {'backend': url, 'processes': processes, 'threads': threads}
+    for op in OPERATIONS:
+        jobs = [(url, op, ops, threads, p) for p in range(processes)]
+        start = time.perf_counter()
+        if processes == 1:
+            bench_process(jobs[0])
+        else:
+            with Pool(processes) as pool:
+                pool.map(bench_process, jobs)
+        elapsed = time.perf_counter() - start
+        results[op] = round(ops * threads * processes / elapsed)
+    store.purge_expired()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark des backends d'état partagé (ops/s)")
+    parser.add_argument('--backend', action='append', dest='backends',
+                        help="URL du backend (répétable). Défaut: memory:// et sqlite:///tmp/bench_state.db")
+    parser.add_argument('--ops', type=int, default=2000, help="opérations par thread et par test")
+    parser.add_argument('--processes', type=int, default=2, help="processus (workers gunicorn simulés)")
+    parser.add_argument('--threads', type=int, default=4, help="threads par processus")
+    parser.add_argument('--json', action='store_true', help="sortie JSON")
+    args = parser.parse_args()
+
+    backends = args.backends or ['memory://', 'sqlite:///tmp/bench_state.db']
+    rows = []
+    for url in backends:
+        try:
+            rows.append(bench_backend(url, args.ops, args.processes, args.threads))
+        except Exception as e:
+            rows.append({'backend': url, 'error': str(e)})
+
+    if args.json:
+        print(json.dumps(rows, indent=2))
+        return 0 if all('error' not in r for r in rows) else 1
+    print(f"{'backend':40} {'proc x thr':>10} " + ' '.join(f'{op + "/s":>10}' for op in OPERATIONS))
+    for r in rows:
+        if 'error' in r:
+            print(f"{r['backend']:40} ERREUR: {r['error']}")
+            continue
+        print(f"{r['backend']:40} {str(r['processes']) + ' x ' + str(r['threads']):>10} "
+              + ' '.join(f'{r[op]:>10}' for op in OPERATIONS))
+    return 0 if all('error' not in r for r in rows) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
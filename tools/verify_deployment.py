@@ -7,7 +7,7 @@ if sys.version_info < (3, 9):
 # python
 """tools/verify_deployment.py
 Script de vérification post-déploiement pour Wake-on-LAN
-Vérifie :
+Vérifie (en parallèle, avec la latence de chaque contrôle) :
  - état du service systemd (wol.service et wol-bind-local.service)
  - endpoint /health
  - endpoint /api/machines
@@ -15,18 +15,28 @@ Vérifie :
  - présence et permissions du fichier .freebox_token
  - écoute réseau (HOST_IP:PORT)
 
+Mode --slo : N requêtes par endpoint (/health, /api/machines, /api/ping/<ip>) avec une concurrence
+donnée ; échec si la latence p95, le taux d'erreur ou le taux de réponses servies par un cache
+(X-Ping-Cache HIT/STALE, X-Micro-Cache de nginx) dépasse les seuils. Les réponses 429 et 503
+de délestage (Retry-After) sont comptées à part, hors latence et taux de cache.
+
 Usage:
-  python3 tools/verify_deployment.py [--env /path/to/.env] [--host HOST_IP] [--port PORT]
+  python3 tools/verify_deployment.py [--env /path/to/.env] [--host HOST_IP] [--port PORT] [--json]
+  python3 tools/verify_deployment.py --slo [--requests 50] [--concurrency 4] [--p95-ms 500]
+                                     [--max-error-rate 0.01] [--min-hit-ratio 0.5] [--json]
 
-Retourne 0 si tous les checks critiques sont OK, 1 sinon.
+Retourne 0 si tous les checks critiques (et les SLO avec --slo) sont OK, 1 sinon.
 """
 
 import os
 import sys
 import json
+import math
+import time
 import argparse
 import subprocess
 import socket
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from pprint import pprint
 
@@ -46,6 +56,9 @@ except Exception:
 BASE_DIR = Path(__file__).resolve().parent.parent
 DEFAULT_ENV_PATH = BASE_DIR / '.env'
 DEFAULT_PORT = 5000
+# réponses servies par un cache (application ou micro-cache nginx)
+CACHE_HIT_PREFIXES = ('HIT', 'STALE')
+MICRO_CACHE_HITS = ('HIT', 'STALE', 'UPDATING', 'REVALIDATED')
 
 parser = argparse.ArgumentParser(description='Vérification post-déploiement Wake-on-LAN')
 parser.add_argument('--env', help='Chemin vers fichier .env', default=str(DEFAULT_ENV_PATH))
@@ -54,6 +67,14 @@ parser.add_argument('--port', help='PORT à tester (par défaut 5000)', type=int
 parser.add_argument('--service', help='Nom du service systemd à vérifier', default='wol.service')
 parser.add_argument('--bind-local-service', help='Nom du service bind-local', default='wol-bind-local.service')
 parser.add_argument('--timeout', help='Timeout requêtes HTTP (s)', type=float, default=5.0)
+parser.add_argument('--json', help='Rapport JSON sur la sortie standard', action='store_true')
+parser.add_argument('--slo', help='Mesurer latence p95, erreurs et cache sur N requêtes par endpoint', action='store_true')
+parser.add_argument('--requests', help='Requêtes par endpoint en mode --slo', type=int, default=50)
+parser.add_argument('--concurrency', help='Requêtes simultanées en mode --slo', type=int, default=4)
+parser.add_argument('--p95-ms', help='Seuil de latence p95 (ms)', type=float, default=500.0)
+parser.add_argument('--max-error-rate', help="Taux d'erreur max (réseau, 5xx)", type=float, default=0.01)
+parser.add_argument('--min-hit-ratio', help='Part minimale de réponses servies par un cache (endpoints qui l\'indiquent)',
+                    type=float, default=0.5)
 args = parser.parse_args()
 
 # Load env
@@ -73,21 +94,28 @@ else:
                         k, v = line.split('=', 1)
                         os.environ.setdefault(k.strip(), v.strip().strip('"\''))
         except Exception as e:
-            print(f"Warning: failed to parse {env_path}: {e}")
+            print(f"Warning: failed to parse {env_path}: {e}", file=sys.stderr)
 
 HOST = args.host or os.environ.get('HOST_IP') or '127.0.0.1'
 PORT = args.port or int(os.environ.get('FLASK_RUN_PORT', DEFAULT_PORT))
 FREEBOX_TOKEN_PATH = os.environ.get('FREEBOX_TOKEN_PATH') or str(BASE_DIR / '.freebox_token')
 GAMEARENA_HOST_IP = os.environ.get('GAMEARENA_HOST_IP') or None
 
-results = {
-    'service_status': {},
-    'http_checks': {},
-    'token_check': {},
-    'listen_check': {},
-}
+base_url = f'http://{HOST}:{PORT}'
+ENDPOINTS = {'health': '/health', 'machines': '/api/machines'}
+if GAMEARENA_HOST_IP:
+    ENDPOINTS['ping_gamearena'] = f'/api/ping/{GAMEARENA_HOST_IP}'
+
+session = requests.Session()
+_adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=max(4, args.concurrency))
+session.mount('http://', _adapter)
 
-critical_fail = False
+def timed(fn, *a):
+    """Run one check and add its latency (ms)."""
+    start = time.perf_counter()
+    result = fn(*a)
+    result['latency_ms'] = round((time.perf_counter() - start) * 1000, 1)
+    return result
 
 def check_systemd(service_name):
     try:
@@ -99,107 +127,192 @@ def check_systemd(service_name):
     except Exception as e:
         return {'service': service_name, 'active': False, 'output': str(e)}
 
-# 1) systemd checks
-for svc in (args.service, args.bind_local_service):
-    r = check_systemd(svc)
-    results['service_status'][svc] = r
-    if not r['active']:
-        # mark as non-critical only if both are inactive? We'll mark critical if both inactive
-        pass
-
-if not (results['service_status'].get(args.service, {}).get('active') or results['service_status'].get(args.bind_local_service, {}).get('active')):
-    critical_fail = True
-
-# 2) HTTP checks
-base_url = f'http://{HOST}:{PORT}'
-health_url = base_url + '/health'
-machines_url = base_url + '/api/machines'
+def cache_hit(headers):
+    """True/False when the response says whether a cache served it, None when it does not say."""
+    micro = headers.get('X-Micro-Cache')
+    if micro and micro != 'BYPASS':
+        if micro in MICRO_CACHE_HITS:
+            return True
+    ping = headers.get('X-Ping-Cache')
+    if ping:
+        return ping.startswith(CACHE_HIT_PREFIXES)
+    return False if micro else None
 
 # helper for http GET
 def http_get(url, timeout=args.timeout):
     try:
-        r = requests.get(url, timeout=timeout)
-        return {'ok': True, 'status_code': r.status_code, 'text_snippet': (r.text or '')[:1000]}
+        r = session.get(url, timeout=timeout)
+        return {'ok': True, 'status_code': r.status_code, 'cache_hit': cache_hit(r.headers),
+                'retry_after': r.headers.get('Retry-After'), 'text_snippet': (r.text or '')[:1000]}
     except Exception as e:
         return {'ok': False, 'error': str(e)}
 
-results['http_checks']['base_url'] = base_url
-h = http_get(health_url)
-results['http_checks']['health'] = h
+def check_token(path):
+    result = {}
+    try:
+        p = Path(path)
+        exists = p.exists()
+        readable = os.access(str(p), os.R_OK)
+        result.update(path=str(p), exists=exists, readable=readable)
+        if exists and readable:
+            try:
+                txt = p.read_text()
+                # quick validation
+                result['content_has_app_id_app_token'] = 'app_id' in txt and 'app_token' in txt
+            except Exception as e:
+                result['read_error'] = str(e)
+    except Exception as e:
+        result['error'] = str(e)
+    return result
+
+def check_listen(host, port):
+    try:
+        with socket.create_connection((host, int(port)), timeout=3):
+            return {'listening': True}
+    except Exception as e:
+        return {'listening': False, 'error': str(e)}
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    return sorted_values[max(0, math.ceil(pct / 100.0 * len(sorted_values)) - 1)]
+
+def slo_endpoint(path):
+    """Fire args.requests GETs at one endpoint and summarise latency, errors and cache hits."""
+    url = base_url + path
+
+    def one(_):
+        start = time.perf_counter()
+        r = http_get(url)
+        r['ms'] = (time.perf_counter() - start) * 1000
+        return r
+
+    with ThreadPoolExecutor(max_workers=max(1, args.concurrency)) as pool:
+        samples = list(pool.map(one, range(max(1, args.requests))))
+    statuses = {}
+    for s in samples:
+        key = str(s.get('status_code', 'error'))
+        statuses[key] = statuses.get(key, 0) + 1
+    # 429 (rate limiter) and 503 + Retry-After (admission control shedding) are answered at once
+    # without doing the work: counted apart, kept out of the latency and cache-hit samples
+    shed = [s for s in samples if s['ok'] and s['status_code'] == 503 and s.get('retry_after')]
+    served = [s for s in samples if s['ok'] and s['status_code'] != 429
+              and not (s['status_code'] == 503 and s.get('retry_after'))]
+    latencies = sorted(s['ms'] for s in served)
+    # 429 is the rate limiter doing its job: reported, not counted as an error
+    errors = sum(1 for s in samples if not s['ok'] or s['status_code'] >= 500)
+    flagged = [s['cache_hit'] for s in served if s.get('cache_hit') is not None]
+    summary = {
+        'requests': len(samples),
+        'served': len(served),
+        'p50_ms': round(percentile(latencies, 50), 1) if latencies else None,
+        'p95_ms': round(percentile(latencies, 95), 1) if latencies else None,
+        'max_ms': round(latencies[-1], 1) if latencies else None,
+        'error_rate': round(errors / len(samples), 4),
+        'rate_limited': statuses.get('429', 0),
+        'shed': len(shed),
+        'hit_ratio': round(sum(flagged) / len(flagged), 3) if flagged else None,
+        'status_counts': statuses,
+    }
+    violations = []
+    if not latencies:
+        violations.append("no response served (all rate-limited, shed or failed)")
+    elif summary['p95_ms'] > args.p95_ms:
+        violations.append(f"p95 {summary['p95_ms']} ms > {args.p95_ms} ms")
+    if summary['error_rate'] > args.max_error_rate:
+        violations.append(f"error rate {summary['error_rate']} > {args.max_error_rate}")
+    if summary['hit_ratio'] is not None and summary['hit_ratio'] < args.min_hit_ratio:
+        violations.append(f"cache hit ratio {summary['hit_ratio']} < {args.min_hit_ratio}")
+    summary['violations'] = violations
+    summary['ok'] = not violations
+    return summary
+
+run_start = time.perf_counter()
+results = {
+    'service_status': {},
+    'http_checks': {'base_url': base_url},
+    'token_check': {},
+    'listen_check': {},
+}
+
+# 1) every check at once: systemd, HTTP, token file, listen
+with ThreadPoolExecutor(max_workers=8) as pool:
+    services = {svc: pool.submit(timed, check_systemd, svc) for svc in (args.service, args.bind_local_service)}
+    http = {name: pool.submit(timed, http_get, base_url + path) for name, path in ENDPOINTS.items()}
+    token = pool.submit(timed, check_token, FREEBOX_TOKEN_PATH)
+    listen = pool.submit(timed, check_listen, HOST, PORT)
+    for svc, fut in services.items():
+        results['service_status'][svc] = fut.result()
+    for name, fut in http.items():
+        results['http_checks'][name] = fut.result()
+    results['token_check'] = token.result()
+    results['listen_check'] = listen.result()
+
+failures = []
+# critical if both services are inactive
+if not any(info['active'] for info in results['service_status'].values()):
+    failures.append('no active service')
+h = results['http_checks']['health']
 if not (h.get('ok') and h.get('status_code') == 200):
-    critical_fail = True
+    failures.append('/health')
+# /api/machines and /api/ping: reported only (not critical)
+t = results['token_check']
+if 'error' in t or 'read_error' in t or not (t.get('exists') and t.get('readable')):
+    failures.append('token file')
+if not results['listen_check']['listening']:
+    failures.append('listen')
 
-m = http_get(machines_url)
-results['http_checks']['machines'] = m
-if not (m.get('ok') and m.get('status_code') == 200):
-    # not critical? mark as warning
-    critical_fail = critical_fail or False
+# 2) SLO mode: endpoints one after another, so each one's latency is measured on its own
+if args.slo:
+    results['slo'] = {'thresholds': {'p95_ms': args.p95_ms, 'max_error_rate': args.max_error_rate,
+                                     'min_hit_ratio': args.min_hit_ratio, 'requests': args.requests,
+                                     'concurrency': args.concurrency},
+                      'endpoints': {name: slo_endpoint(path) for name, path in ENDPOINTS.items()}}
+    for name, summary in results['slo']['endpoints'].items():
+        if not summary['ok']:
+            failures.append(f"SLO {name}: {', '.join(summary['violations'])}")
 
-# ping check against GAMEARENA_HOST_IP if provided
-if GAMEARENA_HOST_IP:
-    ping_url = base_url + f'/api/ping/{GAMEARENA_HOST_IP}'
-    p = http_get(ping_url)
-    results['http_checks']['ping_gamearena'] = p
+results['failures'] = failures
+results['ok'] = not failures
+results['duration_ms'] = round((time.perf_counter() - run_start) * 1000, 1)
 
-# 3) token file
-try:
-    p = Path(FREEBOX_TOKEN_PATH)
-    exists = p.exists()
-    readable = os.access(str(p), os.R_OK)
-    results['token_check']['path'] = str(p)
-    results['token_check']['exists'] = exists
-    results['token_check']['readable'] = readable
-    if exists and readable:
-        try:
-            txt = p.read_text()
-            # quick validation
-            ok = 'app_id' in txt and 'app_token' in txt
-            results['token_check']['content_has_app_id_app_token'] = ok
-            if not ok:
-                critical = False
-            else:
-                pass
-        except Exception as e:
-            results['token_check']['read_error'] = str(e)
-            critical_fail = True
-    else:
-        critical_fail = True
-except Exception as e:
-    results['token_check']['error'] = str(e)
-    critical_fail = True
-
-# 4) listen check (try to open TCP connection)
-sock_ok = False
-try:
-    with socket.create_connection((HOST, int(PORT)), timeout=3):
-        sock_ok = True
-except Exception as e:
-    results['listen_check']['error'] = str(e)
-results['listen_check']['listening'] = sock_ok
-if not sock_ok:
-    critical_fail = True
+if args.json:
+    print(json.dumps(results, indent=2))
+    sys.exit(0 if results['ok'] else 1)
 
 # Final report
 print('\n--- Verify Deployment Report ---\n')
-print('Host:', HOST, 'Port:', PORT)
+print('Host:', HOST, 'Port:', PORT, f"({results['duration_ms']} ms)")
 print('\nService status:')
 for svc, info in results['service_status'].items():
-    print(f" - {svc}: active={info['active']} output={info['output']}")
+    print(f" - {svc}: active={info['active']} output={info['output']} [{info['latency_ms']} ms]")
 
 print('\nHTTP checks:')
-for k,v in results['http_checks'].items():
-    print(f" - {k}: {v}")
+for k, v in results['http_checks'].items():
+    if k == 'base_url':
+        continue
+    status = v.get('status_code') if v.get('ok') else v.get('error')
+    print(f" - {k}: {status} [{v['latency_ms']} ms] {(v.get('text_snippet') or '')[:200]}")
 
-print('\nToken check:')
-p = results['token_check']
-pprint(p)
+print(f"\nToken check: [{results['token_check']['latency_ms']} ms]")
+pprint(results['token_check'])
 
-print('\nListen check:')
+print(f"\nListen check: [{results['listen_check']['latency_ms']} ms]")
 print(results['listen_check'])
 
+if args.slo:
+    print(f"\nSLO ({args.requests} requêtes x endpoint, concurrence {args.concurrency}):")
+    for name, s in results['slo']['endpoints'].items():
+        hit = '-' if s['hit_ratio'] is None else s['hit_ratio']
+        print(f" - {name}: p50={s['p50_ms']} ms p95={s['p95_ms']} ms max={s['max_ms']} ms "
+              f"errors={s['error_rate']} hit={hit} 429={s['rate_limited']} shed={s['shed']} -> {'OK' if s['ok'] else 'FAIL'}")
+        for v in s['violations']:
+            print(f"     ! {v}")
+
 print('\nSummary:')
-if critical_fail:
-    print('FAIL: one or more critical checks failed')
+if failures:
+    print('FAIL: one or more critical checks failed: ' + ', '.join(failures))
     sys.exit(1)
 else:
     print('OK: all critical checks passed')
@@ -1,140 +1,364 @@
+"""tools/wake_remote.py
+Réveil Wake-on-LAN via l'API Freebox, pour une ou plusieurs machines.
+
+Usage:
+  python3 tools/wake_remote.py <mac_address> [host_ip] [--json]
+  python3 tools/wake_remote.py --target MAC[,IP[,PORT|URL]] [--target ...] [--targets-file FILE]
+                               [--max-wait 120] [--json] [--token PATH]
+
+Une cible s'écrit MAC[,IP[,PORT|URL]] ; le fichier --targets-file contient une cible par ligne
+(lignes vides et commentaires # ignorés). Tous les paquets WOL partent sur une seule session
+Freebox, puis les machines sont attendues en parallèle : ping, puis connexion TCP (si port),
+puis requête HTTP (si URL). Une machine est prête quand le niveau le plus exigeant répond.
+
+Codes de sortie:
+  0  toutes les machines sont prêtes (ou WOL envoyé si aucune IP à attendre)
+  1  configuration ou connexion Freebox impossible
+  2  arguments invalides
+  3  au moins un paquet WOL n'a pas pu être envoyé
+  4  au moins une machine n'est pas prête avant --max-wait
+"""
+
 import requests
+import argparse
 import json
+import os
+import socket
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from urllib.parse import urlparse
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_TOKEN_PATH = os.environ.get('FREEBOX_TOKEN_PATH') or os.path.join(BASE_DIR, ".freebox_token")
+DEFAULT_FREEBOX_URL = "http://mafreebox.freebox.fr"
+
+EXIT_OK = 0
+EXIT_CONFIG = 1
+EXIT_USAGE = 2
+EXIT_WOL_FAILED = 3
+EXIT_TIMEOUT = 4
+
+_print_lock = Lock()
+
+def log(message, stream=None):
+    """Affichage thread-safe de la progression (une ligne par événement)."""
+    with _print_lock:
+        print(message, file=stream or sys.stdout, flush=True)
 
-def load_config():
-    """Charger la configuration Freebox"""
+def make_session(pool_size=10):
+    """Session HTTP unique (keep-alive + pool) pour le login, les WOL et les sondes HTTP."""
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=1)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+def load_config(path=DEFAULT_TOKEN_PATH):
+    """Charger la configuration Freebox. Retourne (config, erreur)."""
     try:
-        with open("../.freebox_token", "r") as f:
-            return json.load(f)
+        with open(path, "r") as f:
+            return json.load(f), None
     except FileNotFoundError:
-        print("❌ Fichier .freebox_token non trouvé")
-        print("Exécutez d'abord: python3 freebox_auth.py")
-        sys.exit(1)
+        print(f"❌ Fichier {path} non trouvé", file=sys.stderr)
+        print("Exécutez d'abord: python3 freebox_auth.py", file=sys.stderr)
+        return None, f"{path} not found"
+    except (OSError, ValueError) as e:
+        print(f"❌ Fichier {path} illisible: {e}", file=sys.stderr)
+        return None, f"cannot read {path}: {e}"
+
+def freebox_base(config):
+    """URL de la Freebox (les anciens fichiers .freebox_token n'ont pas de freebox_url)."""
+    return (config.get("freebox_url") or DEFAULT_FREEBOX_URL).rstrip('/')
 
-def get_challenge(freebox_url):
+def get_challenge(freebox_url, session=requests):
     """Obtenir le challenge pour l'authentification"""
     url = f"{freebox_url}/api/v8/login/"
-    response = requests.get(url)
+    response = session.get(url, timeout=(2, 5))
     data = response.json()
-    
+
     if data.get("success"):
         return data["result"]["challenge"]
     else:
         raise Exception(f"Erreur challenge: {data}")
 
-def login_freebox(freebox_url, app_id, app_token):
+def login_freebox(freebox_url, app_id, app_token, session=requests):
     """Se connecter à la Freebox et obtenir un session_token"""
     import hmac
     import hashlib
-    
+
     # Obtenir le challenge
-    challenge = get_challenge(freebox_url)
-    
+    challenge = get_challenge(freebox_url, session=session)
+
     # Calculer le mot de passe (HMAC-SHA1)
     password = hmac.new(
         app_token.encode(),
         challenge.encode(),
         hashlib.sha1
     ).hexdigest()
-    
+
     # Login
     url = f"{freebox_url}/api/v8/login/session/"
     payload = {
         "app_id": app_id,
         "password": password
     }
-    
-    response = requests.post(url, json=payload)
+
+    response = session.post(url, json=payload, timeout=(2, 5))
     data = response.json()
-    
+
     if data.get("success"):
         return data["result"]["session_token"]
     else:
         raise Exception(f"Login échoué: {data}")
 
-def send_wol(freebox_url, session_token, mac_address):
+def send_wol(freebox_url, session_token, mac_address, session=requests):
     """Envoyer un paquet Wake-on-LAN"""
     url = f"{freebox_url}/api/v8/lan/wol/pub/"
     headers = {"X-Fbx-App-Auth": session_token}
     payload = {"mac": mac_address}
-    
-    response = requests.post(url, json=payload, headers=headers)
+
+    response = session.post(url, json=payload, headers=headers, timeout=(2, 5))
     data = response.json()
-    
+
     return data.get("success", False)
 
 def ping_host(host, timeout=1):
     """Vérifier si l'hôte répond au ping"""
     import subprocess
     import platform
-    
+
     param = "-n" if platform.system().lower() == "windows" else "-c"
     command = ["ping", param, "1", "-W" if platform.system().lower() != "darwin" else "-t", str(timeout), host]
-    
+
     try:
         subprocess.check_output(command, stderr=subprocess.STDOUT)
         return True
-    except subprocess.CalledProcessError:
+    except (subprocess.CalledProcessError, FileNotFoundError):
+        return False
+
+def tcp_up(host, port, timeout=1):
+    """Vérifier qu'un port TCP accepte les connexions"""
+    try:
+        with socket.create_connection((host, int(port)), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+def http_up(url, session=requests, timeout=(1, 2)):
+    """Requête HTTP légère : on lit seulement le statut, jamais le corps"""
+    try:
+        with session.get(url, timeout=timeout, allow_redirects=False, stream=True) as resp:
+            return resp.status_code < 400
+    except requests.RequestException:
         return False
 
 def wait_for_host(host, max_wait=120):
     """Attendre que l'hôte soit accessible"""
     print(f"\n⏳ Attente du démarrage de {host}...")
-    
+
     for i in range(max_wait):
         if ping_host(host):
             print(f"\n✅ Hôte {host} accessible après {i} secondes")
             return True
-        
+
         print(f"⏳ Attente... ({i+1}/{max_wait}s)", end="\r")
         time.sleep(1)
-    
+
     print(f"\n⏱️  Timeout après {max_wait} secondes")
     return False
 
-if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python3 wake_remote.py <mac_address> [host_ip]")
-        print("Exemple: python3 wake_remote.py AA:BB:CC:DD:EE:FF 192.168.1.100")
-        sys.exit(1)
-    
-    mac_address = sys.argv[1]
-    host_ip = sys.argv[2] if len(sys.argv) > 2 else None
-    
+def parse_target(spec):
+    """MAC[,IP[,PORT|URL]] -> dict. Lève ValueError si la MAC est absente."""
+    parts = [p.strip() for p in spec.split(',')]
+    if not parts or not parts[0]:
+        raise ValueError(f"cible invalide: {spec!r}")
+    target = {"mac": parts[0], "ip": None, "port": None, "url": None}
+    if len(parts) > 1 and parts[1]:
+        target["ip"] = parts[1]
+    if len(parts) > 2 and parts[2]:
+        if parts[2].isdigit():
+            target["port"] = int(parts[2])
+        else:
+            target["url"] = parts[2]
+            if not target["ip"]:
+                target["ip"] = urlparse(parts[2]).hostname
+    return target
+
+def read_targets_file(path):
+    targets = []
+    with open(path, "r") as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                targets.append(parse_target(line))
+    return targets
+
+def wait_for_target(target, session, max_wait, start):
+    """Attendre une machine avec des sondes adaptatives.
+    Le niveau le plus élevé configuré (HTTP, sinon TCP, sinon ping) est sondé à chaque tour : c'est
+    lui qui décide si la machine est prête, même si elle ne répond pas au ping (pare-feu Windows).
+    Les niveaux inférieurs ne servent qu'à régler l'intervalle : il s'allonge tant que rien ne
+    répond (1s -> 5s) et reste à 1s dès qu'un niveau répond, la disponibilité complète étant proche.
+    """
+    name = target["ip"] or target["mac"]
+    timings = {}
+    tiers = [("ping", lambda: ping_host(target["ip"]))]
+    if target["port"]:
+        tiers.append(("tcp", lambda: tcp_up(target["ip"], target["port"])))
+    if target["url"]:
+        tiers.append(("http", lambda: http_up(target["url"], session=session)))
+    top, ready_probe = tiers[-1]
+
+    interval = 1.0
+    deadline = start + max_wait
+    while time.time() < deadline:
+        if ready_probe():
+            timings[top] = round(time.time() - start, 2)
+            log(f"✅ [{name}] {top} OK après {timings[top]:.1f}s")
+            return {"ready": True, "timings": timings, "elapsed": timings[top]}
+        for tier, probe in tiers[:-1]:
+            if tier not in timings and probe():
+                timings[tier] = round(time.time() - start, 2)
+                log(f"✅ [{name}] {tier} OK après {timings[tier]:.1f}s")
+        time.sleep(max(0.0, min(interval, deadline - time.time())))
+        interval = 1.0 if timings else min(interval * 1.5, 5.0)
+    log(f"⏱️  [{name}] non prêt après {max_wait}s (niveaux atteints: {list(timings) or 'aucun'})")
+    return {"ready": False, "timings": timings, "elapsed": round(time.time() - start, 2)}
+
+def wake_many(targets, config, max_wait=120):
+    """Envoyer tous les WOL sur une seule session, puis attendre toutes les machines en parallèle.
+    Retourne (résumé, code de sortie).
+    """
+    session = make_session(pool_size=max(4, len(targets)))
+    freebox_url = freebox_base(config)
+    t0 = time.time()
+    try:
+        session_token = login_freebox(freebox_url, config["app_id"], config["app_token"], session=session)
+    except Exception as e:
+        log(f"❌ Erreur de connexion: {e}", sys.stderr)
+        return {"error": str(e), "exit_code": EXIT_CONFIG, "targets": []}, EXIT_CONFIG
+    log(f"🔐 Connecté en {time.time() - t0:.2f}s")
+
+    results = []
+    for target in targets:
+        sent_at = time.time()
+        try:
+            sent = send_wol(freebox_url, session_token, target["mac"], session=session)
+        except Exception as e:
+            log(f"❌ [{target['mac']}] erreur WOL: {e}")
+            sent = False
+        log(f"{'📡' if sent else '❌'} [{target['mac']}] WOL {'envoyé' if sent else 'échoué'}")
+        results.append({**target, "wol_sent": sent, "wol_at": round(sent_at - t0, 2)})
+
+    to_wait = [r for r in results if r["wol_sent"] and r["ip"]]
+    if to_wait:
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=min(32, len(to_wait))) as pool:
+            futures = [(r, pool.submit(wait_for_target, r, session, max_wait, start)) for r in to_wait]
+            for r, fut in futures:
+                r.update(fut.result())
+
+    exit_code = EXIT_OK
+    if any(not r["wol_sent"] for r in results):
+        exit_code = EXIT_WOL_FAILED
+    elif any(r.get("ready") is False for r in results):
+        exit_code = EXIT_TIMEOUT
+    summary = {
+        "total": len(results),
+        "sent": sum(1 for r in results if r["wol_sent"]),
+        "ready": sum(1 for r in results if r.get("ready")),
+        "elapsed": round(time.time() - t0, 2),
+        "exit_code": exit_code,
+        "targets": results,
+    }
+    return summary, exit_code
+
+def main_single(mac_address, host_ip, config):
+    """Mode historique : une MAC, attente optionnelle par ping."""
     print("🏠 Wake-on-LAN via Freebox API")
     print("="*60)
-    
-    # Charger config
-    config = load_config()
-    
+
     # Login
     print("🔐 Connexion à la Freebox...")
     try:
         session_token = login_freebox(
-            config["freebox_url"],
+            freebox_base(config),
             config["app_id"],
             config["app_token"]
         )
         print("✅ Connecté")
     except Exception as e:
         print(f"❌ Erreur de connexion: {e}")
-        sys.exit(1)
-    
+        sys.exit(EXIT_CONFIG)
+
     # Envoyer WOL
     print(f"📡 Envoi du paquet WOL vers {mac_address}...")
-    if send_wol(config["freebox_url"], session_token, mac_address):
+    if send_wol(freebox_base(config), session_token, mac_address):
         print("✅ Paquet WOL envoyé")
-        
+
         # Attendre que l'hôte démarre
         if host_ip:
             if wait_for_host(host_ip):
                 print("\n🎉 PC démarré et accessible!")
             else:
                 print("\n⚠️  PC non accessible (vérifiez la configuration)")
+                sys.exit(EXIT_TIMEOUT)
         else:
             print("\n⏳ Attendez environ 30-60 secondes que le PC démarre")
     else:
         print("❌ Échec de l'envoi du paquet WOL")
-        sys.exit(1)
\ No newline at end of file
+        sys.exit(EXIT_WOL_FAILED)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Wake-on-LAN via l'API Freebox (une ou plusieurs machines)")
+    parser.add_argument('mac', nargs='?', help='Adresse MAC (mode historique à une machine)')
+    parser.add_argument('host_ip', nargs='?', help='IP à attendre (mode historique)')
+    parser.add_argument('--target', action='append', default=[], help='Cible MAC[,IP[,PORT|URL]] (répétable)')
+    parser.add_argument('--targets-file', help='Fichier avec une cible MAC[,IP[,PORT|URL]] par ligne')
+    parser.add_argument('--max-wait', type=int, default=120, help='Attente maximale par machine (s)')
+    parser.add_argument('--json', action='store_true', help='Résumé JSON sur stdout (progression sur stderr)')
+    parser.add_argument('--token', default=DEFAULT_TOKEN_PATH, help='Chemin du fichier .freebox_token')
+    args = parser.parse_args()
+
+    json_out = None
+    if args.json:
+        # la progression part sur stderr pour garder stdout exploitable par un script
+        sys.stdout, json_out = sys.stderr, sys.stdout
+
+    def finish(summary, code):
+        if json_out:
+            json.dump(summary, json_out, indent=2)
+            json_out.write("\n")
+        sys.exit(code)
+
+    try:
+        targets = [parse_target(t) for t in args.target]
+        if args.targets_file:
+            targets.extend(read_targets_file(args.targets_file))
+    except (OSError, ValueError) as e:
+        parser.error(str(e))
+
+    if not targets and not args.mac:
+        parser.print_usage()
+        print("Exemple: python3 wake_remote.py AA:BB:CC:DD:EE:FF 192.168.1.100")
+        print("         python3 wake_remote.py --target AA:BB:CC:DD:EE:FF,192.168.1.100,http://192.168.1.100:5000/")
+        finish({"error": "no target", "exit_code": EXIT_USAGE, "targets": []}, EXIT_USAGE)
+
+    config, err = load_config(args.token)
+    if config is None:
+        finish({"error": err, "exit_code": EXIT_CONFIG, "targets": []}, EXIT_CONFIG)
+
+    if not targets and not args.json:
+        main_single(args.mac, args.host_ip, config)
+        sys.exit(EXIT_OK)
+
+    # --json en mode historique: même chemin que --target, pour le même résumé
+    if args.mac:
+        targets.insert(0, {"mac": args.mac, "ip": args.host_ip, "port": None, "url": None})
+    summary, code = wake_many(targets, config, max_wait=args.max_wait)
+    if not json_out:
+        log(f"\n🎯 {summary.get('ready', 0)}/{summary.get('total', 0)} machine(s) prête(s) "
+            f"en {summary.get('elapsed', 0)}s (code {code})")
+    finish(summary, code)
@@ -4,7 +4,7 @@
 Application Flask pour Wake-on-LAN via API Freebox (durcie)
 """
 
-from flask import Flask, render_template, request, jsonify, redirect, abort
+from flask import Flask, render_template, request, jsonify, redirect, abort, g, has_request_context
 from requests import adapters, Session
 from werkzeug.middleware.proxy_fix import ProxyFix
 import json
@@ -14,18 +14,39 @@ import subprocess
 import platform
 import os
 import socket
-from urllib.parse import urlparse
-from dotenv import load_dotenv
+import struct
+import signal
+import atexit
+import fcntl
+import random
+import secrets
+from concurrent.futures import ThreadPoolExecutor, wait as wait_futures
+import ipaddress
+from collections import OrderedDict, Counter
+import sys
+import errno
+import selectors
+from urllib.parse import urlparse, urljoin
+from dotenv import load_dotenv, dotenv_values
+import click
 from requests.exceptions import RequestException
 import logging
 import time
-from threading import Lock
+from threading import Lock, BoundedSemaphore, Condition, Thread, Event, get_ident, current_thread, main_thread, enumerate as enumerate_threads
+from datetime import datetime, timedelta
+from contextlib import contextmanager
+from wol_state import open_store, MemoryStore
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 TEMPLATE_DIR = os.path.join(BASE_DIR, 'templates')
 STATIC_DIR = os.path.join(BASE_DIR, 'static')
 ENV_PATH = os.path.join(BASE_DIR, '.env')
 
+# Environnement du processus avant .env (prioritaire sur .env, y compris lors d'un rechargement)
+BOOT_ENVIRON = dict(os.environ)
+# .env tel qu'au démarrage: une variable de BOOT_ENVIRON de même valeur vient de ce fichier
+# (EnvironmentFile=.env de systemd) et suit donc .env au rechargement
+BOOT_FILE_ENV = {k: v for k, v in dotenv_values(ENV_PATH).items() if v is not None} if os.path.exists(ENV_PATH) else {}
 # Charger .env s'il existe
 load_dotenv(ENV_PATH)
 
@@ -87,6 +108,12 @@ try:
 except Exception:
     _csrf_enabled = False
 
+def csrf_exempt(view):
+    """Exempt a JSON endpoint from the CSRF check (no session or form is involved)."""
+    if _csrf_enabled:
+        csrf.exempt(view)
+    return view
+
 # Par défaut; sera remplacé par la valeur du fichier .freebox_token si présente
 DEFAULT_FREEBOX_URL = "http://mafreebox.freebox.fr"
 # TIMEOUT = 10  # timeout pour requests en secondes
@@ -94,60 +121,374 @@ DEFAULT_FREEBOX_URL = "http://mafreebox.freebox.fr"
 REQUEST_TIMEOUT = int(os.environ.get('REQUEST_TIMEOUT', '8'))
 CONNECT_TIMEOUT = int(os.environ.get('CONNECT_TIMEOUT', '2'))
 READ_TIMEOUT = int(os.environ.get('READ_TIMEOUT', '5'))
-# Session for HTTP calls with sensible defaults
+# Session for HTTP calls with sensible defaults (service probes, warm-up); Freebox calls go through
+# the pool of their router (see ROUTERS)
 _http_session = Session()
 _adapter = adapters.HTTPAdapter(max_retries=1)
 _http_session.mount('http://', _adapter)
 _http_session.mount('https://', _adapter)
 
+# Server-Timing: stages wrapped in timing_span() are summed per request and sent back in a
+# Server-Timing header (browser devtools); requests slower than SLOW_REQUEST_MS are logged as one
+# JSON record with the full breakdown (and appended to SLOW_REQUEST_LOG if set). SERVER_TIMING=0
+# turns every span into a bare yield.
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING', '1') in ('1', 'true', 'True')
+try:
+    SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', '1000'))
+    SLOW_REQUEST_LOG_MAX_BYTES = int(os.environ.get('SLOW_REQUEST_LOG_MAX_BYTES', '1048576'))
+except Exception:
+    SLOW_REQUEST_MS = 1000.0
+    SLOW_REQUEST_LOG_MAX_BYTES = 1048576
+SLOW_REQUEST_LOG = os.environ.get('SLOW_REQUEST_LOG')
+slow_logger = logging.getLogger('wakeonlan.slow')
+
+@contextmanager
+def timing_span(name):
+    """Time the enclosed stage for the current request (no-op outside requests or when disabled)."""
+    if not SERVER_TIMING_ENABLED or not has_request_context():
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        g.setdefault('timing_spans', []).append((name, start, time.perf_counter() - start))
+
+@app.before_request
+def _start_timing():
+    if SERVER_TIMING_ENABLED:
+        g.timing_start = time.perf_counter()
+
+def record_slow_request(record):
+    line = json.dumps(record, separators=(',', ':'))
+    slow_logger.warning(f"Slow request: {line}")
+    if not SLOW_REQUEST_LOG:
+        return
+    try:
+        if os.path.exists(SLOW_REQUEST_LOG) and os.path.getsize(SLOW_REQUEST_LOG) > SLOW_REQUEST_LOG_MAX_BYTES:
+            os.replace(SLOW_REQUEST_LOG, SLOW_REQUEST_LOG + '.1')
+        with open(SLOW_REQUEST_LOG, 'a') as f:
+            f.write(line + '\n')
+    except Exception as e:
+        logger.debug(f"Cannot append to {SLOW_REQUEST_LOG}: {e}")
+
+@app.after_request
+def _server_timing(resp):
+    start = g.get('timing_start')
+    if start is None:
+        return resp
+    total_ms = (time.perf_counter() - start) * 1000
+    spans = g.get('timing_spans') or []
+    totals = {}
+    for name, _start, dur in spans:
+        ms, count = totals.get(name, (0.0, 0))
+        totals[name] = (ms + dur * 1000, count + 1)
+    parts = [f'{name};dur={ms:.1f}' + (f';desc="x{count}"' if count > 1 else '')
+             for name, (ms, count) in totals.items()]
+    parts.append(f'total;dur={total_ms:.1f}')
+    resp.headers['Server-Timing'] = ', '.join(parts)
+    if SLOW_REQUEST_MS and total_ms >= SLOW_REQUEST_MS:
+        record_slow_request({
+            'ts': datetime.now().isoformat(timespec='seconds'),
+            'method': request.method,
+            'path': request.path,
+            'status': resp.status_code,
+            'total_ms': round(total_ms, 1),
+            'spans': [{'name': name, 'start_ms': round((s0 - start) * 1000, 1), 'ms': round(dur * 1000, 1)}
+                      for name, s0, dur in spans],
+        })
+    return resp
+
 CONFIG_FILE = os.environ.get('FREEBOX_TOKEN_PATH', os.path.join(BASE_DIR, ".freebox_token"))
 # Allow FREEBOX_IP from .env as an override/fallback
 ENV_FREEBOX_IP = os.environ.get('FREEBOX_IP')
 
 GAMEARENA_URL = os.environ.get('GAMEARENA_URL')
 GAMEARENA_HOST_IP = os.environ.get('GAMEARENA_HOST_IP')
-# Parse GAMEARENA_PORT robustly: None if not set or invalid
-_gamearena_port_env = os.environ.get('GAMEARENA_PORT')
-try:
-    GAMEARENA_PORT = int(_gamearena_port_env) if _gamearena_port_env is not None else None
-except (TypeError, ValueError):
-    GAMEARENA_PORT = None
+
+def parse_optional_port(value):
+    """GAMEARENA_PORT: a TCP port, or None if not set or invalid (same rule at boot and on reload)."""
+    if value is None or not str(value).strip():
+        return None
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        port = 0
+    if not 0 < port < 65536:
+        logger.warning(f"Ignoring invalid GAMEARENA_PORT {value!r}")
+        return None
+    return port
+
+GAMEARENA_PORT = parse_optional_port(os.environ.get('GAMEARENA_PORT'))
 MAX_WAIT_TIME = int(os.environ.get('MAX_WAIT_TIME', '120'))
 
-MACHINES = {
-    "gamearena_server": {
-        "name": "GameArena Server",
-        "mac": os.environ.get('GAMEARENA_HOST_MAC'),
-        "ip": GAMEARENA_HOST_IP
-    },
-}
+def parse_status_set(value, default=((200, 399),)):
+    """'200-399' or '200,204,301-302' -> tuple of (lo, hi) ranges."""
+    ranges = []
+    for part in (value or '').split(','):
+        part = part.strip()
+        if not part:
+            continue
+        try:
+            lo, _, hi = part.partition('-')
+            ranges.append((int(lo), int(hi or lo)))
+        except ValueError:
+            logger.warning(f"Ignoring invalid status range {part!r}")
+    return tuple(ranges) or default
+
+def load_http_probe_spec(prefix, environ=None):
+    """Readiness probe spec for a machine, from <prefix>_PROBE_* environment variables.
+    Probes never download bodies: at most `max_bytes` are read when `body_prefix` is set.
+    """
+    env = (os.environ if environ is None else environ).get
+    try:
+        max_bytes = int(env(f'{prefix}_PROBE_MAX_BYTES', '512'))
+        redirects = int(env(f'{prefix}_PROBE_REDIRECTS', '0'))
+    except ValueError:
+        max_bytes, redirects = 512, 0
+    return {
+        'path': env(f'{prefix}_PROBE_PATH'),  # None: keep the URL path
+        'method': env(f'{prefix}_PROBE_METHOD', 'GET').upper(),
+        'status': parse_status_set(env(f'{prefix}_PROBE_STATUS')),
+        'header': env(f'{prefix}_PROBE_HEADER'),  # "Name" or "Name: substring"
+        'body_prefix': env(f'{prefix}_PROBE_BODY_PREFIX'),
+        'max_bytes': max_bytes,
+        'redirects': redirects,  # 0: a 3xx answer is judged by its own status
+    }
 
-def load_config():
-    # defensive: ensure CONFIG_FILE is a valid path-like string
-    if not CONFIG_FILE or not isinstance(CONFIG_FILE, (str, bytes, os.PathLike)):
+def parse_port_list(value):
+    """'5000, 22,8765' -> [5000, 22, 8765] (invalid entries ignored)."""
+    ports = []
+    for part in (value or '').split(','):
+        try:
+            ports.append(int(part))
+        except ValueError:
+            continue
+    return ports
+
+def load_warmup_spec(prefix, environ=None):
+    """Post-wake warm-up for a machine, from <prefix>_WARMUP_* environment variables.
+    URLs may be absolute or paths relative to the readiness URL; no URL means no warm-up.
+    """
+    env = (os.environ if environ is None else environ).get
+    try:
+        concurrency = max(1, int(env(f'{prefix}_WARMUP_CONCURRENCY', '2')))
+        budget = float(env(f'{prefix}_WARMUP_BUDGET', '15'))
+    except ValueError:
+        concurrency, budget = 2, 15.0
+    return {
+        'urls': [u for u in (env(f'{prefix}_WARMUP_URLS') or '').replace(',', ' ').split() if u],
+        'concurrency': concurrency,
+        'budget': budget,
+    }
+
+def build_env_machines(environ=None):
+    """Machines defined by GAMEARENA_* variables (rebuilt by reload_config)."""
+    env = (os.environ if environ is None else environ).get
+    try:
+        wake_lead_minutes = float(env('GAMEARENA_WAKE_LEAD_MINUTES', '30') or 30)
+    except Exception:
+        logger.warning(f"Invalid GAMEARENA_WAKE_LEAD_MINUTES {env('GAMEARENA_WAKE_LEAD_MINUTES')!r}, using 30")
+        wake_lead_minutes = 30.0
+    return {
+        "gamearena_server": {
+            "name": "GameArena Server",
+            "mac": env('GAMEARENA_HOST_MAC'),
+            "ip": env('GAMEARENA_HOST_IP'),
+            "probe": load_http_probe_spec('GAMEARENA', environ),
+            # extra TCP services that must also accept connections before the machine is "ready"
+            "ready_ports": parse_port_list(env('GAMEARENA_READY_PORTS')),
+            "warmup": load_warmup_spec('GAMEARENA', environ),
+            # Freebox profile used to wake it and to read its LAN status (see FREEBOX_ROUTERS)
+            "router": env('GAMEARENA_ROUTER') or 'default',
+            # pre-wake rules, e.g. "weekdays 17:45; sat,sun 10:00", and/or an events file
+            "wake_schedule": [r.strip() for r in env('GAMEARENA_WAKE_SCHEDULE', '').split(';') if r.strip()],
+            "wake_events_file": env('GAMEARENA_WAKE_EVENTS_FILE'),
+            "wake_lead_minutes": wake_lead_minutes
+        },
+    }
+
+MACHINES = build_env_machines()
+
+def file_stamp(path):
+    """(mtime_ns, size, inode) of path, or None when it cannot be stat'ed."""
+    if not path or not isinstance(path, (str, bytes, os.PathLike)):
+        return None
+    try:
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    return (st.st_mtime_ns, st.st_size, st.st_ino)
+
+def registry_version(machines):
+    """Short digest of the machine registry, part of every ETag that depends on it."""
+    return hashlib.sha1(json.dumps(machines, sort_keys=True, default=str).encode()).hexdigest()[:12]
+
+MACHINES_VERSION = registry_version(MACHINES)
+
+# Freebox routers (multi-site): every machine is woken and watched through one router profile.
+# "default" is the historical single Freebox (FREEBOX_TOKEN_PATH, FREEBOX_IP); FREEBOX_ROUTERS="site2 site3"
+# adds profiles read from FREEBOX_<NAME>_URL, FREEBOX_<NAME>_TOKEN_PATH, FREEBOX_<NAME>_APP_ID and
+# FREEBOX_<NAME>_MAX_CONCURRENCY. Each router has its own HTTP pool, session token, concurrency limit
+# and circuit breaker, so a slow or unreachable site never holds the threads or locks of another one.
+DEFAULT_ROUTER = 'default'
+try:
+    FREEBOX_MAX_CONCURRENCY = int(os.environ.get('FREEBOX_MAX_CONCURRENCY', '2'))
+    FREEBOX_BREAKER_THRESHOLD = int(os.environ.get('FREEBOX_BREAKER_THRESHOLD', '3'))
+    FREEBOX_BREAKER_COOLDOWN = float(os.environ.get('FREEBOX_BREAKER_COOLDOWN', '30'))
+except Exception:
+    FREEBOX_MAX_CONCURRENCY = 2
+    FREEBOX_BREAKER_THRESHOLD = 3
+    FREEBOX_BREAKER_COOLDOWN = 30.0
+
+def make_router(name, url=None, token_path=None, app_id=None, max_concurrency=None):
+    limit = max(1, max_concurrency or FREEBOX_MAX_CONCURRENCY)
+    session = Session()
+    adapter = adapters.HTTPAdapter(pool_connections=1, pool_maxsize=limit, max_retries=1)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return {
+        'name': name, 'url': url, 'token_path': token_path, 'app_id': app_id, 'limit': limit,
+        'session': session,
+        'slots': BoundedSemaphore(limit),
+        'login_lock': Lock(),  # one login at a time per router
+        'lan_lock': Lock(),    # one LAN-browser refresh at a time per router
+        'breaker_lock': Lock(),
+        'breaker': {'failures': 0, 'open_until': 0.0, 'trial': False, 'opened': 0},
+    }
+
+def load_routers(environ=None, token_path=None):
+    routers = {DEFAULT_ROUTER: make_router(DEFAULT_ROUTER, token_path=token_path or CONFIG_FILE)}
+    env = (os.environ if environ is None else environ).get
+    for name in (env('FREEBOX_ROUTERS') or '').replace(',', ' ').split():
+        key = name.upper().replace('-', '_')
+        try:
+            limit = int(env(f'FREEBOX_{key}_MAX_CONCURRENCY') or 0) or None
+        except ValueError:
+            limit = None
+        routers[name] = make_router(name, url=env(f'FREEBOX_{key}_URL'),
+                                    token_path=env(f'FREEBOX_{key}_TOKEN_PATH') or os.path.join(BASE_DIR, f'.freebox_token.{name}'),
+                                    app_id=env(f'FREEBOX_{key}_APP_ID'), max_concurrency=limit)
+    return routers
+
+ROUTERS = load_routers()
+
+def get_router(config_or_name=None):
+    """Router profile for a name or a loaded config (unknown names fall back to the default router)."""
+    name = config_or_name.get('router') if isinstance(config_or_name, dict) else config_or_name
+    return ROUTERS.get(name) or ROUTERS[DEFAULT_ROUTER]
+
+def machine_router(machine):
+    """Name of the router a machine entry is reached through (unknown names: default router)."""
+    name = (machine or {}).get('router') or DEFAULT_ROUTER
+    if name not in ROUTERS:
+        logger.warning(f"Unknown Freebox router {name!r} for {machine.get('name')}; using {DEFAULT_ROUTER}")
+        return DEFAULT_ROUTER
+    return name
+
+def router_for(ip=None, mac=None):
+    """Router of the registered machine with this IP or MAC (default router otherwise)."""
+    return machine_router(find_machine(ip=ip, mac=mac)[1])
+
+def load_config(router=DEFAULT_ROUTER):
+    """Token file of a router, tagged with the router name so every Freebox call made with it
+    goes through that router's pool, session and breaker. None if missing or unreadable."""
+    profile = get_router(router)
+    path = profile['token_path']
+    # defensive: ensure the token path is a valid path-like string
+    if not path or not isinstance(path, (str, bytes, os.PathLike)):
         return None
     try:
-        with open(CONFIG_FILE, "r") as f:
-            return json.load(f)
+        with open(path, "r") as f:
+            config = json.load(f)
     except FileNotFoundError:
         return None
     except Exception:
         return None
+    if not isinstance(config, dict):
+        return None
+    config['router'] = profile['name']
+    if profile['app_id']:
+        config['app_id'] = profile['app_id']
+    return config
+
+def _normalize_base(url):
+    # If user provided an IP that likely includes scheme or not, normalize
+    if url.startswith('http://') or url.startswith('https://'):
+        return url.rstrip('/')
+    return f"http://{url}".rstrip('/')
 
 def get_freebox_base(config):
+    router = get_router(config)
+    # URL explicite du profil de routeur en priorité
+    if router['url']:
+        return _normalize_base(router['url'])
     # Prend la valeur dans la config si fournie, sinon fallback
     if config:
         url = config.get("freebox_url")
         if url:
             return url.rstrip('/')
-    # If freebox IP is provided via environment, build a URL
-    if ENV_FREEBOX_IP:
-        # If user provided an IP that likely includes scheme or not, normalize
-        if ENV_FREEBOX_IP.startswith('http://') or ENV_FREEBOX_IP.startswith('https://'):
-            return ENV_FREEBOX_IP.rstrip('/')
-        return f"http://{ENV_FREEBOX_IP}"
+    # If freebox IP is provided via environment, build a URL (default router only)
+    if ENV_FREEBOX_IP and router['name'] == DEFAULT_ROUTER:
+        return _normalize_base(ENV_FREEBOX_IP)
     return DEFAULT_FREEBOX_URL
 
+def _breaker_record(router, ok):
+    with router['breaker_lock']:
+        breaker = router['breaker']
+        breaker['trial'] = False
+        if ok:
+            breaker['failures'] = 0
+            breaker['open_until'] = 0.0
+            return
+        breaker['failures'] += 1
+        if breaker['failures'] >= FREEBOX_BREAKER_THRESHOLD:
+            if breaker['open_until'] <= time.monotonic():
+                breaker['opened'] += 1
+                logger.warning(f"Freebox {router['name']}: {breaker['failures']} network failures — "
+                               f"circuit open for {FREEBOX_BREAKER_COOLDOWN:.0f}s")
+            breaker['open_until'] = time.monotonic() + FREEBOX_BREAKER_COOLDOWN
+
+def router_request(router, method, url, what, **kwargs):
+    """One HTTP call through the router's own pool, bounded by its concurrency limit and circuit
+    breaker. Returns (resp, err). Network errors count towards opening the breaker; while it is open
+    calls fail at once, then a single trial call decides whether it closes again.
+    """
+    name = router['name']
+    with router['breaker_lock']:
+        breaker = router['breaker']
+        remaining = breaker['open_until'] - time.monotonic()
+        if remaining > 0 or (breaker['failures'] >= FREEBOX_BREAKER_THRESHOLD and breaker['trial']):
+            return None, f"Freebox {name} unavailable (circuit open, retry in {max(remaining, 0):.0f}s)"
+        if breaker['failures'] >= FREEBOX_BREAKER_THRESHOLD:
+            breaker['trial'] = True  # half-open: this call is the probe
+    if not router['slots'].acquire(timeout=CONNECT_TIMEOUT):
+        with router['breaker_lock']:
+            router['breaker']['trial'] = False
+        return None, f"Freebox {name} busy ({router['limit']} calls in flight)"
+    try:
+        resp = router['session'].request(method, url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), **kwargs)
+    except RequestException as e:
+        _breaker_record(router, ok=False)
+        logger.debug(f"Network error {what} ({name}): {e}")
+        return None, f"Network error {what}: {e}"
+    finally:
+        router['slots'].release()
+    _breaker_record(router, ok=True)
+    return resp, None
+
+def router_status(router):
+    """Gauges of one router for /api/load."""
+    with router['breaker_lock']:
+        breaker = dict(router['breaker'])
+    remaining = breaker['open_until'] - time.monotonic()
+    return {'base_url': get_freebox_base({'router': router['name']}), 'limit': router['limit'],
+            # BoundedSemaphore keeps its free count in _value
+            'in_flight': router['limit'] - getattr(router['slots'], '_value', router['limit']),
+            'breaker': 'open' if remaining > 0 else ('half-open' if breaker['failures'] >= FREEBOX_BREAKER_THRESHOLD else 'closed'),
+            'failures': breaker['failures'], 'opened': breaker['opened'],
+            'retry_in': round(remaining, 1) if remaining > 0 else None}
+
 def safe_json(resp):
     """Retourne un tuple (data, error). data est dict ou None."""
     try:
@@ -158,13 +499,11 @@ def safe_json(resp):
         snippet = (resp.text or "")[:2000]
         return None, f"Non-JSON response (status {resp.status_code}): {snippet}"
 
-def get_challenge(base_url):
+def get_challenge(base_url, router=None):
     url = f"{base_url}/api/v8/login/"
-    try:
-        resp = _http_session.get(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
-    except RequestException as e:
-        logger.debug(f"Network error getting challenge: {e}")
-        return None, f"Network error getting challenge: {e}"
+    resp, err = router_request(router or get_router(), 'GET', url, 'getting challenge')
+    if err:
+        return None, err
     data, err = safe_json(resp)
     if err:
         return None, err
@@ -174,7 +513,9 @@ def get_challenge(base_url):
 
 def login_freebox(config):
     base_url = get_freebox_base(config)
-    challenge, err = get_challenge(base_url)
+    router = get_router(config)
+    with timing_span('fbx-challenge'):
+        challenge, err = get_challenge(base_url, router)
     if err:
         return None, err
     if not challenge:
@@ -192,11 +533,10 @@ def login_freebox(config):
 
     url = f"{base_url}/api/v8/login/session/"
     payload = {"app_id": config["app_id"], "password": password}
-    try:
-        resp = _http_session.post(url, json=payload, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
-    except RequestException as e:
-        logger.debug(f"Network error during login: {e}")
-        return None, f"Network error during login: {e}"
+    with timing_span('fbx-login'):
+        resp, err = router_request(router, 'POST', url, 'during login', json=payload)
+    if err:
+        return None, err
 
     data, err = safe_json(resp)
     if err:
@@ -214,11 +554,10 @@ def send_wol(session_token, mac_address, config):
     headers = {"X-Fbx-App-Auth": session_token}
     payload = {"mac": mac_address}
 
-    try:
-        resp = _http_session.post(url, json=payload, headers=headers, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
-    except RequestException as e:
-        logger.debug(f"Network error sending WOL: {e}")
-        return False, f"Network error sending WOL: {e}"
+    with timing_span('fbx-wol'):
+        resp, err = router_request(get_router(config), 'POST', url, 'sending WOL', json=payload, headers=headers)
+    if err:
+        return False, err
 
     data, err = safe_json(resp)
     if err:
@@ -227,7 +566,169 @@ def send_wol(session_token, mac_address, config):
         return False, f"Freebox returned failure for WOL: {data}"
     return True, None
 
-def ping_host(host, timeout=1):
+# Kernel neighbour table (ARP/NDP): a zero-cost presence tier read before any ICMP/subprocess.
+# One bulk dump covers every machine; the snapshot is shared for NEIGH_CACHE_TTL seconds.
+NEIGH_PROBE_ENABLED = os.environ.get('NEIGH_PROBE', '1') in ('1', 'true', 'True')
+try:
+    NEIGH_CACHE_TTL = float(os.environ.get('NEIGH_CACHE_TTL', '1'))
+except Exception:
+    NEIGH_CACHE_TTL = 1.0
+NEIGH_PROC_PATH = '/proc/net/arp'
+# only a REACHABLE entry proves the host answered at link level very recently
+NEIGH_FRESH_STATES = ('REACHABLE',)
+# states meaning the NIC has (had) a resolved link-layer address on the LAN
+NEIGH_PRESENT_STATES = ('REACHABLE', 'DELAY', 'PROBE', 'STALE', 'COMPLETE')
+
+_NUD_STATES = {
+    0x01: 'INCOMPLETE', 0x02: 'REACHABLE', 0x04: 'STALE', 0x08: 'DELAY',
+    0x10: 'PROBE', 0x20: 'FAILED', 0x40: 'NOARP', 0x80: 'PERMANENT',
+}
+_RTM_NEWNEIGH = 28
+_RTM_GETNEIGH = 30
+_NLMSG_ERROR = 2
+_NLMSG_DONE = 3
+_NLM_F_REQUEST = 0x1
+_NLM_F_DUMP = 0x300
+_NDA_DST = 1
+_NDA_LLADDR = 2
+
+NEIGH_CACHE = {'ts': 0.0, 'by_ip': {}, 'by_mac': {}, 'source': None}
+NEIGH_CACHE_LOCK = Lock()
+
+def normalize_mac(mac):
+    if not mac:
+        return None
+    return mac.strip().lower().replace('-', ':')
+
+def _read_neigh_netlink():
+    """Dump the neighbour table with a single RTM_GETNEIGH request (IPv4 + IPv6, NUD states).
+    Returns {ip: {'mac': ..., 'state': ...}}. Raises OSError if netlink is unavailable.
+    """
+    if not hasattr(socket, 'AF_NETLINK'):
+        raise OSError('netlink not available on this platform')
+    entries = {}
+    with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, 0) as s:  # 0 = NETLINK_ROUTE
+        s.settimeout(1)
+        s.bind((0, 0))
+        ndmsg = struct.pack('=BBHiHBB', socket.AF_UNSPEC, 0, 0, 0, 0, 0, 0)
+        hdr = struct.pack('=IHHII', 16 + len(ndmsg), _RTM_GETNEIGH, _NLM_F_REQUEST | _NLM_F_DUMP, 1, 0)
+        s.send(hdr + ndmsg)
+        done = False
+        while not done:
+            data = s.recv(65536)
+            if not data:
+                break
+            off = 0
+            while off + 16 <= len(data):
+                length, mtype, _flags, _seq, _pid = struct.unpack_from('=IHHII', data, off)
+                if length < 16 or mtype == _NLMSG_DONE:
+                    done = True
+                    break
+                if mtype == _NLMSG_ERROR:
+                    errno_ = struct.unpack_from('=i', data, off + 16)[0]
+                    raise OSError(-errno_, 'netlink RTM_GETNEIGH error')
+                if mtype == _RTM_NEWNEIGH:
+                    family, _, _, _ifindex, state, _nflags, _ntype = struct.unpack_from('=BBHiHBB', data, off + 16)
+                    ip = mac = None
+                    attr = off + 16 + 12
+                    end = off + length
+                    while attr + 4 <= end:
+                        alen, atype = struct.unpack_from('=HH', data, attr)
+                        if alen < 4:
+                            break
+                        payload = data[attr + 4:attr + alen]
+                        if atype == _NDA_DST:
+                            try:
+                                ip = socket.inet_ntop(family, payload)
+                            except (ValueError, OSError):
+                                ip = None
+                        elif atype == _NDA_LLADDR and any(payload):
+                            mac = ':'.join(f'{b:02x}' for b in payload)
+                        attr += (alen + 3) & ~3
+                    if ip:
+                        entries[ip] = {'mac': mac, 'state': _NUD_STATES.get(state, hex(state))}
+                off += (length + 3) & ~3
+    return entries
+
+def _read_neigh_proc(path=NEIGH_PROC_PATH):
+    """Fallback: parse /proc/net/arp (IPv4 only, no NUD state — only complete/incomplete)."""
+    entries = {}
+    with open(path, 'r') as f:
+        next(f, None)  # header
+        for line in f:
+            parts = line.split()
+            if len(parts) < 4:
+                continue
+            ip, _hwtype, flags, mac = parts[:4]
+            try:
+                flags = int(flags, 16)
+            except ValueError:
+                continue
+            if flags & 0x4:
+                state = 'PERMANENT'
+            elif flags & 0x2:
+                state = 'COMPLETE'
+            else:
+                state = 'INCOMPLETE'
+            entries[ip] = {'mac': None if mac == '00:00:00:00:00:00' else mac.lower(), 'state': state}
+    return entries
+
+def read_neighbour_table(max_age=None):
+    """Return the (cached) neighbour snapshot as (by_ip, by_mac).
+    A single bulk read refreshes the snapshot for every machine at once.
+    """
+    if max_age is None:
+        max_age = NEIGH_CACHE_TTL
+    now = time.time()
+    with NEIGH_CACHE_LOCK:
+        if now - NEIGH_CACHE['ts'] < max_age:
+            return NEIGH_CACHE['by_ip'], NEIGH_CACHE['by_mac']
+        source = 'netlink'
+        try:
+            by_ip = _read_neigh_netlink()
+        except Exception as e:
+            logger.debug(f"netlink neighbour dump unavailable ({e}); falling back to {NEIGH_PROC_PATH}")
+            source = 'proc'
+            try:
+                by_ip = _read_neigh_proc()
+            except Exception as e2:
+                logger.debug(f"Cannot read {NEIGH_PROC_PATH}: {e2}")
+                by_ip, source = {}, None
+        by_mac = {}
+        for ip, entry in by_ip.items():
+            if entry.get('mac'):
+                # keep the freshest entry when a MAC has several addresses (IPv4 + IPv6)
+                prev = by_mac.get(entry['mac'])
+                if not prev or (prev['state'] not in NEIGH_FRESH_STATES and entry['state'] in NEIGH_FRESH_STATES):
+                    by_mac[entry['mac']] = {'ip': ip, 'state': entry['state']}
+        NEIGH_CACHE.update(ts=now, by_ip=by_ip, by_mac=by_mac, source=source)
+        return by_ip, by_mac
+
+def neighbour_state(ip=None, mac=None):
+    """Return the kernel NUD state for a host (by IP, else by MAC) or None if unknown.
+    When both are given, an entry whose MAC differs from `mac` is ignored.
+    """
+    if not NEIGH_PROBE_ENABLED:
+        return None
+    by_ip, by_mac = read_neighbour_table()
+    mac = normalize_mac(mac)
+    entry = by_ip.get(ip) if ip else None
+    if entry and (not mac or entry.get('mac') == mac):
+        return entry['state']
+    if mac and mac in by_mac:
+        return by_mac[mac]['state']
+    return None
+
+def neighbour_present(mac):
+    """True if the MAC currently has a resolved link-layer entry — typically long
+    before the OS answers ICMP or HTTP during a boot."""
+    return neighbour_state(mac=mac) in NEIGH_PRESENT_STATES
+
+def ping_host(host, timeout=1, mac=None, use_neigh=True):
+    # Tier 0: a fresh REACHABLE neighbour entry answers without forking ping
+    if use_neigh and NEIGH_PROBE_ENABLED and neighbour_state(ip=host, mac=mac) in NEIGH_FRESH_STATES:
+        logger.debug(f"Neighbour table REACHABLE for {host} — skipping ICMP")
+        return True
     param = "-n" if platform.system().lower() == "windows" else "-c"
     # macOS and Linux differ on timeout flags; keep a minimal portable ping invocation
     command = ["ping", param, "1", host]
@@ -239,6 +740,12 @@ def ping_host(host, timeout=1):
     except FileNotFoundError:
         return False
 
+def machine_mac_for_ip(ip):
+    for machine in MACHINES.values():
+        if machine.get("ip") == ip:
+            return machine.get("mac")
+    return None
+
 def is_service_up(host, port, timeout=1):
     """Vérifie qu'un service TCP est joignable sur (host, port).
     Retourne True si une connexion TCP a réussi, False sinon.
@@ -250,20 +757,97 @@ def is_service_up(host, port, timeout=1):
         logger.debug(f"Service check failed for {host}:{port} - {e}")
         return False
 
-def http_service_up(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT)):
-    """Check a service by performing a lightweight HTTP request (HEAD then GET fallback).
-    Returns True if a 2xx-3xx response is returned, False otherwise.
+def scan_tcp_ports(targets, timeout=1.0):
+    """Non-blocking connect to every (host, port) at once, with one shared deadline.
+    Returns {(host, port): {'open': bool, 'latency_ms': float|None, 'error': str|None}}.
+    Ten ports cost the time of the slowest one, not the sum.
+    """
+    results = {}
+    sel = selectors.DefaultSelector()
+    start = time.monotonic()
+    deadline = start + timeout
+    try:
+        for host, port in targets:
+            key = (host, port)
+            if key in results:
+                continue
+            try:
+                family, socktype, proto, _, addr = socket.getaddrinfo(host, int(port), type=socket.SOCK_STREAM)[0]
+                sock = socket.socket(family, socktype, proto)
+            except (OSError, TypeError, ValueError) as e:
+                results[key] = {'open': False, 'latency_ms': None, 'error': str(e)}
+                continue
+            sock.setblocking(False)
+            t0 = time.monotonic()
+            err = sock.connect_ex(addr)
+            if err == 0:
+                results[key] = {'open': True, 'latency_ms': round((time.monotonic() - t0) * 1000, 2), 'error': None}
+                sock.close()
+            elif err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                sel.register(sock, selectors.EVENT_WRITE, (key, t0))
+            else:
+                results[key] = {'open': False, 'latency_ms': None, 'error': os.strerror(err)}
+                sock.close()
+
+        while sel.get_map():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            for sk, _events in sel.select(remaining):
+                sock = sk.fileobj
+                key, t0 = sk.data
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                latency = round((time.monotonic() - t0) * 1000, 2)
+                results[key] = {'open': err == 0, 'latency_ms': latency if err == 0 else None,
+                                'error': None if err == 0 else os.strerror(err)}
+                sel.unregister(sock)
+                sock.close()
+    finally:
+        for sk in list(sel.get_map().values()):
+            results[sk.data[0]] = {'open': False, 'latency_ms': None, 'error': 'timeout'}
+            sk.fileobj.close()
+        sel.close()
+    return results
+
+DEFAULT_HTTP_PROBE = {'path': None, 'method': 'GET', 'status': ((200, 399),), 'header': None,
+                      'body_prefix': None, 'max_bytes': 512, 'redirects': 0}
+
+def _probe_matches(resp, spec):
+    if not any(lo <= resp.status_code <= hi for lo, hi in spec['status']):
+        return False
+    if spec.get('header'):
+        name, _, expected = spec['header'].partition(':')
+        value = resp.headers.get(name.strip())
+        if value is None or expected.strip() not in value:
+            return False
+    if spec.get('body_prefix'):
+        # read only the first bytes of the body, then drop the connection
+        head = resp.raw.read(max(spec['max_bytes'], len(spec['body_prefix'].encode())), decode_content=True) or b''
+        if not head.decode('utf-8', 'replace').lstrip().startswith(spec['body_prefix']):
+            return False
+    return True
+
+def http_service_up(url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), spec=None):
+    """Check a service with a single lightweight HTTP exchange described by `spec`
+    (see load_http_probe_spec). The response is streamed and closed as soon as the
+    status/headers (and optional body prefix) are known: bodies are never downloaded.
+    Returns True if the probe matches, False otherwise.
     """
     if not url:
         return False
+    spec = {**DEFAULT_HTTP_PROBE, **(spec or {})}
+    if spec.get('path'):
+        url = urljoin(url, spec['path'])
     try:
-        # Prefer HEAD (lighter). Some servers block HEAD so fallback to GET.
-        resp = _http_session.head(url, timeout=timeout, allow_redirects=True)
-        if resp.status_code and resp.status_code < 400:
-            return True
-        # try GET as some servers don't support HEAD
-        resp = _http_session.get(url, timeout=timeout, allow_redirects=True)
-        return bool(resp.status_code and resp.status_code < 400)
+        for _hop in range(spec['redirects'] + 1):
+            with _http_session.request(spec['method'], url, timeout=timeout, allow_redirects=False,
+                                       stream=True, headers={'Accept-Encoding': 'identity'}) as resp:
+                location = resp.headers.get('Location')
+                if resp.is_redirect and location and _hop < spec['redirects']:
+                    url = urljoin(url, location)
+                    continue
+                return _probe_matches(resp, spec)
+        return False
     except RequestException as e:
         logger.debug(f"HTTP check failed for {url}: {e}")
         return False
@@ -280,18 +864,242 @@ def parse_host_port_from_url(url):
             port = 80
     return host, port
 
-# Simple in-memory cache for ping results to debounce frequent client polls
-PING_CACHE = {}
+# Freebox session reuse: one login per router serves every call to that router (in every worker,
+# through the state store) until the box rejects the token
+try:
+    FREEBOX_SESSION_TTL = float(os.environ.get('FREEBOX_SESSION_TTL', '1800'))
+except Exception:
+    FREEBOX_SESSION_TTL = 1800.0
+
+def get_session_token(config, force=False):
+    """Return the router's cached Freebox session token, logging in only when needed. (token, err)"""
+    router = get_router(config)
+    key = f"freebox:session:{router['name']}"
+    with router['login_lock']:
+        session = None if force else state_get(key)
+        if session:
+            return session['token'], None
+        token, err = login_freebox(config)
+        if token:
+            state_set(key, {'token': token, 'ts': time.time()}, ttl=FREEBOX_SESSION_TTL)
+        else:
+            state_delete(key)
+        return token, err
+
+def freebox_get(config, path):
+    """Authenticated GET on the Freebox API with the cached session; re-login once on auth errors.
+    Returns (result, err).
+    """
+    base_url = get_freebox_base(config)
+    url = f"{base_url}{path}"
+    for attempt in (0, 1):
+        session_token, err = get_session_token(config, force=bool(attempt))
+        if err:
+            return None, err
+        with timing_span('fbx-get'):
+            resp, err = router_request(get_router(config), 'GET', url, f"on {path}",
+                                       headers={"X-Fbx-App-Auth": session_token})
+        if err:
+            return None, err
+        data, err = safe_json(resp)
+        if err:
+            return None, err
+        if data.get("success"):
+            return data.get("result"), None
+        if data.get("error_code") in ("auth_required", "invalid_session") and attempt == 0:
+            logger.info("Freebox session expired — logging in again")
+            continue
+        return None, f"Freebox returned error for {path}: {data}"
+    return None, f"Freebox authentication failed for {path}"
+
+def _is_auth_error(err):
+    return bool(err) and ('auth_required' in err or 'invalid_session' in err)
+
+def wake_machine(mac, config=None):
+    """Send a WOL packet through the machine's Freebox with the cached session (re-login once if
+    it expired). Returns (success, err).
+    """
+    config = config or load_config(router_for(mac=mac))
+    if not config:
+        return False, "Configuration not found"
+    err = None
+    for attempt in (0, 1):
+        session_token, err = get_session_token(config, force=bool(attempt))
+        if err:
+            return False, err
+        success, err = send_wol(session_token, mac, config)
+        if success:
+            return True, None
+        if not _is_auth_error(err):
+            break
+    return False, err
+
+# Fleet-wide reachability from the Freebox LAN browser: one call per TTL window for all hosts
+LAN_BROWSER_ENABLED = os.environ.get('LAN_BROWSER', '1') in ('1', 'true', 'True')
+try:
+    LAN_BROWSER_TTL = float(os.environ.get('LAN_BROWSER_TTL', '5'))
+except Exception:
+    LAN_BROWSER_TTL = 5.0
+
+def fetch_lan_hosts(config):
+    """Fetch every LAN host known to the Freebox and index it by MAC. Returns (by_mac, err)."""
+    result, err = freebox_get(config, "/api/v8/lan/browser/pub/")
+    if err:
+        return None, err
+    by_mac = {}
+    for host in result or []:
+        l2 = host.get("l2ident") or {}
+        mac = normalize_mac(l2.get("id")) if l2.get("type", "mac_address") == "mac_address" else None
+        if not mac:
+            continue
+        by_mac[mac] = {
+            "reachable": bool(host.get("reachable")),
+            "active": bool(host.get("active")),
+            "last_activity": host.get("last_activity"),
+            "last_time_reachable": host.get("last_time_reachable"),
+            "name": host.get("primary_name"),
+        }
+    return by_mac, None
+
+def lan_browser_snapshot(router=DEFAULT_ROUTER):
+    """Return (by_mac, age) from the router's shared LAN-browser snapshot, refreshed at most once
+    per TTL by whichever worker takes the refresh lease (the others keep serving the previous
+    snapshot). by_mac is None when the Freebox is not usable (no token, network error...).
+    """
+    if not LAN_BROWSER_ENABLED:
+        return None, None
+    key, lease = f'lan:hosts:{router}', f'lease:lan-refresh:{router}'
+    snap = state_get(key)
+    if snap is None or time.time() - snap['ts'] >= LAN_BROWSER_TTL:
+        with get_router(router)['lan_lock']:
+            snap = state_get(key)
+            owner = state_owner()
+            if (snap is None or time.time() - snap['ts'] >= LAN_BROWSER_TTL) and \
+                    state_acquire_lease(lease, owner, CONNECT_TIMEOUT + READ_TIMEOUT + 1):
+                try:
+                    config = load_config(router)
+                    if config:
+                        by_mac, err = fetch_lan_hosts(config)
+                    else:
+                        by_mac, err = None, "Configuration not found"
+                    if err:
+                        logger.debug(f"LAN browser unavailable: {err}")
+                    # errors are cached for the TTL too, so a down Freebox is not hammered
+                    snap = {'ts': time.time(), 'by_mac': by_mac, 'error': err}
+                    state_set(key, snap, ttl=max(60.0, 10 * LAN_BROWSER_TTL))
+                finally:
+                    state_release_lease(lease, owner)
+    if snap is None:
+        return None, None
+    return snap['by_mac'], time.time() - snap['ts']
+
+def lan_browser_status(mac, router=None):
+    """O(1) lookup of one MAC in its router's LAN-browser snapshot, or None if unknown/unavailable."""
+    mac = normalize_mac(mac)
+    if not mac:
+        return None
+    by_mac, age = lan_browser_snapshot(router or router_for(mac=mac))
+    if not by_mac or mac not in by_mac:
+        return None
+    return {**by_mac[mac], "age": round(age, 2)}
+
+def machine_online(ip, mac=None):
+    """Resolve reachability for a host: Freebox LAN browser first, then neighbour table/ping.
+    Returns (online, source).
+    """
+    status = lan_browser_status(mac)
+    if status is not None:
+        if status["reachable"]:
+            return True, "freebox"
+        # the Freebox refreshes reachability lazily: a fresh local neighbour entry wins
+        if neighbour_state(ip=ip, mac=mac) in NEIGH_FRESH_STATES:
+            return True, "neigh"
+        return False, "freebox"
+    return ping_host(ip, mac=mac), "ping"
+
+# Simple in-memory cache for ping results to debounce frequent client polls.
+# Bounded LRU (PING_CACHE_MAX entries), expired entries dropped on access.
+PING_CACHE = OrderedDict()
 PING_CACHE_LOCK = Lock()
 # seconds: TTL for cached ping results; configurable via env
 try:
     PING_CACHE_TTL = float(os.environ.get('PING_CACHE_TTL', '10'))
 except Exception:
     PING_CACHE_TTL = 10.0
+try:
+    PING_CACHE_MAX = int(os.environ.get('PING_CACHE_MAX', '256'))
+    PING_SWEEP_INTERVAL = float(os.environ.get('PING_SWEEP_INTERVAL', '60'))
+    # entries in the shared state store expire after this (PING_FILE_MAX_AGE: former name)
+    PING_SHARED_MAX_AGE = float(os.environ.get('PING_SHARED_MAX_AGE') or os.environ.get('PING_FILE_MAX_AGE', '300'))
+except Exception:
+    PING_CACHE_MAX = 256
+    PING_SWEEP_INTERVAL = 60.0
+    PING_SHARED_MAX_AGE = 300.0
+# Stale-while-revalidate: each entry expires after PING_CACHE_TTL ± PING_CACHE_JITTER (fraction) so
+# entries written together do not expire together; past expiry the last value is still served
+# (marked stale) while one background refresh runs, until PING_HARD_STALE where callers wait.
+try:
+    PING_CACHE_JITTER = float(os.environ.get('PING_CACHE_JITTER', '0.2'))
+    PING_HARD_STALE = max(float(os.environ.get('PING_HARD_STALE', '60')), PING_CACHE_TTL)
+except Exception:
+    PING_CACHE_JITTER = 0.2
+    PING_HARD_STALE = max(60.0, PING_CACHE_TTL)
+PING_REFRESH_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='ping-refresh')
+PING_REFRESHING = set()
+PING_CACHE_STATS = {'hits': 0, 'stale_hits': 0, 'refreshes': 0, 'misses': 0, 'evicted_lru': 0, 'evicted_ttl': 0,
+                    'shared_purged': 0, 'rejected': 0,
+                    'last_sweep': 0.0}
+
+# Which targets /api/ping accepts: registered machines always; other addresses must be valid IPs
+# and, if PING_ALLOWED_TARGETS is set, either "registered" (nothing else) or a list of CIDRs.
+PING_ALLOWED_TARGETS = os.environ.get('PING_ALLOWED_TARGETS', '').strip()
+PING_ALLOWED_NETWORKS = []
+if PING_ALLOWED_TARGETS and PING_ALLOWED_TARGETS != 'registered':
+    for _cidr in PING_ALLOWED_TARGETS.split(','):
+        try:
+            PING_ALLOWED_NETWORKS.append(ipaddress.ip_network(_cidr.strip(), strict=False))
+        except ValueError:
+            logger.warning(f"Ignoring invalid CIDR in PING_ALLOWED_TARGETS: {_cidr!r}")
+
+def ping_target_allowed(ip):
+    if any(machine.get("ip") == ip for machine in MACHINES.values()):
+        return True
+    try:
+        addr = ipaddress.ip_address(ip)
+    except ValueError:
+        return False
+    if PING_ALLOWED_TARGETS == 'registered':
+        return False
+    if PING_ALLOWED_NETWORKS:
+        return any(addr in net for net in PING_ALLOWED_NETWORKS)
+    return True
 
-# Rate limiting state (simple in-process sliding window per client IP)
-PING_RATE_MAP = {}
-PING_RATE_LOCK = Lock()
+def ping_cache_get(ip, now=None):
+    """Return the cached entry for ip unless older than PING_HARD_STALE (and mark it recently used).
+    Freshness against the entry's own expiry is left to the caller.
+    """
+    now = now or time.time()
+    with PING_CACHE_LOCK:
+        entry = PING_CACHE.get(ip)
+        if entry is None:
+            return None
+        if now - entry.get('ts', 0.0) >= PING_HARD_STALE:
+            del PING_CACHE[ip]
+            PING_CACHE_STATS['evicted_ttl'] += 1
+            return None
+        PING_CACHE.move_to_end(ip)
+        return entry
+
+def ping_cache_put(ip, entry):
+    with PING_CACHE_LOCK:
+        PING_CACHE[ip] = entry
+        PING_CACHE.move_to_end(ip)
+        while len(PING_CACHE) > PING_CACHE_MAX:
+            PING_CACHE.popitem(last=False)
+            PING_CACHE_STATS['evicted_lru'] += 1
+
+# Rate limiting: approximate sliding window per client IP, from two fixed-window counters in the
+# shared state store (so the limit holds across gunicorn workers)
 try:
     PING_RATE_LIMIT = int(os.environ.get('PING_RATE_LIMIT', '4'))  # max requests
     PING_RATE_WINDOW = float(os.environ.get('PING_RATE_WINDOW', '10'))  # seconds window
@@ -299,50 +1107,904 @@ except Exception:
     PING_RATE_LIMIT = 4
     PING_RATE_WINDOW = 10.0
 
-# Simple file-based cache directory to share ping results across gunicorn workers
-PING_CACHE_DIR = os.environ.get('PING_CACHE_DIR', '/run/wakeonlan/ping_cache')
+# Cross-worker state (ping results, rate-limit counters, wake dispatches, leases, Freebox session,
+# LAN browser snapshot) goes through a wol_state store: SQLite in WAL mode under STATE_DIR by
+# default, memory:// for a single process, redis://... to share it between hosts.
+STATE_DIR = os.environ.get('STATE_DIR', '/run/wakeonlan')
 try:
-    os.makedirs(PING_CACHE_DIR, exist_ok=True)
+    os.makedirs(STATE_DIR, exist_ok=True)
 except Exception:
     # fallback to /tmp if /run not writable
-    PING_CACHE_DIR = '/tmp/wakeonlan_ping_cache'
+    STATE_DIR = '/tmp/wakeonlan'
     try:
-        os.makedirs(PING_CACHE_DIR, exist_ok=True)
+        os.makedirs(STATE_DIR, exist_ok=True)
     except Exception:
-        PING_CACHE_DIR = None
+        STATE_DIR = None
+STATE_URL = os.environ.get('STATE_URL') or (
+    f"sqlite:///{os.path.join(STATE_DIR, 'state.db')}" if STATE_DIR else 'memory://')
+try:
+    STATE = open_store(STATE_URL)
+except Exception as e:
+    logger.warning(f"State store {STATE_URL} unavailable ({e}); falling back to per-process memory")
+    STATE = MemoryStore()
+# Request and supervisor paths must survive a store error (SQLite "database is locked" after its
+# busy timeout, Redis down): they go through these wrappers, which keep a per-process copy of what
+# could not be shared and fail open on leases, like check_rate_limit.
+STATE_FALLBACK = MemoryStore()
+
+def state_get(key):
+    try:
+        value = STATE.get(key)
+    except Exception as e:
+        logger.warning(f"State store read of {key} failed ({e}); using this worker's copy")
+        return STATE_FALLBACK.get(key)
+    return STATE_FALLBACK.get(key) if value is None else value
+
+def state_set(key, value, ttl=None):
+    try:
+        STATE.set(key, value, ttl=ttl)
+    except Exception as e:
+        logger.warning(f"State store write of {key} failed ({e}); kept in this worker only")
+        STATE_FALLBACK.set(key, value, ttl=ttl)
+
+def state_delete(key):
+    STATE_FALLBACK.delete(key)
+    try:
+        STATE.delete(key)
+    except Exception as e:
+        logger.warning(f"State store delete of {key} failed: {e}")
+
+def state_acquire_lease(key, owner, ttl, default=True):
+    """Like STATE.acquire_lease, but `default` when the store fails: True lets the caller proceed
+    unshared, False (leader election) keeps it out until the store answers again."""
+    try:
+        return STATE.acquire_lease(key, owner, ttl)
+    except Exception as e:
+        logger.warning(f"State store lease {key} failed ({e}); {'proceeding without it' if default else 'not taken'}")
+        return default
+
+def state_release_lease(key, owner):
+    try:
+        STATE.release_lease(key, owner)
+    except Exception as e:
+        logger.warning(f"State store release of {key} failed: {e}")
+
+def state_lease_owner(key):
+    try:
+        return STATE.lease_owner(key)
+    except Exception as e:
+        logger.warning(f"State store lease lookup of {key} failed: {e}")
+        return None
 
-import tempfile
+def state_owner():
+    """Lease owner id for this worker (computed per call: gunicorn may fork after import)."""
+    return f"{socket.gethostname()}:{os.getpid()}"
 
-def _safe_ip_filename(ip):
-    # replace chars not safe for filenames
-    return ip.replace(':', '_').replace('/', '_').replace('.', '_')
+def serving_process():
+    """True in a process that serves the app (gunicorn worker, `flask run`, `python wol_app.py`),
+    False for other importers (`flask discover`, tools) that must not start background jobs."""
+    if 'gunicorn.arbiter' in sys.modules or __name__ == '__main__':
+        return True
+    prog = os.path.basename(sys.argv[0]) if sys.argv else ''
+    return prog in ('flask', '__main__.py') and 'run' in sys.argv[1:]
 
-def read_ping_cache_file(ip):
-    if not PING_CACHE_DIR:
+def read_shared_ping(ip):
+    try:
+        return STATE.get(f'ping:{ip}')
+    except Exception as e:
+        logger.debug(f"State store read failed for {ip}: {e}")
         return None
-    fn = os.path.join(PING_CACHE_DIR, _safe_ip_filename(ip) + '.json')
+
+def write_shared_ping(ip, online, ts, exp=None, source=None):
     try:
-        with open(fn, 'r') as f:
-            data = json.load(f)
-        return data
+        STATE.set(f'ping:{ip}', {'ts': ts, 'exp': exp or ts + PING_CACHE_TTL, 'online': bool(online), 'source': source},
+                  ttl=PING_SHARED_MAX_AGE)
+    except Exception as e:
+        logger.debug(f"State store write failed for {ip}: {e}")
+
+def sweep_ping_cache(now=None, force=False):
+    """Periodic garbage collection (at most every PING_SWEEP_INTERVAL, from any request):
+    drops expired memory entries and purges expired entries from the state store.
+    """
+    now = now or time.time()
+    with PING_CACHE_LOCK:
+        if not force and now - PING_CACHE_STATS['last_sweep'] < PING_SWEEP_INTERVAL:
+            return
+        PING_CACHE_STATS['last_sweep'] = now
+        for key in [k for k, v in PING_CACHE.items() if now - v.get('ts', 0.0) >= PING_HARD_STALE]:
+            del PING_CACHE[key]
+            PING_CACHE_STATS['evicted_ttl'] += 1
+    try:
+        purged = STATE.purge_expired()
+    except Exception as e:
+        logger.debug(f"State store purge failed: {e}")
+        purged = 0
+    with PING_CACHE_LOCK:
+        PING_CACHE_STATS['shared_purged'] += purged
+    if purged:
+        logger.debug(f"Ping cache sweep: {purged} expired state entr(y/ies) removed")
+
+# Admission control for expensive work (probes, readiness checks, Freebox calls) done in request
+# threads: at most ADMISSION_MAX_ACTIVE run at once, ADMISSION_MAX_QUEUE wait (up to
+# ADMISSION_QUEUE_TIMEOUT s), everything else is shed with 503 + Retry-After. Keep
+# ADMISSION_MAX_ACTIVE + ADMISSION_MAX_QUEUE below gunicorn --threads so /health and static
+# files always find a free thread.
+try:
+    ADMISSION_MAX_ACTIVE = int(os.environ.get('ADMISSION_MAX_ACTIVE', '2'))
+    ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '1'))
+    ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', '1'))
+    ADMISSION_RETRY_AFTER = int(os.environ.get('ADMISSION_RETRY_AFTER', '2'))
+except Exception:
+    ADMISSION_MAX_ACTIVE = 2
+    ADMISSION_MAX_QUEUE = 1
+    ADMISSION_QUEUE_TIMEOUT = 1.0
+    ADMISSION_RETRY_AFTER = 2
+ADMISSION_STATS = {'active': 0, 'waiting': 0, 'admitted': 0, 'shed': 0, 'shed_stale': 0, 'max_waiting': 0}
+ADMISSION_COND = Condition()
+
+class Overloaded(Exception):
+    """Raised when expensive work is shed by admission control."""
+    def __init__(self, kind):
+        super().__init__(f"overloaded: {kind} shed")
+        self.kind = kind
+
+@contextmanager
+def admission(kind):
+    """Run the enclosed expensive operation under the per-worker concurrency limit."""
+    with ADMISSION_COND:
+        if ADMISSION_STATS['active'] >= ADMISSION_MAX_ACTIVE:
+            if ADMISSION_STATS['waiting'] >= ADMISSION_MAX_QUEUE:
+                ADMISSION_STATS['shed'] += 1
+                raise Overloaded(kind)
+            ADMISSION_STATS['waiting'] += 1
+            ADMISSION_STATS['max_waiting'] = max(ADMISSION_STATS['max_waiting'], ADMISSION_STATS['waiting'])
+            try:
+                ok = ADMISSION_COND.wait_for(lambda: ADMISSION_STATS['active'] < ADMISSION_MAX_ACTIVE,
+                                             timeout=ADMISSION_QUEUE_TIMEOUT)
+            finally:
+                ADMISSION_STATS['waiting'] -= 1
+            if not ok:
+                ADMISSION_STATS['shed'] += 1
+                raise Overloaded(kind)
+        ADMISSION_STATS['active'] += 1
+        ADMISSION_STATS['admitted'] += 1
+    try:
+        yield
+    finally:
+        with ADMISSION_COND:
+            ADMISSION_STATS['active'] -= 1
+            ADMISSION_COND.notify()
+
+@app.errorhandler(Overloaded)
+def handle_overloaded(e):
+    logger.warning(f"Load shedding: {e.kind} rejected (active={ADMISSION_STATS['active']}, waiting={ADMISSION_STATS['waiting']})")
+    if request.path.startswith('/api/'):
+        resp = jsonify({"error": "overloaded", "retry_after": ADMISSION_RETRY_AFTER})
+    else:
+        resp = app.make_response((render_template('error.html',
+                                                  title="Serveur occupé",
+                                                  message="Trop de vérifications en cours, réessayez dans quelques secondes."), 503))
+    resp.status_code = 503
+    resp.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER)
+    return resp
+
+def _jittered_ttl():
+    return PING_CACHE_TTL * random.uniform(1 - PING_CACHE_JITTER, 1 + PING_CACHE_JITTER)
+
+def probe_host_status(ip):
+    """Run the real reachability check for ip and store it in both cache layers."""
+    now = time.time()
+    # registered machines are answered from the Freebox LAN browser snapshot; others are pinged
+    with timing_span('probe'):
+        online, source = machine_online(ip, mac=machine_mac_for_ip(ip))
+    track_boot_progress(ip, online)
+    entry = {'ts': now, 'exp': now + _jittered_ttl(), 'online': online, 'source': source}
+    ping_cache_put(ip, entry)
+    # also share it with the other workers
+    write_shared_ping(ip, online, now, exp=entry['exp'], source=source)
+    return entry
+
+def _background_refresh(ip):
+    try:
+        probe_host_status(ip)
     except Exception:
+        logger.exception(f"Background status refresh failed for {ip}")
+    finally:
+        with PING_CACHE_LOCK:
+            PING_REFRESHING.discard(ip)
+
+def schedule_refresh(ip):
+    """Start one asynchronous refresh per ip (per worker); returns False if one is already running."""
+    with PING_CACHE_LOCK:
+        if ip in PING_REFRESHING:
+            return False
+        PING_REFRESHING.add(ip)
+        PING_CACHE_STATS['refreshes'] += 1
+    PING_REFRESH_EXECUTOR.submit(_background_refresh, ip)
+    return True
+
+def get_host_status(ip, now=None, probe=True, gate=True):
+    """Cached reachability for ip. Returns a dict with online, source, age, ts, exp, cached, stale and
+    cache (HIT_SHARED/HIT_MEM, STALE_SHARED/STALE_MEM, SHED_SHARED or MISS). Only a missing or hard-stale
+    entry makes the caller wait for a probe; with probe=False such an entry returns None instead.
+    With gate=True the probe goes through admission control; when shed, the last shared value
+    (whatever its age) is served, otherwise Overloaded propagates.
+    """
+    now = now or time.time()
+    best, layer = None, None
+    # Try the shared state first (written by every worker), keep whichever layer is newer
+    shared = read_shared_ping(ip)
+    if shared and now - shared.get('ts', 0.0) < PING_HARD_STALE:
+        best, layer = shared, 'SHARED'
+    mem_cached = ping_cache_get(ip, now)
+    if mem_cached and (best is None or mem_cached.get('ts', 0.0) >= best.get('ts', 0.0)):
+        best, layer = mem_cached, 'MEM'
+
+    if best is not None:
+        ts = best.get('ts', 0.0)
+        status = {'online': bool(best.get('online')), 'source': best.get('source'),
+                  'age': round(now - ts, 2), 'ts': ts, 'exp': best.get('exp', ts + PING_CACHE_TTL), 'cached': True}
+        if now < status['exp']:
+            with PING_CACHE_LOCK:
+                PING_CACHE_STATS['hits'] += 1
+            return {**status, 'stale': False, 'cache': f'HIT_{layer}'}
+        schedule_refresh(ip)
+        with PING_CACHE_LOCK:
+            PING_CACHE_STATS['stale_hits'] += 1
+        return {**status, 'stale': True, 'cache': f'STALE_{layer}'}
+
+    if not probe:
         return None
+    try:
+        if gate:
+            with admission('probe'):
+                entry = probe_host_status(ip)
+        else:
+            entry = probe_host_status(ip)
+    except Overloaded:
+        last = read_shared_ping(ip)
+        if not last:
+            raise
+        with ADMISSION_COND:
+            ADMISSION_STATS['shed_stale'] += 1
+        ts = last.get('ts', 0.0)
+        return {'online': bool(last.get('online')), 'source': last.get('source'), 'age': round(now - ts, 2),
+                'ts': ts, 'exp': last.get('exp', ts + PING_CACHE_TTL), 'cached': True, 'stale': True, 'cache': 'SHED_SHARED'}
+    with PING_CACHE_LOCK:
+        PING_CACHE_STATS['misses'] += 1
+    sweep_ping_cache(now)
+    return {'online': entry['online'], 'source': entry['source'], 'age': 0.0, 'ts': entry['ts'],
+            'exp': entry['exp'], 'cached': False, 'stale': False, 'cache': 'MISS'}
+
+def set_status_cache_headers(resp, statuses):
+    """HTTP caching derived from the cache entries behind a status response: Cache-Control max-age
+    is the shortest entry lifetime and Age the age of the oldest entry, so browsers reuse the
+    answer exactly as long as the app would; X-Accel-Expires gives nginx the remaining seconds
+    (at least 1, so a stale answer being refreshed still absorbs a polling burst).
+    """
+    statuses = [st for st in statuses if st]
+    if not statuses:
+        resp.headers['Cache-Control'] = 'no-store'
+        return resp
+    now = time.time()
+    remaining = min(st['exp'] - now for st in statuses)
+    age = max(0, int(now - min(st['ts'] for st in statuses)))
+    if remaining <= 0:
+        resp.headers['Cache-Control'] = 'no-cache'
+    else:
+        resp.headers['Cache-Control'] = f'max-age={age + int(remaining)}'
+        resp.headers['Age'] = str(age)
+    resp.headers['X-Accel-Expires'] = str(max(1, int(remaining)))
+    return resp
+
+# Last serialised body per endpoint, keyed by its ETag: {name: (etag, bytes)}
+RESPONSE_BODIES = {}
+RESPONSE_BODIES_LOCK = Lock()
+
+def make_etag(*parts):
+    return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()[:24]
+
+def conditional_json(name, etag, build):
+    """JSON response under a strong ETag. A matching If-None-Match gets a 304 without calling
+    build(); otherwise the body is serialised once per ETag and reused while the state is unchanged.
+    """
+    if request.if_none_match.contains(etag):
+        resp = app.response_class(status=304)
+    else:
+        with RESPONSE_BODIES_LOCK:
+            cached = RESPONSE_BODIES.get(name)
+        if cached and cached[0] == etag:
+            body = cached[1]
+        else:
+            body = jsonify(build()).get_data()
+            with RESPONSE_BODIES_LOCK:
+                RESPONSE_BODIES[name] = (etag, body)
+        resp = app.response_class(body, mimetype='application/json')
+    resp.set_etag(etag)
+    return resp
+
+try:
+    STATUS_BATCH_MAX = int(os.environ.get('STATUS_BATCH_MAX', '64'))
+except Exception:
+    STATUS_BATCH_MAX = 64
+PROBE_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='probe')
+
+def get_many_host_status(ips):
+    """Status for several hosts: cache answers first, then every miss probed in one concurrent round."""
+    results = {}
+    misses = []
+    for ip in ips:
+        status = get_host_status(ip, probe=False)
+        if status is None:
+            misses.append(ip)
+        else:
+            results[ip] = status
+    if misses:
+        # the whole round is admitted once; pool threads do not take request slots
+        with admission('probe-batch'):
+            probed = list(PROBE_EXECUTOR.map(lambda ip: get_host_status(ip, gate=False), misses))
+        for ip, status in zip(misses, probed):
+            results[ip] = status
+    return results
+
+# Boot-time history: append-only JSON lines {"m": machine_id, "e": "w"|"p"|"s"|"u"|"n", "t": ts}
+# (w = wake sent, p = ping up, s = service up, u = warm-up finished, with "d": its duration,
+# n = host confirmed up by the wake supervisor, with "n": the WOL packets it needed).
+# Shared by all workers through O_APPEND writes.
+BOOT_HISTORY_PATH = os.environ.get('BOOT_HISTORY_PATH', os.path.join(BASE_DIR, 'boot_history.jsonl'))
+try:
+    BOOT_HISTORY_SAMPLES = int(os.environ.get('BOOT_HISTORY_SAMPLES', '20'))
+    BOOT_HISTORY_MAX_BYTES = int(os.environ.get('BOOT_HISTORY_MAX_BYTES', '262144'))
+except Exception:
+    BOOT_HISTORY_SAMPLES = 20
+    BOOT_HISTORY_MAX_BYTES = 262144
+BOOT_EVENTS = {'wake': 'w', 'ping': 'p', 'service': 's', 'warmup': 'u', 'packets': 'n'}
+BOOT_HISTORY_CACHE = {'stat': None, 'sessions': {}}
+BOOT_HISTORY_LOCK = Lock()
+
+def find_machine(ip=None, mac=None):
+    """Return (machine_id, machine) for a registered IP or MAC, else (None, None)."""
+    mac = normalize_mac(mac)
+    for machine_id, machine in MACHINES.items():
+        if (ip and machine.get("ip") == ip) or (mac and normalize_mac(machine.get("mac")) == mac):
+            return machine_id, machine
+    return None, None
 
-def write_ping_cache_file(ip, online, ts):
-    if not PING_CACHE_DIR:
+def _append_boot_event(machine_id, event, ts, duration=None, count=None):
+    if not BOOT_HISTORY_PATH:
         return
-    fn = os.path.join(PING_CACHE_DIR, _safe_ip_filename(ip) + '.json')
-    tmpfd, tmpname = tempfile.mkstemp(dir=PING_CACHE_DIR)
+    ev = {'m': machine_id, 'e': BOOT_EVENTS[event], 't': round(ts, 2)}
+    if duration is not None:
+        ev['d'] = round(duration, 2)
+    if count is not None:
+        ev['n'] = count
+    line = json.dumps(ev, separators=(',', ':'))
     try:
-        with os.fdopen(tmpfd, 'w') as tf:
-            json.dump({'ts': ts, 'online': bool(online)}, tf)
-        os.replace(tmpname, fn)
+        if os.path.exists(BOOT_HISTORY_PATH) and os.path.getsize(BOOT_HISTORY_PATH) > BOOT_HISTORY_MAX_BYTES:
+            # rotation: the previous generation stays readable as <path>.1
+            os.replace(BOOT_HISTORY_PATH, BOOT_HISTORY_PATH + '.1')
+        with open(BOOT_HISTORY_PATH, 'a') as f:
+            f.write(line + '\n')
+    except Exception as e:
+        logger.debug(f"Cannot append boot event to {BOOT_HISTORY_PATH}: {e}")
+
+def _boot_history_stat():
+    stats = []
+    for path in (BOOT_HISTORY_PATH + '.1', BOOT_HISTORY_PATH):
+        try:
+            st = os.stat(path)
+            stats.append((path, st.st_size, st.st_mtime))
+        except OSError:
+            pass
+    return tuple(stats)
+
+def load_boot_sessions():
+    """Parse the history into
+    {machine_id: [{'wake': ts, 'ping': dur, 'service': dur, 'warmup': dur, 'packets': n}, ...]}.
+    Re-parsed only when the files change.
+    """
+    if not BOOT_HISTORY_PATH:
+        return {}
+    stat = _boot_history_stat()
+    with BOOT_HISTORY_LOCK:
+        if stat == BOOT_HISTORY_CACHE['stat']:
+            return BOOT_HISTORY_CACHE['sessions']
+        sessions = {}
+        for path, _size, _mtime in stat:
+            try:
+                with open(path, 'r') as f:
+                    lines = f.readlines()
+            except OSError:
+                continue
+            for line in lines:
+                try:
+                    ev = json.loads(line)
+                    machine_id, kind, ts = ev['m'], ev['e'], float(ev['t'])
+                except Exception:
+                    continue
+                runs = sessions.setdefault(machine_id, [])
+                if kind == 'w':
+                    runs.append({'wake': ts, 'ping': None, 'service': None, 'warmup': None, 'packets': None})
+                elif kind == 'n':
+                    if runs and runs[-1]['packets'] is None:
+                        runs[-1]['packets'] = ev.get('n')
+                elif kind == 'u':
+                    # warm-up duration, attached to the boot it followed (if any)
+                    if runs and runs[-1]['warmup'] is None and runs[-1]['service'] is not None:
+                        runs[-1]['warmup'] = ev.get('d')
+                elif runs:
+                    key = 'ping' if kind == 'p' else 'service'
+                    if runs[-1][key] is None and ts >= runs[-1]['wake']:
+                        runs[-1][key] = round(ts - runs[-1]['wake'], 2)
+        BOOT_HISTORY_CACHE.update(stat=stat, sessions=sessions)
+        return sessions
+
+def pending_boot(machine_id, now=None):
+    """Return the open boot session for a machine (wake sent less than MAX_WAIT_TIME ago), or None."""
+    now = now or time.time()
+    runs = load_boot_sessions().get(machine_id) or []
+    if runs and now - runs[-1]['wake'] < MAX_WAIT_TIME and runs[-1]['service'] is None:
+        return runs[-1]
+    return None
+
+def record_boot_event(machine_id, event, ts=None, count=None):
+    """Record a boot milestone. A wake inside an open session is ignored so retries do not
+    shorten the measured boot; ping/service are recorded once per session. 'packets' (with
+    count) is attached to the last boot, even once its service is up.
+    """
+    if not machine_id:
+        return
+    ts = ts or time.time()
+    if event == 'packets':
+        _append_boot_event(machine_id, event, ts, count=count)
+        return
+    open_run = pending_boot(machine_id, ts)
+    if event == 'wake':
+        if open_run is None:
+            _append_boot_event(machine_id, event, ts)
+    elif open_run is not None and open_run[event] is None:
+        _append_boot_event(machine_id, event, ts)
+
+def _percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return None
+    k = max(0, min(len(values) - 1, int(round(pct / 100.0 * len(values) + 0.5)) - 1))
+    return values[k]
+
+def boot_eta(machine_id):
+    """Rolling percentiles over the last BOOT_HISTORY_SAMPLES boots: ping/service in seconds
+    after the wake, warmup as its own duration, packets as WOL packets sent until the host was up.
+    """
+    runs = (load_boot_sessions().get(machine_id) or [])[-BOOT_HISTORY_SAMPLES:]
+    eta = {'samples': 0}
+    for key in ('ping', 'service', 'warmup', 'packets'):
+        values = [r[key] for r in runs if r[key] is not None]
+        eta['samples'] = max(eta['samples'], len(values))
+        for pct in (10, 50, 90):
+            eta[f'{key}_p{pct}'] = _percentile(values, pct)
+    return eta
+
+def track_boot_progress(ip, online):
+    """Called after a real probe of `ip`: records ping-up, then service-up, for an open boot."""
+    machine_id, _machine = find_machine(ip=ip)
+    if not machine_id or not online:
+        return
+    run = pending_boot(machine_id)
+    if run is None:
+        return
+    if run['ping'] is None:
+        record_boot_event(machine_id, 'ping')
+    if ip == GAMEARENA_HOST_IP and GAMEARENA_PORT and is_service_up(ip, GAMEARENA_PORT, timeout=1):
+        record_boot_event(machine_id, 'service')
+
+# Background wake dispatch: `/` renders the waiting page at once while a supervisor sends the
+# WOL through the Freebox on WAKE_EXECUTOR, re-sending on WAKE_RESEND_SCHEDULE (seconds after the
+# first packet) until a readiness tier reports the host up. One supervisor per MAC across workers
+# (a lease in the state store, owned by the wake id). Each dispatch gets an id and its outcome is
+# kept in the state store, so /api/wake/<id> answers from any worker.
+try:
+    WAKE_DEDUP_WINDOW = float(os.environ.get('WAKE_DEDUP_WINDOW', '10'))
+    WAKE_RESEND_SCHEDULE = sorted(float(x) for x in os.environ.get('WAKE_RESEND_SCHEDULE', '0,5,15,45').split(',') if x.strip()) or [0.0]
+except Exception:
+    WAKE_DEDUP_WINDOW = 10.0
+    WAKE_RESEND_SCHEDULE = [0.0, 5.0, 15.0, 45.0]
+WAKE_EXECUTOR = ThreadPoolExecutor(max_workers=2, thread_name_prefix='wake')
+# set on SIGTERM: supervisors stop waiting, so the executor (joined at exit) does not hold the
+# worker past gunicorn's graceful timeout
+WAKE_SHUTDOWN = Event()
+# a supervisor never runs longer than this; statuses stay readable a while after it ends
+WAKE_SUPERVISE_TTL = max(MAX_WAIT_TIME, WAKE_RESEND_SCHEDULE[-1]) + 60
+WAKE_STATUS_TTL = max(PING_SHARED_MAX_AGE, WAKE_SUPERVISE_TTL)
+
+def _wake_lease_key(mac):
+    return f"lease:wake:{normalize_mac(mac) or mac}"
+
+def _update_wake_status(wake_id, **changes):
+    status = state_get(f'wake:{wake_id}') or {}
+    status.update(changes)
+    state_set(f'wake:{wake_id}', status, ttl=WAKE_STATUS_TTL)
+    return status
+
+def _wait_host_up(ip, until):
+    """Poll the readiness tiers (LAN browser, neighbour table, ping) until `until`; True once up.
+    Without an IP there is nothing to probe, but the wait still runs so resends keep their spacing.
+    """
+    while not WAKE_SHUTDOWN.is_set():
+        if ip and probe_host_status(ip)['online']:
+            return True
+        remaining = until - time.time()
+        if remaining <= 0:
+            return False
+        WAKE_SHUTDOWN.wait(min(1.0, remaining))
+    return False
+
+def supervise_wake(wake_id, mac):
+    """Send the WOL, then re-send on WAKE_RESEND_SCHEDULE until the host is up (or MAX_WAIT_TIME).
+    Another worker already supervising this MAC makes this dispatch an alias of its own.
+    """
+    machine_id, machine = find_machine(mac=mac)
+    ip = (machine or {}).get("ip")
+    lease = _wake_lease_key(mac)
+    if not state_acquire_lease(lease, wake_id, WAKE_SUPERVISE_TTL):
+        active = state_get(lease)
+        _update_wake_status(wake_id, state='joined' if active else 'failed', alias=active,
+                            details=None if active else 'Wake already supervised by another worker', done=time.time())
+        return
+    try:
+        start = time.time()
+        packets = attempts = 0
+        up = False
+        for offset in WAKE_RESEND_SCHEDULE:
+            if attempts and _wait_host_up(ip, start + offset):
+                up = True
+                break
+            if WAKE_SHUTDOWN.is_set():
+                break
+            attempts += 1
+            success, err = wake_machine(mac)
+            if success:
+                packets += 1
+                if packets == 1:
+                    record_boot_event(machine_id, 'wake')
+                logger.info(f"WOL packet {packets} sent to {mac} (t+{time.time() - start:.1f}s)")
+            else:
+                logger.warning(f"WOL attempt {attempts} for {mac} failed: {err}")
+            _update_wake_status(wake_id, state='sent' if packets else 'pending', packets=packets,
+                                attempts=attempts, details=None if success else err)
+        if packets and not up and ip:
+            up = _wait_host_up(ip, start + MAX_WAIT_TIME)
+        if packets and up:
+            record_boot_event(machine_id, 'packets', count=packets)
+        if not ip or (WAKE_SHUTDOWN.is_set() and not up):
+            # unregistered MAC, or worker stopping: whether the host came up is unknown
+            up = None
+        if packets:
+            state_set(f"wake:last:{normalize_mac(mac) or mac}", wake_id, ttl=WAKE_DEDUP_WINDOW)
+        _update_wake_status(wake_id, state='sent' if packets else 'failed', up=up, done=time.time())
+        logger.info(f"Wake supervisor for {mac}: up={up} after {packets} packet(s) in {time.time() - start:.1f}s")
     except Exception:
+        logger.exception(f"Wake supervisor for {mac} crashed")
+        _update_wake_status(wake_id, state='failed', details='Wake supervisor error', done=time.time())
+    finally:
+        state_release_lease(lease, wake_id)
+
+def dispatch_wake(mac, force=False):
+    """Queue a supervised WOL for `mac` and return its wake id. A dispatch for the same MAC that is
+    still supervised (by any worker), or finished less than WAKE_DEDUP_WINDOW seconds ago after
+    sending a packet, is reused instead. force (scheduler retries) only reuses a running one.
+    """
+    keys = [_wake_lease_key(mac)] if force else [_wake_lease_key(mac), f"wake:last:{normalize_mac(mac) or mac}"]
+    for key in keys:
+        active = state_get(key)
+        if active and state_get(f'wake:{active}'):
+            return active
+    wake_id = secrets.token_hex(8)
+    state_set(f'wake:{wake_id}', {'mac': mac, 'state': 'pending', 'ts': time.time(), 'details': None,
+                                  'packets': 0, 'attempts': 0}, ttl=WAKE_STATUS_TTL)
+    WAKE_EXECUTOR.submit(supervise_wake, wake_id, mac)
+    return wake_id
+
+def get_wake_status(wake_id):
+    """Outcome of a dispatch, or None. A dispatch that joined another worker's supervisor resolves
+    to that supervisor's status.
+    """
+    status = state_get(f'wake:{wake_id}')
+    if status and status.get('alias') and status['alias'] != wake_id:
+        return state_get(f"wake:{status['alias']}") or status
+    return status
+
+def wait_first_attempt(wake_id, timeout):
+    """Block until the first send attempt of a dispatch is known (or timeout); returns its status."""
+    deadline = time.time() + timeout
+    status = get_wake_status(wake_id)
+    while status and not status.get('attempts') and status['state'] == 'pending' and time.time() < deadline:
+        time.sleep(0.1)
+        status = get_wake_status(wake_id)
+    return status
+
+# Post-wake warm-up: once the service comes up after being seen down (or after a wake), request
+# the machine's warm-up URLs so the first visitors do not hit cold caches. One run per process and
+# per boot; concurrent requests wait for the same run, bounded by the time budget.
+WARMUP_STATE = {}
+WARMUP_LOCK = Lock()
+
+def _warmup_entry(machine_id):
+    return WARMUP_STATE.setdefault(machine_id, {'down_seen': False, 'event': None, 'boot': None, 'last': None})
+
+def mark_service_down(machine_id):
+    """The service was observed unreachable: the next time it is up, warm it up again."""
+    if not machine_id:
+        return
+    with WARMUP_LOCK:
+        _warmup_entry(machine_id)['down_seen'] = True
+
+def _needs_warmup(machine_id, entry):
+    if entry['down_seen']:
+        return True
+    # boot seen by another worker (shared history): warm once per boot that has no warm-up yet
+    runs = load_boot_sessions().get(machine_id) or []
+    last = runs[-1] if runs else None
+    return (last is not None and last['service'] is not None and last['warmup'] is None
+            and entry['boot'] != last['wake'] and time.time() - last['wake'] < 2 * MAX_WAIT_TIME)
+
+def _fetch_warmup_url(url, deadline):
+    start = time.time()
+    try:
+        remaining = max(0.5, deadline - start)
+        with _http_session.get(url, timeout=(min(CONNECT_TIMEOUT, remaining), remaining),
+                               stream=True, allow_redirects=True) as r:
+            for _chunk in r.iter_content(chunk_size=65536):
+                if time.time() > deadline:
+                    break
+            return {'url': url, 'status': r.status_code, 'ms': int((time.time() - start) * 1000)}
+    except RequestException as e:
+        return {'url': url, 'status': None, 'ms': int((time.time() - start) * 1000), 'error': str(e)}
+
+def _run_warmup(machine_id, spec, base_url, event):
+    start = time.time()
+    deadline = start + spec['budget']
+    urls = [urljoin(base_url, u) for u in spec['urls']]
+    pool = ThreadPoolExecutor(max_workers=min(spec['concurrency'], len(urls)), thread_name_prefix='warmup')
+    futures = [pool.submit(_fetch_warmup_url, url, deadline) for url in urls]
+    # budget exhausted: unfinished URLs are abandoned
+    done, _pending = wait_futures(futures, timeout=max(0, deadline - time.time()))
+    pool.shutdown(wait=False)
+    results = [fut.result() for fut in futures if fut in done]
+    duration = time.time() - start
+    ok = sum(1 for r in results if r.get('status') and r['status'] < 500)
+    runs = load_boot_sessions().get(machine_id) or []
+    with WARMUP_LOCK:
+        entry = _warmup_entry(machine_id)
+        entry['last'] = {'ts': start, 'duration': round(duration, 2), 'ok': ok, 'total': len(urls),
+                         'timed_out': len(results) < len(urls), 'results': results}
+        entry['boot'] = runs[-1]['wake'] if runs else None
+        entry['event'] = None
+    _append_boot_event(machine_id, 'warmup', time.time(), duration)
+    logger.info(f"Warm-up of {machine_id}: {ok}/{len(urls)} URLs ok in {duration:.1f}s")
+    event.set()
+
+def warm_up_service(machine_id, machine, base_url, wait=True):
+    """Run (or join) the warm-up of a service that just came up; returns once it finished or
+    its budget elapsed (at once with wait=False, see warmup_running). Returns the last warm-up
+    report, or None when nothing was needed.
+    """
+    spec = (machine or {}).get("warmup") or {}
+    if not machine_id or not spec.get('urls') or not base_url:
+        return None
+    with WARMUP_LOCK:
+        entry = _warmup_entry(machine_id)
+        event = entry['event']
+        if event is None:
+            if not _needs_warmup(machine_id, entry):
+                return entry['last']
+            event = entry['event'] = Event()
+            entry['down_seen'] = False
+            Thread(target=_run_warmup, args=(machine_id, spec, base_url, event),
+                   name=f'warmup-{machine_id}', daemon=True).start()
+    if wait:
+        with timing_span('warmup'):
+            event.wait(spec['budget'] + 1)
+    with WARMUP_LOCK:
+        return entry['last']
+
+def warmup_running(machine_id):
+    with WARMUP_LOCK:
+        return (WARMUP_STATE.get(machine_id) or {}).get('event') is not None
+
+# Scheduled pre-wake: rules "<days> HH:MM" (days: daily, weekdays, weekends or mon,tue,...)
+# plus "lead minutes before" each event of an events file ("YYYY-MM-DD HH:MM [title]" per line).
+# Every worker runs the scheduler thread; only the holder of the 'lease:scheduler' lease (renewed
+# each tick in the state store) fires triggers, and a new leader resumes from the last tick.
+WAKE_SCHEDULER_ENABLED = os.environ.get('WAKE_SCHEDULER', '1') in ('1', 'true', 'True')
+try:
+    WAKE_SCHEDULER_TICK = float(os.environ.get('WAKE_SCHEDULER_TICK', '30'))
+    WAKE_RETRIES = int(os.environ.get('WAKE_RETRIES', '2'))
+except Exception:
+    WAKE_SCHEDULER_TICK = 30.0
+    WAKE_RETRIES = 2
+_WEEKDAYS = ('mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun')
+_DAY_ALIASES = {'daily': range(7), 'weekdays': range(5), 'weekends': (5, 6)}
+WAKE_SCHEDULER_STATE = {'leader': False, 'started': False}
+WAKE_SCHEDULER_LOCK_OBJ = Lock()
+_EVENTS_CACHE = {}
+
+def parse_wake_rule(rule):
+    """'weekdays 17:45' -> (set of weekday numbers, hour, minute). Raises ValueError."""
+    days_part, _, time_part = rule.strip().rpartition(' ')
+    hour, minute = (int(x) for x in time_part.split(':'))
+    if not (0 <= hour < 24 and 0 <= minute < 60):
+        raise ValueError(f"invalid time in wake rule {rule!r}")
+    days = set()
+    for token in (days_part or 'daily').lower().replace(' ', '').split(','):
+        if token in _DAY_ALIASES:
+            days.update(_DAY_ALIASES[token])
+        elif token[:3] in _WEEKDAYS:
+            days.add(_WEEKDAYS.index(token[:3]))
+        else:
+            raise ValueError(f"invalid day {token!r} in wake rule {rule!r}")
+    return days, hour, minute
+
+def load_wake_events(path):
+    """Event datetimes from a local file, re-read only when it changes."""
+    if not path:
+        return []
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError:
+        return []
+    cached = _EVENTS_CACHE.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    events = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.split('#', 1)[0].strip()
+            if not line:
+                continue
+            try:
+                events.append(datetime.strptime(line[:16], '%Y-%m-%d %H:%M'))
+            except ValueError:
+                logger.warning(f"Ignoring invalid event line in {path}: {line!r}")
+    _EVENTS_CACHE[path] = (mtime, events)
+    return events
+
+def wake_triggers(machine, start, end):
+    """Trigger datetimes for a machine in the interval (start, end]."""
+    triggers = []
+    for rule in machine.get("wake_schedule") or []:
+        try:
+            days, hour, minute = parse_wake_rule(rule)
+        except ValueError as e:
+            logger.warning(str(e))
+            continue
+        day = start.date()
+        while day <= end.date():
+            t = datetime.combine(day, datetime.min.time()).replace(hour=hour, minute=minute)
+            if day.weekday() in days and start < t <= end:
+                triggers.append(t)
+            day += timedelta(days=1)
+    lead = timedelta(minutes=machine.get("wake_lead_minutes") or 0)
+    for event in load_wake_events(machine.get("wake_events_file")):
+        if start < event - lead <= end:
+            triggers.append(event - lead)
+    return sorted(triggers)
+
+def run_scheduled_wake(machine_id, machine, trigger):
+    """Run a supervised wake (re-sends included) and retry it up to WAKE_RETRIES times if the
+    machine still does not answer.
+    """
+    run = {'machine': machine_id, 'trigger': trigger.isoformat(), 'attempts': 0, 'packets': 0, 'up': False, 'error': None}
+    counted = set()
+    for attempt in range(1 + WAKE_RETRIES):
+        run['attempts'] = attempt + 1
+        # retries must send again: bypass the dedup window that still holds the previous attempt
+        wake_id = dispatch_wake(machine.get("mac"), force=attempt > 0)
+        status = get_wake_status(wake_id) or {}
+        while status and 'done' not in status:
+            time.sleep(5)
+            status = get_wake_status(wake_id) or {}
+        # an attempt that joined a running supervisor reports that supervisor's packets
+        source_id = status.get('alias') or wake_id
+        if source_id not in counted:
+            counted.add(source_id)
+            run['packets'] += status.get('packets', 0)
+        run['error'] = status.get('details')
+        if status.get('up'):
+            run['up'] = True
+            break
+        logger.warning(f"Scheduled wake of {machine_id} not confirmed (attempt {attempt + 1}): {run['error'] or 'no answer'}")
+    logger.info(f"Scheduled wake of {machine_id} for {trigger:%Y-%m-%d %H:%M}: up={run['up']} attempts={run['attempts']}")
+    with WAKE_SCHEDULER_LOCK_OBJ:
+        state_set('scheduler:runs', ((state_get('scheduler:runs') or []) + [run])[-20:])
+
+def _scheduler_tick():
+    was_leader = WAKE_SCHEDULER_STATE['leader']
+    # followers retry every tick, so a new leader takes over if the elected worker exits
+    # a store error must not make every worker leader (each would fire the same wakes)
+    WAKE_SCHEDULER_STATE['leader'] = state_acquire_lease('lease:scheduler', state_owner(), 3 * WAKE_SCHEDULER_TICK,
+                                                         default=False)
+    if WAKE_SCHEDULER_STATE['leader'] and not was_leader:
+        logger.info(f"Wake scheduler elected in pid {os.getpid()}")
+    if not WAKE_SCHEDULER_STATE['leader']:
+        return
+    now = datetime.now()
+    # resume from the previous leader's last tick (at most one hour back)
+    try:
+        last = max(datetime.fromisoformat(state_get('scheduler:last_tick')), now - timedelta(hours=1))
+    except (TypeError, ValueError):
+        last = now
+    for machine_id, machine in MACHINES.items():
+        if not machine.get("mac") or not machine.get("ip"):
+            continue
         try:
-            if os.path.exists(tmpname):
-                os.remove(tmpname)
+            triggers = wake_triggers(machine, last, now)
+        except Exception as e:
+            logger.warning(f"Wake schedule of {machine_id} unreadable: {e}")
+            continue
+        for trigger in triggers:
+            Thread(target=run_scheduled_wake, args=(machine_id, machine, trigger),
+                   name=f'wake-{machine_id}', daemon=True).start()
+    state_set('scheduler:last_tick', now.isoformat(timespec='seconds'))
+
+def _scheduler_loop():
+    while True:
+        # one failing tick (state store, events file, reload) must not stop the scheduler
+        try:
+            # rules and settings follow .env even when no request comes in
+            maybe_reload_config()
+            _scheduler_tick()
         except Exception:
-            pass
+            logger.exception("Wake scheduler tick failed")
+        time.sleep(WAKE_SCHEDULER_TICK)
+
+def ensure_scheduler_started():
+    """Start the scheduler thread in this process once any rule exists. Called when a served worker
+    boots and again on requests (rules may appear later through a config reload). 'started' holds
+    the pid, so a process forked after the start (gunicorn --preload) starts its own thread."""
+    if WAKE_SCHEDULER_STATE['started'] == os.getpid() or not WAKE_SCHEDULER_ENABLED:
+        return
+    if not any(m.get("wake_schedule") or m.get("wake_events_file") for m in MACHINES.values()):
+        return
+    with WAKE_SCHEDULER_LOCK_OBJ:
+        if WAKE_SCHEDULER_STATE['started'] == os.getpid():
+            return
+        WAKE_SCHEDULER_STATE['started'] = os.getpid()
+        Thread(target=_scheduler_loop, name='wake-scheduler', daemon=True).start()
+
+@app.before_request
+def _start_background_jobs():
+    ensure_scheduler_started()
+
+def request_client_ip():
+    # Prefer X-Forwarded-For when behind a reverse proxy (nginx). Take first value if multiple.
+    xff = request.headers.get('X-Forwarded-For', '')
+    if xff:
+        return xff.split(',')[0].strip()
+    return request.remote_addr or 'unknown'
+
+def check_rate_limit(client_ip):
+    """Sliding-window rate limit per client IP, shared by all workers. The window is approximated
+    from the current and previous fixed-window counters. Returns a 429 response or None.
+    """
+    now = time.time()
+    window = int(now // PING_RATE_WINDOW)
+    try:
+        previous = STATE.get(f'rate:{client_ip}:{window - 1}') or 0
+        current = STATE.get(f'rate:{client_ip}:{window}') or 0
+        weight = 1.0 - (now % PING_RATE_WINDOW) / PING_RATE_WINDOW
+        if previous * weight + current >= PING_RATE_LIMIT:
+            # Too many requests in window
+            resp = jsonify({"error": "too many requests", "limit": PING_RATE_LIMIT, "window": PING_RATE_WINDOW})
+            resp.status_code = 429
+            resp.headers['Retry-After'] = str(int(PING_RATE_WINDOW))
+            return resp
+        # record this request; the counter outlives its window to weigh the next one
+        STATE.incr(f'rate:{client_ip}:{window}', ttl=2 * PING_RATE_WINDOW)
+    except Exception as e:
+        # a broken state store must not take the API down: fail open
+        logger.warning(f"Rate limit check failed: {e}")
+    return None
 
 @app.route('/api/wol', methods=['POST'])
 def api_wol():
@@ -353,80 +2015,94 @@ def api_wol():
     if not mac:
         return jsonify({"success": False, "error": "MAC address required"}), 400
 
-    config = load_config()
+    config = load_config(router_for(mac=mac))
     if not config:
         return jsonify({"success": False, "error": "Configuration not found"}), 500
 
-    session_token, err = login_freebox(config)
-    if err:
-        return jsonify({"success": False, "error": "Freebox login failed", "details": err}), 500
-
-    success, err = send_wol(session_token, mac, config)
-    if success:
-        return jsonify({"success": True, "message": "WOL packet sent", "mac": mac, "ip": ip})
+    # the supervisor re-sends until the host is up; answer with the outcome of the first packet
+    wake_id = dispatch_wake(mac)
+    with timing_span('wake-wait'):
+        status = wait_first_attempt(wake_id, 2 * (CONNECT_TIMEOUT + READ_TIMEOUT)) or {}
+    if status.get('packets'):
+        return jsonify({"success": True, "message": "WOL packet sent", "mac": mac, "ip": ip, "wake_id": wake_id})
+    elif status.get('state') == 'pending' and not status.get('attempts'):
+        return jsonify({"success": True, "message": "WOL queued", "mac": mac, "ip": ip, "wake_id": wake_id}), 202
     else:
-        return jsonify({"success": False, "error": "Failed to send WOL packet", "details": err}), 500
+        return jsonify({"success": False, "error": "Failed to send WOL packet",
+                        "details": status.get('details'), "wake_id": wake_id}), 500
 
 @app.route('/api/ping/<ip>')
 def api_ping(ip):
-    # Prefer X-Forwarded-For when behind a reverse proxy (nginx). Take first value if multiple.
-    xff = request.headers.get('X-Forwarded-For', '')
-    if xff:
-        client_ip = xff.split(',')[0].strip()
+    if not ping_target_allowed(ip):
+        with PING_CACHE_LOCK:
+            PING_CACHE_STATS['rejected'] += 1
+        return jsonify({"error": "target not allowed", "ip": ip}), 400
+    client_ip = request_client_ip()
+    limited = check_rate_limit(client_ip)
+    if limited is not None:
+        return limited
+
+    # Return cached result if recent to avoid hammering the host when clients poll rapidly;
+    # an expired entry is still served (stale) while a background refresh runs
+    status = get_host_status(ip)
+    if status['cached']:
+        logger.debug(f"Ping cache {status['cache']} for {ip} (client={client_ip}) age={status['age']:.2f}s")
     else:
-        client_ip = request.remote_addr or 'unknown'
-    now = time.time()
-
-    # simple sliding-window rate limit per client IP
-    with PING_RATE_LOCK:
-        arr = PING_RATE_MAP.get(client_ip)
-        if not arr:
-            arr = []
-            PING_RATE_MAP[client_ip] = arr
-        # remove old timestamps
-        while arr and arr[0] < now - PING_RATE_WINDOW:
-            arr.pop(0)
-        if len(arr) >= PING_RATE_LIMIT:
-            # Too many requests in window
-            resp = jsonify({"error": "too many requests", "limit": PING_RATE_LIMIT, "window": PING_RATE_WINDOW})
-            resp.status_code = 429
-            resp.headers['Retry-After'] = str(int(PING_RATE_WINDOW))
-            return resp
-        # record this request
-        arr.append(now)
-
-    # Return cached result if recent to avoid hammering the host when clients poll rapidly
-    now = time.time()
-    # Try file cache first (shared between workers)
-    file_cached = read_ping_cache_file(ip)
-    if file_cached and (now - file_cached.get('ts', 0.0) < PING_CACHE_TTL):
-        logger.debug(f"Ping file-cache HIT for {ip} (client={client_ip}) age={now - file_cached.get('ts', 0.0):.2f}s")
-        resp = jsonify({"ip": ip, "online": file_cached.get('online', False), "cached": True})
-        resp.headers['X-Ping-Cache'] = 'HIT_FILE'
-        return resp
-
-    with PING_CACHE_LOCK:
-        cached = PING_CACHE.get(ip)
-        if cached and (now - cached.get('ts', 0.0) < PING_CACHE_TTL):
-            logger.debug(f"Ping memory-cache HIT for {ip} (client={client_ip}) age={now - cached.get('ts', 0.0):.2f}s")
-            resp = jsonify({"ip": ip, "online": cached.get('online', False), "cached": True})
-            resp.headers['X-Ping-Cache'] = 'HIT_MEM'
-            return resp
-
-    # Not cached or expired: perform actual ping
-    logger.info(f"Ping cache MISS for {ip} — performing ping (client={client_ip})")
-    online = ping_host(ip)
-    with PING_CACHE_LOCK:
-        PING_CACHE[ip] = {'ts': now, 'online': online}
-    # also write to file cache
-    try:
-        write_ping_cache_file(ip, online, now)
-    except Exception:
-        pass
+        logger.info(f"Ping cache MISS for {ip} — performed ping (client={client_ip})")
+
+    # neighbour state lets the waiting page see the NIC come up before the OS answers ICMP
+    resp = jsonify({"ip": ip, "online": status['online'], "cached": status['cached'],
+                    "stale": status['stale'], "age": status['age'], "source": status['source'],
+                    "neigh": neighbour_state(ip=ip)})
+    resp.headers['X-Ping-Cache'] = status['cache']
+    return set_status_cache_headers(resp, [status])
+
+@app.route('/api/status', methods=['GET', 'POST'])
+@csrf_exempt
+def api_status():
+    """Batched status: GET /api/status?ids=a,b,c or POST {"ids": [...]} (machine ids or IPs).
+    One request (and one rate-limit slot) for the whole dashboard. Raw IPs must belong to a
+    registered machine or to PING_ALLOWED_NETWORKS: a batch of arbitrary addresses would
+    get up to STATUS_BATCH_MAX probes and cache entries for a single rate-limit slot.
+    """
+    if request.method == 'POST':
+        body = request.get_json(silent=True)
+        if body is None:
+            body = {}
+        if not isinstance(body, dict):
+            return jsonify({"error": "JSON object expected"}), 400
+        ids = body.get('ids') or []
+        if not isinstance(ids, list):
+            return jsonify({"error": "ids must be a list"}), 400
+    else:
+        ids = [i for i in request.args.get('ids', '').split(',') if i]
+    if not ids:
+        ids = list(MACHINES.keys())
+    if len(ids) > STATUS_BATCH_MAX:
+        return jsonify({"error": "too many ids", "max": STATUS_BATCH_MAX}), 400
+
+    limited = check_rate_limit(request_client_ip())
+    if limited is not None:
+        return limited
+
+    targets = {}
+    unknown = []
+    for item in ids:
+        item = str(item)
+        if item in MACHINES and MACHINES[item].get("ip"):
+            targets[item] = MACHINES[item]["ip"]
+        elif ping_target_allowed(item) and (PING_ALLOWED_NETWORKS or find_machine(ip=item)[0]):
+            targets[item] = item
+        else:
+            unknown.append(item)
 
-    resp = jsonify({"ip": ip, "online": online, "cached": False})
-    resp.headers['X-Ping-Cache'] = 'MISS'
-    return resp
+    statuses = get_many_host_status(set(targets.values()))
+    machines = {}
+    for item, ip in targets.items():
+        st = statuses[ip]
+        machines[item] = {"ip": ip, "online": st['online'], "cached": st['cached'], "stale": st['stale'],
+                          "age": st['age'], "source": st['source'], "neigh": neighbour_state(ip=ip)}
+    return set_status_cache_headers(jsonify({"machines": machines, "unknown": unknown}), statuses.values())
 
 @app.route('/api/service-check')
 def api_service_check():
@@ -434,29 +2110,690 @@ def api_service_check():
     check_host = GAMEARENA_HOST_IP or host
     port = GAMEARENA_PORT
 
-    ping_result = ping_host(check_host)
-    service_result = is_service_up(check_host, port, timeout=2)
-    
+    ready_ports = (find_machine(ip=check_host)[1] or {}).get("ready_ports") or []
+    ports = ([port] if port is not None else []) + [p for p in ready_ports if p != port]
+    with admission('service-check'):
+        ping_result = ping_host(check_host)
+        scan = scan_tcp_ports([(check_host, p) for p in ports], timeout=2) if check_host else {}
+    service_result = bool(ports) and all(scan.get((check_host, p), {}).get('open') for p in ports)
+    if service_result:
+        record_boot_event(find_machine(ip=check_host)[0], 'service')
+
     return jsonify({
         "gamearena_url": GAMEARENA_URL,
         "check_host": check_host,
         "port": port,
         "ping_ok": ping_result,
-        "service_up": service_result
+        "service_up": service_result,
+        "ports": {str(p): scan.get((check_host, p)) for p in ports}
     })
 
+@app.route('/api/schedule')
+def api_schedule():
+    """Next scheduled pre-wakes (7 days ahead) and the recent runs of whichever worker led."""
+    now = datetime.now()
+    upcoming = {}
+    for machine_id, machine in MACHINES.items():
+        try:
+            upcoming[machine_id] = [t.isoformat(timespec='minutes')
+                                    for t in wake_triggers(machine, now, now + timedelta(days=7))][:10]
+        except Exception as e:
+            logger.warning(f"Wake schedule of {machine_id} unreadable: {e}")
+            upcoming[machine_id] = []
+    return jsonify({'enabled': WAKE_SCHEDULER_ENABLED, 'leader': state_get('lease:scheduler'),
+                    'pid': os.getpid(), 'last_tick': state_get('scheduler:last_tick'),
+                    'upcoming': upcoming, 'runs': state_get('scheduler:runs') or []})
+
+@app.route('/api/load')
+def api_load():
+    """Admission-control gauges and counters (queue depth, shed counts). Worker details (pid,
+    Freebox routers and breakers, config reload errors that may quote .env values) are only added
+    for local requests with debug enabled, like /debug/profile.
+    """
+    with ADMISSION_COND:
+        stats = dict(ADMISSION_STATS)
+    load = {**stats, 'max_active': ADMISSION_MAX_ACTIVE, 'max_queue': ADMISSION_MAX_QUEUE}
+    if debug_allowed() and is_local_request():
+        load.update(pid=os.getpid(), routers={name: router_status(r) for name, r in ROUTERS.items()},
+                    config={'loaded_at': CONFIG_STATE['loaded_at'], 'reloads': CONFIG_STATE['reloads'],
+                            'error': CONFIG_STATE['error'], 'shadowed': CONFIG_STATE['shadowed']})
+    return jsonify(load)
+
+# --- Machine registry: env-defined machines plus the ones found by LAN discovery ---
+# Discovered machines live in MACHINES_FILE ({machine_id: {name, mac, ip, ports, discovered, last_seen}}),
+# written by `flask --app wol_app discover` or POST /api/admin/discover and re-read by every worker
+# when its stamp changes. Env-defined machines (GAMEARENA_*) always win and are never rewritten.
+ENV_MACHINES = MACHINES
+MACHINES_FILE = os.environ.get('MACHINES_FILE', os.path.join(BASE_DIR, 'machines.json'))
+try:
+    REGISTRY_CHECK_INTERVAL = float(os.environ.get('REGISTRY_CHECK_INTERVAL', '2'))
+except Exception:
+    REGISTRY_CHECK_INTERVAL = 2.0
+REGISTRY = {'stamp': None, 'checked': 0.0}
+REGISTRY_LOCK = Lock()
+
+def load_machine_registry(path):
+    """Discovered machines stored in path ({} when missing or unreadable)."""
+    try:
+        with open(path, 'r') as f:
+            data = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logger.warning(f"Cannot read machine registry {path}: {e}")
+        return {}
+    if not isinstance(data, dict):
+        return {}
+    return {mid: m for mid, m in data.items() if isinstance(m, dict) and normalize_mac(m.get('mac'))}
+
+def apply_machine_registry(discovered):
+    """Swap in a new MACHINES dict (env machines first). The dict is replaced, never mutated, so
+    request threads iterating the previous one are not disturbed."""
+    global MACHINES, MACHINES_VERSION
+    env_macs = {normalize_mac(m.get('mac')) for m in ENV_MACHINES.values()}
+    machines = dict(ENV_MACHINES)
+    for mid, machine in discovered.items():
+        if mid not in machines and normalize_mac(machine.get('mac')) not in env_macs:
+            machines[mid] = machine
+    MACHINES, MACHINES_VERSION = machines, registry_version(machines)
+
+def refresh_machine_registry(force=False):
+    """Pick up MACHINES_FILE changes made by another worker or by the discover command
+    (one stat at most every REGISTRY_CHECK_INTERVAL seconds)."""
+    if not force and time.monotonic() - REGISTRY['checked'] < REGISTRY_CHECK_INTERVAL:
+        return
+    with REGISTRY_LOCK:
+        REGISTRY['checked'] = time.monotonic()
+        stamp = file_stamp(MACHINES_FILE)
+        if not force and stamp == REGISTRY['stamp']:
+            return
+        REGISTRY['stamp'] = stamp
+        apply_machine_registry(load_machine_registry(MACHINES_FILE))
+
+def merge_discovered(hosts):
+    """Merge sweep results into MACHINES_FILE and the live registry. A known MAC gets its IP,
+    ports and last_seen updated (DHCP moves); a new MAC gets a 'lan-<mac>' entry. Machines defined
+    in the environment are skipped. Returns (added, updated).
+    """
+    added = updated = 0
+    with REGISTRY_LOCK:
+        discovered = load_machine_registry(MACHINES_FILE)
+        ids_by_mac = {normalize_mac(m['mac']): mid for mid, m in discovered.items()}
+        env_macs = {normalize_mac(m.get('mac')) for m in ENV_MACHINES.values()}
+        now = int(time.time())
+        for host in hosts:
+            mac = normalize_mac(host['mac'])
+            if mac in env_macs:
+                continue
+            mid = ids_by_mac.get(mac)
+            if mid is None:
+                mid = ids_by_mac[mac] = 'lan-' + mac.replace(':', '')
+                discovered[mid] = {'name': host.get('name') or f"LAN {host['ip']}", 'mac': mac, 'discovered': True}
+                added += 1
+            else:
+                updated += 1
+            entry = discovered[mid]
+            entry.update(ip=host['ip'], last_seen=now)
+            if host.get('ports') is not None:
+                entry['ports'] = host['ports']
+        tmp = f"{MACHINES_FILE}.{os.getpid()}.tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(discovered, f, indent=2, sort_keys=True)
+            os.replace(tmp, MACHINES_FILE)
+        except OSError as e:
+            logger.warning(f"Cannot write machine registry {MACHINES_FILE}: {e}")
+        REGISTRY['stamp'] = file_stamp(MACHINES_FILE)
+        apply_machine_registry(discovered)
+    return added, updated
+
+refresh_machine_registry(force=True)
+
+@app.before_request
+def _refresh_registry():
+    refresh_machine_registry()
+
+# --- LAN discovery: ARP sweep through the kernel neighbour table, then a port fingerprint ---
+try:
+    DISCOVERY_WAIT = float(os.environ.get('DISCOVERY_WAIT', '1.0'))
+    DISCOVERY_PORT_TIMEOUT = float(os.environ.get('DISCOVERY_PORT_TIMEOUT', '0.5'))
+    DISCOVERY_MAX_HOSTS = int(os.environ.get('DISCOVERY_MAX_HOSTS', '1024'))
+except Exception:
+    DISCOVERY_WAIT = 1.0
+    DISCOVERY_PORT_TIMEOUT = 0.5
+    DISCOVERY_MAX_HOSTS = 1024
+DISCOVERY_PORTS = parse_port_list(os.environ.get('DISCOVERY_PORTS', '22,80,443,445,3389,5900,8080'))
+# default: the /24 around the GameArena host
+
+def discovery_subnets_setting(environ):
+    """DISCOVERY_SUBNETS, defaulting to the /24 of GAMEARENA_HOST_IP (recomputed on reload)."""
+    host_ip = environ.get('GAMEARENA_HOST_IP')
+    return environ.get('DISCOVERY_SUBNETS') or (f"{host_ip}/24" if host_ip else '')
+
+DISCOVERY_SUBNETS = discovery_subnets_setting(os.environ)
+DISCOVERY_NUDGE_PORT = 9  # discard: the datagram only exists to make the kernel resolve the MAC
+DISCOVERY_SCAN_CHUNK = 256  # sockets opened at once by the port fingerprint
+
+def parse_discovery_subnets(value):
+    """Comma/space separated private IPv4 CIDRs -> ([networks], err)."""
+    networks = []
+    for cidr in (value or '').replace(',', ' ').split():
+        try:
+            net = ipaddress.ip_network(cidr, strict=False)
+        except ValueError:
+            return None, f"invalid subnet {cidr!r}"
+        if net.version != 4 or not net.is_private:
+            return None, f"subnet {cidr} is not a private IPv4 network"
+        if net.num_addresses > DISCOVERY_MAX_HOSTS:
+            return None, f"subnet {cidr} is larger than DISCOVERY_MAX_HOSTS ({DISCOVERY_MAX_HOSTS})"
+        networks.append(net)
+    if not networks:
+        return None, "no subnet to sweep (set DISCOVERY_SUBNETS)"
+    return networks, None
+
+def sweep_subnet(network, wait=None):
+    """ARP sweep of one subnet without raw sockets: one empty UDP datagram per address makes the
+    kernel resolve every MAC in parallel, then a single neighbour-table dump collects the answers.
+    Returns [{'ip', 'mac', 'state'}] for the hosts that answered ARP (firewalled hosts included).
+    """
+    wait = DISCOVERY_WAIT if wait is None else wait
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s:
+        s.setblocking(False)
+        for addr in network.hosts():
+            try:
+                s.sendto(b'', (str(addr), DISCOVERY_NUDGE_PORT))
+            except OSError:
+                # EAGAIN, or EHOSTUNREACH for an address whose resolution failed recently
+                pass
+    time.sleep(wait)
+    by_ip, _by_mac = read_neighbour_table(max_age=0)
+    found = []
+    for ip, entry in by_ip.items():
+        try:
+            in_net = ipaddress.ip_address(ip) in network
+        except ValueError:
+            continue
+        if in_net and entry.get('mac') and entry['state'] in NEIGH_PRESENT_STATES:
+            found.append({'ip': ip, 'mac': entry['mac'], 'state': entry['state']})
+    return sorted(found, key=lambda h: ipaddress.ip_address(h['ip']))
+
+def fingerprint_ports(hosts, ports, timeout=None):
+    """Set host['ports'] to the open TCP ports among `ports`, scanning every host concurrently."""
+    timeout = DISCOVERY_PORT_TIMEOUT if timeout is None else timeout
+    targets = [(h['ip'], p) for h in hosts for p in ports]
+    results = {}
+    for i in range(0, len(targets), DISCOVERY_SCAN_CHUNK):
+        results.update(scan_tcp_ports(targets[i:i + DISCOVERY_SCAN_CHUNK], timeout=timeout))
+    for h in hosts:
+        h['ports'] = [p for p in ports if results.get((h['ip'], p), {}).get('open')]
+    return hosts
+
+def _discovery_lease(networks):
+    """Take lease:discovery for one sweep; returns the owner token, or None if a sweep is running."""
+    owner = f"{state_owner()}:{secrets.token_hex(4)}"
+    ttl = len(networks) * (DISCOVERY_WAIT + 1) + DISCOVERY_PORT_TIMEOUT * 8 + 30
+    return owner if state_acquire_lease('lease:discovery', owner, ttl) else None
+
+def run_discovery(networks, ports=None, merge=True, owner=None):
+    """Sweep networks, name hosts from the Freebox LAN browser snapshot when it has them, and
+    merge into the registry in two steps: IP<->MAC pairs as soon as the ARP sweep ends, then
+    the port fingerprints. Only one sweep runs at a time across workers (lease:discovery).
+    owner is the lease token when the caller already took it. Returns (summary, err); the summary
+    is also kept in STATE as discovery:last.
+    """
+    ports = DISCOVERY_PORTS if ports is None else ports
+    owner = owner or _discovery_lease(networks)
+    if owner is None:
+        return None, "a discovery sweep is already running"
+    start = time.monotonic()
+    try:
+        hosts = []
+        for network in networks:
+            hosts.extend(sweep_subnet(network))
+        lan_by_mac = {}
+        for router in ROUTERS:
+            lan_by_mac.update(lan_browser_snapshot(router)[0] or {})
+        for h in hosts:
+            h['name'] = (lan_by_mac.get(h['mac']) or {}).get('name')
+        arp_ms = round((time.monotonic() - start) * 1000, 1)
+        added = updated = 0
+        if merge:
+            added, updated = merge_discovered(hosts)
+        if ports and hosts:
+            fingerprint_ports(hosts, ports)
+            if merge:
+                merge_discovered(hosts)
+        summary = {'subnets': [str(n) for n in networks], 'ports': ports, 'hosts': hosts,
+                   'added': added, 'updated': updated, 'arp_ms': arp_ms,
+                   'duration_ms': round((time.monotonic() - start) * 1000, 1), 'ts': time.time()}
+        state_set('discovery:last', summary, ttl=7 * 86400)
+        logger.info(f"LAN discovery: {len(hosts)} hosts on {', '.join(summary['subnets'])} "
+                    f"({added} new, {updated} updated) in {summary['duration_ms']} ms")
+        return summary, None
+    except Exception as e:
+        logger.warning(f"LAN discovery failed: {e}")
+        return None, str(e)
+    finally:
+        state_release_lease('lease:discovery', owner)
+
+def _discovery_job(networks, ports, owner):
+    _summary, err = run_discovery(networks, ports, owner=owner)
+    if err:
+        state_set('discovery:last', {'error': err, 'ts': time.time()}, ttl=7 * 86400)
+
+@app.route('/api/admin/discover', methods=['GET', 'POST'])
+@csrf_exempt  # protected by the loopback check, not by a session
+def api_admin_discover():
+    """POST starts a sweep in the background (202), GET returns the last result. Local clients only."""
+    if not is_local_request():
+        abort(404)
+    if request.method == 'GET':
+        return jsonify({'running': state_lease_owner('lease:discovery'), 'last': state_get('discovery:last'),
+                        'machines': len(MACHINES)})
+    data = request.get_json(silent=True)
+    if data is None:
+        data = {}
+    if not isinstance(data, dict):
+        return jsonify({'error': 'JSON object expected'}), 400
+    networks, err = parse_discovery_subnets(data.get('subnets') or DISCOVERY_SUBNETS)
+    if err:
+        return jsonify({'error': err}), 400
+    ports = parse_port_list(','.join(str(p) for p in data['ports'])) if isinstance(data.get('ports'), list) else DISCOVERY_PORTS
+    owner = _discovery_lease(networks)
+    if owner is None:
+        return jsonify({'error': 'discovery already running', 'running': state_lease_owner('lease:discovery')}), 409
+    Thread(target=_discovery_job, args=(networks, ports, owner), name='lan-discovery', daemon=True).start()
+    return jsonify({'started': True, 'subnets': [str(n) for n in networks], 'ports': ports}), 202
+
+@app.cli.command('discover')
+@click.option('--subnet', 'subnets', multiple=True, help="CIDR à balayer (répétable). Défaut: DISCOVERY_SUBNETS")
+@click.option('--ports', default=None, help="ports TCP à tester, ex: 22,80,3389 ('' pour aucun)")
+@click.option('--dry-run', is_flag=True, help="afficher sans modifier MACHINES_FILE")
+@click.option('--json', 'as_json', is_flag=True, help="sortie JSON")
+def discover_command(subnets, ports, dry_run, as_json):
+    """Balayer le LAN et ajouter les machines trouvées au registre (MACHINES_FILE)."""
+    networks, err = parse_discovery_subnets(' '.join(subnets) or DISCOVERY_SUBNETS)
+    if err:
+        raise click.UsageError(err)
+    summary, err = run_discovery(networks, DISCOVERY_PORTS if ports is None else parse_port_list(ports),
+                                 merge=not dry_run)
+    if err:
+        raise click.ClickException(err)
+    if as_json:
+        click.echo(json.dumps(summary, indent=2))
+        return
+    for h in summary['hosts']:
+        ports_txt = ','.join(str(p) for p in h.get('ports') or []) or '-'
+        click.echo(f"{h['ip']:16} {h['mac']}  {h['state']:10} ports: {ports_txt:20} {h.get('name') or ''}")
+    click.echo(f"{len(summary['hosts'])} machine(s) en {summary['duration_ms']} ms "
+               f"(ARP {summary['arp_ms']} ms) — {summary['added']} ajoutée(s), {summary['updated']} mise(s) à jour"
+               + (" [dry-run]" if dry_run else ""))
+
+# --- Runtime snapshot: warm state carried over a restart ---
+# Each worker writes host statuses, warm-up verdicts and the Freebox sessions to one compact file
+# when it exits gracefully (merged with what the other workers wrote); at start-up every worker
+# reloads the entries the snapshot still vouches for. Entries keep their original timestamps,
+# so ages stay truthful and the usual TTL/stale rules apply.
+RUNTIME_SNAPSHOT_PATH = os.environ.get('RUNTIME_SNAPSHOT',
+                                       os.path.join(STATE_DIR, 'runtime_snapshot.json') if STATE_DIR else '')
+try:
+    RUNTIME_SNAPSHOT_MAX_AGE = float(os.environ.get('RUNTIME_SNAPSHOT_MAX_AGE', '600'))
+except Exception:
+    RUNTIME_SNAPSHOT_MAX_AGE = 600.0
+RUNTIME_SNAPSHOT_STATE = {'restored': None, 'saved': None}
+RUNTIME_SNAPSHOT_LOCK = Lock()
+
+def _read_runtime_snapshot():
+    """The snapshot file if it exists and is younger than RUNTIME_SNAPSHOT_MAX_AGE, else None."""
+    if not RUNTIME_SNAPSHOT_PATH:
+        return None
+    try:
+        with open(RUNTIME_SNAPSHOT_PATH, 'r') as f:
+            snap = json.load(f)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logger.warning(f"Ignoring unreadable runtime snapshot {RUNTIME_SNAPSHOT_PATH}: {e}")
+        return None
+    if not isinstance(snap, dict) or snap.get('v') != 1:
+        return None
+    if time.time() - snap.get('ts', 0) > RUNTIME_SNAPSHOT_MAX_AGE:
+        return None
+    return snap
+
+def _newest(a, b, key='ts'):
+    if not a:
+        return b
+    if not b:
+        return a
+    return a if (a.get(key) or 0) >= (b.get(key) or 0) else b
+
+def build_runtime_snapshot():
+    """This worker's warm state: memory and shared ping entries, warm-up verdicts, sessions."""
+    hosts = {}
+    with PING_CACHE_LOCK:
+        for ip, entry in PING_CACHE.items():
+            hosts[ip] = dict(entry)
+    for machine in MACHINES.values():
+        ip = machine.get("ip")
+        if ip:
+            hosts[ip] = _newest(hosts.get(ip), read_shared_ping(ip))
+    with WARMUP_LOCK:
+        warmup = {mid: {'down_seen': e['down_seen'], 'boot': e['boot'], 'last': e['last']}
+                  for mid, e in WARMUP_STATE.items()}
+    sessions = {}
+    for name in ROUTERS:
+        try:
+            session = STATE.get(f"freebox:session:{name}")
+        except Exception:
+            session = None
+        if session:
+            sessions[name] = session
+    return {'v': 1, 'ts': time.time(), 'pid': os.getpid(),
+            'hosts': {ip: e for ip, e in hosts.items() if e}, 'warmup': warmup, 'sessions': sessions}
+
+def _merge_runtime_snapshot(snap):
+    """Merge snap with the file on disk (newest entry wins) and replace the file atomically."""
+    previous = _read_runtime_snapshot() or {}
+    for ip, entry in (previous.get('hosts') or {}).items():
+        snap['hosts'][ip] = _newest(snap['hosts'].get(ip), entry)
+    for mid, entry in (previous.get('warmup') or {}).items():
+        mine = snap['warmup'].get(mid)
+        if not mine or ((entry.get('last') or {}).get('ts') or 0) > ((mine.get('last') or {}).get('ts') or 0):
+            snap['warmup'][mid] = entry
+    for name, session in (previous.get('sessions') or {}).items():
+        snap['sessions'][name] = _newest(snap['sessions'].get(name), session)
+    tmp = f"{RUNTIME_SNAPSHOT_PATH}.{os.getpid()}.tmp"
+    # the file holds Freebox session tokens
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(snap, f, separators=(',', ':'))
+    os.replace(tmp, RUNTIME_SNAPSHOT_PATH)
+    RUNTIME_SNAPSHOT_STATE['saved'] = snap['ts']
+    logger.info(f"Runtime snapshot saved: {len(snap['hosts'])} hosts, {len(snap['sessions'])} sessions")
+
+def save_runtime_snapshot():
+    """Write (merge) this worker's warm state into the snapshot file; called once on SIGTERM or at
+    exit, whichever comes first."""
+    with RUNTIME_SNAPSHOT_LOCK:
+        if not RUNTIME_SNAPSHOT_PATH or RUNTIME_SNAPSHOT_STATE['saved']:
+            return
+        RUNTIME_SNAPSHOT_STATE['saved'] = time.time()
+    try:
+        snap = build_runtime_snapshot()
+        # workers stop together: one read-merge-write at a time (flock on a sibling file, which
+        # holds across processes whatever the state store), released when the file is closed
+        with open(f"{RUNTIME_SNAPSHOT_PATH}.lock", 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            _merge_runtime_snapshot(snap)
+    except Exception as e:
+        logger.warning(f"Cannot save runtime snapshot {RUNTIME_SNAPSHOT_PATH}: {e}")
+
+def restore_runtime_snapshot():
+    """Reload a recent snapshot: host statuses into the ping cache (and the shared store when it
+    has nothing newer), warm-up verdicts, and sessions still inside FREEBOX_SESSION_TTL."""
+    snap = _read_runtime_snapshot()
+    if snap is None:
+        return None
+    now = time.time()
+    age = now - snap['ts']
+    hosts = 0
+    for ip, entry in sorted((snap.get('hosts') or {}).items(), key=lambda item: item[1].get('ts', 0)):
+        if now - entry.get('ts', 0) >= PING_HARD_STALE:
+            continue
+        ping_cache_put(ip, entry)
+        if _newest(read_shared_ping(ip), entry) is entry:
+            write_shared_ping(ip, entry['online'], entry['ts'], exp=entry.get('exp'), source=entry.get('source'))
+        hosts += 1
+    with WARMUP_LOCK:
+        for mid, saved in (snap.get('warmup') or {}).items():
+            entry = _warmup_entry(mid)
+            if entry['last'] is None:
+                entry.update(down_seen=saved.get('down_seen', False), boot=saved.get('boot'), last=saved.get('last'))
+    sessions = 0
+    for name, session in (snap.get('sessions') or {}).items():
+        remaining = session.get('ts', 0) + FREEBOX_SESSION_TTL - now
+        key = f"freebox:session:{name}"
+        if name in ROUTERS and remaining > 0 and not STATE.get(key):
+            STATE.set(key, session, ttl=remaining)
+            sessions += 1
+    RUNTIME_SNAPSHOT_STATE['restored'] = {'age': round(age, 1), 'hosts': hosts, 'sessions': sessions,
+                                          'warmup': len(snap.get('warmup') or {})}
+    logger.info(f"Runtime snapshot restored ({age:.0f}s old): {hosts} hosts, {sessions} sessions")
+    return RUNTIME_SNAPSHOT_STATE['restored']
+
+try:
+    restore_runtime_snapshot()
+except Exception as e:
+    logger.warning(f"Cannot restore runtime snapshot: {e}")
+
+# --- Hot reload: .env changes (or SIGHUP) are applied to running workers without a restart ---
+# Only settings, never state: PING_CACHE, the state store (sessions, rate-limit counters, wakes)
+# and routers whose profile did not change are kept as they are. Precedence is the same as at
+# boot: the process environment first, then .env. Boot variables that carried the .env value
+# (systemd EnvironmentFile=.env) are not pinned: .env edits apply to them too.
+try:
+    CONFIG_CHECK_INTERVAL = float(os.environ.get('CONFIG_CHECK_INTERVAL', '2'))
+except Exception:
+    CONFIG_CHECK_INTERVAL = 2.0
+CONFIG_STATE = {'stamp': file_stamp(ENV_PATH), 'checked': 0.0, 'pending': False, 'loaded_at': time.time(),
+                'reloads': 0, 'error': None, 'shadowed': [], 'file_keys': set(dotenv_values(ENV_PATH)) if os.path.exists(ENV_PATH) else set()}
+CONFIG_LOCK = Lock()
+
+def _positive(cast):
+    def parse(value):
+        parsed = cast(value)
+        if parsed <= 0:
+            raise ValueError(f"must be > 0, got {value!r}")
+        return parsed
+    return parse
+
+def _non_negative(cast):
+    def parse(value):
+        parsed = cast(value)
+        if parsed < 0:
+            raise ValueError(f"must be >= 0, got {value!r}")
+        return parsed
+    return parse
+
+def _resend_schedule(value):
+    offsets = sorted(_non_negative(float)(x) for x in value.split(',') if x.strip())
+    return offsets or [0.0]
+
+# global name -> (variable, parser, default); a None default leaves the setting unset
+RELOADABLE_SETTINGS = {
+    'MAX_WAIT_TIME': ('MAX_WAIT_TIME', _positive(int), '120'),
+    'GAMEARENA_URL': ('GAMEARENA_URL', str, None),
+    'GAMEARENA_HOST_IP': ('GAMEARENA_HOST_IP', str, None),
+    'GAMEARENA_PORT': ('GAMEARENA_PORT', parse_optional_port, None),
+    'CONFIG_FILE': ('FREEBOX_TOKEN_PATH', str, os.path.join(BASE_DIR, ".freebox_token")),
+    'ENV_FREEBOX_IP': ('FREEBOX_IP', str, None),
+    'FREEBOX_SESSION_TTL': ('FREEBOX_SESSION_TTL', _positive(float), '1800'),
+    'PING_CACHE_TTL': ('PING_CACHE_TTL', _positive(float), '10'),
+    'PING_CACHE_JITTER': ('PING_CACHE_JITTER', _non_negative(float), '0.2'),
+    'PING_HARD_STALE': ('PING_HARD_STALE', _positive(float), '60'),
+    'PING_RATE_LIMIT': ('PING_RATE_LIMIT', _positive(int), '4'),
+    'PING_RATE_WINDOW': ('PING_RATE_WINDOW', _positive(float), '10'),
+    'LAN_BROWSER_TTL': ('LAN_BROWSER_TTL', _positive(float), '5'),
+    'NEIGH_CACHE_TTL': ('NEIGH_CACHE_TTL', _non_negative(float), '1'),
+    'WAKE_DEDUP_WINDOW': ('WAKE_DEDUP_WINDOW', _non_negative(float), '10'),
+    'WAKE_RESEND_SCHEDULE': ('WAKE_RESEND_SCHEDULE', _resend_schedule, '0,5,15,45'),
+    'WAKE_RETRIES': ('WAKE_RETRIES', _non_negative(int), '2'),
+    'SLOW_REQUEST_MS': ('SLOW_REQUEST_MS', _positive(float), '1000'),
+}
+
+def parse_settings(environ):
+    """Parse every reloadable setting from environ. Returns (values, errors): nothing is applied
+    here, so one bad value rejects the whole reload."""
+    values, errors = {}, []
+    for name, (var, parse, default) in RELOADABLE_SETTINGS.items():
+        raw = environ.get(var)
+        raw = default if raw is None or raw == '' else raw
+        try:
+            values[name] = None if raw is None else parse(raw)
+        except (TypeError, ValueError) as e:
+            errors.append(f"{var}={environ.get(var)!r}: {e}")
+    if errors:
+        return None, errors
+    # derived values, computed as at boot
+    values['PING_HARD_STALE'] = max(values['PING_HARD_STALE'], values['PING_CACHE_TTL'])
+    values['WAKE_SUPERVISE_TTL'] = max(values['MAX_WAIT_TIME'], values['WAKE_RESEND_SCHEDULE'][-1]) + 60
+    values['WAKE_STATUS_TTL'] = max(PING_SHARED_MAX_AGE, values['WAKE_SUPERVISE_TTL'])
+    values['DISCOVERY_SUBNETS'] = discovery_subnets_setting(environ)
+    try:
+        values['ENV_MACHINES'] = build_env_machines(environ)
+    except (TypeError, ValueError) as e:
+        return None, [f"GAMEARENA_*: {e}"]
+    return values, []
+
+def _merge_routers(new_routers):
+    """Keep the live router (pool, breaker) when its profile is unchanged; drop the cached session
+    of a router whose URL or credentials changed."""
+    merged = {}
+    for name, router in new_routers.items():
+        old = ROUTERS.get(name)
+        same = old and all(old[k] == router[k] for k in ('url', 'token_path', 'app_id', 'limit'))
+        if same:
+            merged[name] = old
+        else:
+            if old:
+                STATE.delete(f"freebox:session:{name}")
+            merged[name] = router
+    return merged
+
+def reload_config(reason='manual'):
+    """Re-read .env and apply the reloadable settings to this worker, validated first and swapped
+    together under CONFIG_LOCK. Returns (changed_names, err)."""
+    global ROUTERS
+    with CONFIG_LOCK:
+        CONFIG_STATE['pending'] = False
+        CONFIG_STATE['stamp'] = file_stamp(ENV_PATH)
+        try:
+            file_env = {k: v for k, v in dotenv_values(ENV_PATH).items() if v is not None} if os.path.exists(ENV_PATH) else {}
+        except (OSError, ValueError) as e:
+            CONFIG_STATE['error'] = f"cannot read {ENV_PATH}: {e}"
+            logger.error(f"Config reload ({reason}) rejected: {CONFIG_STATE['error']}")
+            return [], CONFIG_STATE['error']
+        pinned = {k: v for k, v in BOOT_ENVIRON.items() if BOOT_FILE_ENV.get(k) != v}
+        environ = {**file_env, **pinned}
+        values, errors = parse_settings(environ)
+        if errors:
+            CONFIG_STATE['error'] = '; '.join(errors)
+            logger.error(f"Config reload ({reason}) rejected, keeping current settings: {CONFIG_STATE['error']}")
+            return [], CONFIG_STATE['error']
+        routers = _merge_routers(load_routers(environ, token_path=values['CONFIG_FILE']))
+
+        module = globals()
+        changed = [name for name, value in values.items() if module.get(name) != value]
+        # variables read at call time (ALLOW_DEBUG...) follow .env too; removed ones are dropped
+        for key in CONFIG_STATE['file_keys'] - set(file_env):
+            if key not in pinned:
+                os.environ.pop(key, None)
+        os.environ.update({k: v for k, v in file_env.items() if k not in pinned})
+        CONFIG_STATE['file_keys'] = set(file_env)
+        shadowed = sorted(k for k, v in file_env.items() if k in pinned and pinned[k] != v)
+        if shadowed and shadowed != CONFIG_STATE['shadowed']:
+            logger.warning(f"Config reload ({reason}): .env values ignored, set in the process environment: "
+                           f"{', '.join(shadowed)}")
+        CONFIG_STATE['shadowed'] = shadowed
+        module.update(values)
+        ROUTERS = routers
+        with REGISTRY_LOCK:
+            apply_machine_registry(load_machine_registry(MACHINES_FILE))
+        CONFIG_STATE.update(loaded_at=time.time(), error=None, reloads=CONFIG_STATE['reloads'] + 1)
+    logger.info(f"Config reloaded ({reason}): {', '.join(changed) or 'no change'}")
+    return changed, None
+
+def maybe_reload_config():
+    """Reload when SIGHUP was received or .env changed (one stat every CONFIG_CHECK_INTERVAL s)."""
+    if not CONFIG_STATE['pending']:
+        if time.monotonic() - CONFIG_STATE['checked'] < CONFIG_CHECK_INTERVAL:
+            return
+        CONFIG_STATE['checked'] = time.monotonic()
+        if file_stamp(ENV_PATH) == CONFIG_STATE['stamp']:
+            return
+    reload_config('SIGHUP' if CONFIG_STATE['pending'] else '.env changed')
+
+# the start-up values went through the same parsers: report what a reload would reject (the
+# module-level fallbacks stay in effect until .env is fixed)
+_boot_values, _boot_errors = parse_settings(os.environ)
+if _boot_errors:
+    CONFIG_STATE['error'] = '; '.join(_boot_errors)
+    logger.error(f"Invalid settings at start-up, defaults used: {CONFIG_STATE['error']}")
+
+def _on_sighup(signum, frame):
+    # no locks in a signal handler: the next request (or scheduler tick) does the reload
+    CONFIG_STATE['pending'] = True
+
+if hasattr(signal, 'SIGHUP') and current_thread() is main_thread():
+    signal.signal(signal.SIGHUP, _on_sighup)
+
+@app.before_request
+def _reload_config_if_needed():
+    maybe_reload_config()
+
 @app.route('/api/machines')
 def api_machines():
-    machines_with_status = {}
-    for machine_id, machine in MACHINES.items():
-        machines_with_status[machine_id] = {
-            **machine,
-            "online": ping_host(machine["ip"])
-        }
-    return jsonify(machines_with_status)
+    # one read of the registry and of each source: the ETag and the body are built from the same
+    # values, so a cached body always matches the ETag it is stored under
+    machines, version = MACHINES, MACHINES_VERSION
+    statuses = get_many_host_status({m["ip"] for m in machines.values() if m.get("ip")})
+    # ETag from what the body is made of (ages excluded): the registry, each host's status,
+    # its LAN-browser entry and its neighbour state, plus the Freebox config file
+    lan_by_router = {}
+    snapshot = []
+    for machine_id, machine in machines.items():
+        status = statuses.get(machine["ip"]) or {}
+        router = machine_router(machine)
+        if router not in lan_by_router:
+            by_mac, age = lan_browser_snapshot(router)
+            lan_by_router[router] = (by_mac or {}, age)
+        snapshot.append((machine_id, status.get("online"), status.get("source"), status.get("stale"),
+                         lan_by_router[router][0].get(normalize_mac(machine.get("mac"))),
+                         neighbour_state(ip=machine["ip"], mac=machine.get("mac"))))
+    etag = make_etag(version, config_file_stamp(), snapshot)
+
+    def build():
+        machines_with_status = {}
+        for (machine_id, online, source, stale, lan, neigh) in snapshot:
+            machine = machines[machine_id]
+            age = lan_by_router[machine_router(machine)][1]
+            machines_with_status[machine_id] = {
+                **machine,
+                "online": online or False,
+                "source": source,
+                "stale": stale or False,
+                "lan": {**lan, "age": round(age, 2)} if lan else None,
+                "neigh": neigh
+            }
+        return machines_with_status
+    return set_status_cache_headers(conditional_json('machines', etag, build), statuses.values())
+
+def check_service_ready(check_url, check_host, port):
+    """Readiness decision for the GameArena service: HTTP probe, then TCP checks."""
+    # 1) Prefer an HTTP check (more accurate for web services). If HTTP check passes -> redirect to GAMEARENA_URL
+    service_ready = False
+    if check_url:
+        with timing_span('http-probe'):
+            service_ready = http_service_up(check_url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT),
+                                            spec=(find_machine(ip=GAMEARENA_HOST_IP)[1] or {}).get("probe"))
+        logger.debug(f"HTTP check_url={check_url} result={service_ready}")
 
-@app.route('/')
-def gamearena_redirect():
+    # 2) TCP: fallback for the main port if HTTP failed, plus every extra port required for readiness;
+    #    all connects run concurrently under one deadline
+    ready_ports = (find_machine(ip=GAMEARENA_HOST_IP)[1] or {}).get("ready_ports") or []
+    scan_ports = ([port] if not service_ready and port is not None else []) + ready_ports
+    if check_host and scan_ports:
+        with timing_span('tcp-scan'):
+            scan = scan_tcp_ports([(check_host, p) for p in scan_ports], timeout=1)
+        if not service_ready and port is not None:
+            service_ready = scan[(check_host, port)]['open']
+        service_ready = service_ready and all(scan[(check_host, p)]['open'] for p in ready_ports)
+        logger.debug(f"TCP scan {check_host}:{scan_ports} result={service_ready}")
+    return service_ready
+
+def gamearena_check_target():
+    """(host, port, check_host, check_url) used to decide whether GameArena is ready."""
     # Determine host/port/url to check
     host = None
     port = None
@@ -482,29 +2819,112 @@ def gamearena_redirect():
         check_url = f"http://{GAMEARENA_HOST_IP}:{port}/"
     elif GAMEARENA_URL:
         check_url = GAMEARENA_URL
+    return host, port, check_host, check_url
 
-    # 1) Prefer an HTTP check (more accurate for web services). If HTTP check passes -> redirect to GAMEARENA_URL
-    service_ready = False
-    if check_url:
-        service_ready = http_service_up(check_url, timeout=(CONNECT_TIMEOUT, READ_TIMEOUT))
-        logger.debug(f"HTTP check_url={check_url} result={service_ready}")
+def warmup_summary(report):
+    if not report:
+        return None
+    return {k: report[k] for k in ('duration', 'ok', 'total', 'timed_out')}
+
+@app.route('/api/wake/<wake_id>')
+def api_wake_status(wake_id):
+    """Result of a wake dispatched in the background by `/` (pending, sent or failed)."""
+    if len(wake_id) != 16 or wake_id.strip('0123456789abcdef'):
+        return jsonify({'error': 'Invalid wake id'}), 400
+    status = get_wake_status(wake_id)
+    if status is None:
+        return jsonify({'error': 'Unknown wake id'}), 404
+    return jsonify({'wake_id': wake_id, 'state': status['state'], 'success': status['state'] == 'sent',
+                    'error': status.get('details'), 'age': round(time.time() - status['ts'], 2),
+                    'packets': status.get('packets', 0), 'up': status.get('up')})
+
+# The readiness probe (HTTP + TCP scan) is shared by every waiting page of this worker: one probe
+# per READY_CACHE_TTL, single-flight. Requests never wait for a probe or a warm-up running for
+# another request: they get the last verdict (or "not ready") and a Retry-After, so a few polling
+# tabs cannot hold every gthread slot.
+try:
+    READY_CACHE_TTL = float(os.environ.get('READY_CACHE_TTL', '2'))
+except Exception:
+    READY_CACHE_TTL = 2.0
+READY_CACHE = {'ts': 0.0, 'ready': False}
+READY_PROBE_LOCK = Lock()
+
+@app.route('/api/ready')
+def api_ready():
+    """Readiness for the waiting page: true only once the service answers and is warmed up."""
+    _host, port, check_host, check_url = gamearena_check_target()
+    busy = False
+    if time.time() - READY_CACHE['ts'] < READY_CACHE_TTL:
+        service_ready = READY_CACHE['ready']
+    elif READY_PROBE_LOCK.acquire(blocking=False):
+        try:
+            with admission('readiness'):
+                service_ready = check_service_ready(check_url, check_host, port)
+            READY_CACHE.update(ts=time.time(), ready=service_ready)
+        finally:
+            READY_PROBE_LOCK.release()
+    else:
+        # another request is probing: answer with the previous verdict
+        service_ready, busy = READY_CACHE['ready'], True
+    machine_id, machine = find_machine(ip=GAMEARENA_HOST_IP)
+    report = None
+    warming = False
+    if service_ready:
+        record_boot_event(machine_id, 'service')
+        # the warm-up runs in its own thread: poll again until it is over
+        report = warm_up_service(machine_id, machine, check_url, wait=False)
+        warming = warmup_running(machine_id)
+    else:
+        mark_service_down(machine_id)
+    resp = jsonify({'ready': service_ready and not warming, 'warming': warming, 'busy': busy,
+                    'warmup': warmup_summary(report)})
+    if busy or warming:
+        resp.headers['Retry-After'] = '1'
+    return resp
 
-    # 2) Fallback: if HTTP check failed, try a low-level TCP connect to check_host:port
-    if not service_ready and check_host and port is not None:
-        service_ready = is_service_up(check_host, port, timeout=1)
-        logger.debug(f"TCP check {check_host}:{port} result={service_ready}")
+@app.route('/')
+def gamearena_redirect():
+    host, port, check_host, check_url = gamearena_check_target()
+
+    # No readiness probe here: the HTTP/TCP checks can each wait for their connect timeout. The
+    # verdict comes from READY_CACHE when fresh, or from the ping cache when the host is known to
+    # be asleep; otherwise the waiting page is rendered at once and its /api/ready poll decides
+    # (it comes back with ?wake=1 when the service is down).
+    service_ready = READY_CACHE['ready'] if time.time() - READY_CACHE['ts'] < READY_CACHE_TTL else None
+    known = get_host_status(GAMEARENA_HOST_IP, probe=False) if GAMEARENA_HOST_IP else None
+    if known and not known['online'] and not known['stale']:
+        service_ready = False
+    elif request.args.get('wake') == '1' and not service_ready:
+        service_ready = False
 
     logger.debug(f"host={host}, port={port}, check_host={check_host}, GAMEARENA_URL={GAMEARENA_URL}")
     logger.debug(f"service_ready={service_ready}")
 
+    machine_id, machine = find_machine(ip=GAMEARENA_HOST_IP)
     if service_ready:
-        # Redirect to the public GAMEARENA_URL if available, otherwise build a local http URL
-        redirect_target = GAMEARENA_URL or (f"http://{check_host}:{port}/" if check_host and port else '/')
-        logger.info(f"Redirecting to {redirect_target} (service ready)")
-        return redirect(redirect_target)
+        record_boot_event(machine_id, 'service')
+        # the warm-up runs in its own thread; the waiting page redirects once it is over
+        warm_up_service(machine_id, machine, check_url, wait=False)
+        if not warmup_running(machine_id):
+            # Redirect to the public GAMEARENA_URL if available, otherwise build a local http URL
+            redirect_target = GAMEARENA_URL or (f"http://{check_host}:{port}/" if check_host and port else '/')
+            logger.info(f"Redirecting to {redirect_target} (service ready)")
+            return redirect(redirect_target)
+    if service_ready is not False:
+        # readiness unknown or warm-up running: no wake (wake_id empty), the page polls /api/ready
+        with timing_span('render'):
+            page = render_template('gamearena_waiting.html',
+                                   mac=(machine or {}).get("mac"),
+                                   ip=GAMEARENA_HOST_IP,
+                                   url=GAMEARENA_URL,
+                                   max_wait=MAX_WAIT_TIME,
+                                   eta=boot_eta(machine_id),
+                                   wake_id='')
+        return page
 
     # 2) Service non joignable -> tenter le Wake-on-LAN via la Freebox
-    config = load_config()
+    mark_service_down(machine_id)
+    config = load_config(router_for(ip=GAMEARENA_HOST_IP))
     if not config:
         return render_template('error.html',
                              title="Configuration manquante",
@@ -523,32 +2943,38 @@ def gamearena_redirect():
                              title="Machine non configurée",
                              message=f"L'adresse IP {GAMEARENA_HOST_IP} n'est pas configurée dans MACHINES.")
 
-    # Attempt login + send WOL. On renvoie le résultat à la page d'attente pour affichage/debug.
-    session_token, err = login_freebox(config)
-    wol_status = False
-    wol_details = None
-
-    if session_token:
-        success, details = send_wol(session_token, gamearena_mac, config)
-        wol_status = success
-        wol_details = details
-    else:
-        wol_status = False
-        wol_details = err
-
-    return render_template('gamearena_waiting.html',
-                         mac=gamearena_mac,
-                         ip=GAMEARENA_HOST_IP,
-                         url=GAMEARENA_URL,
-                         max_wait=MAX_WAIT_TIME,
-                         wol_status=wol_status,
-                         wol_details=wol_details)
+    # Login + WOL partent en arrière-plan: la page d'attente s'affiche tout de suite et suit le
+    # résultat via /api/wake/<wake_id>.
+    wake_id = dispatch_wake(gamearena_mac)
+
+    with timing_span('render'):
+        page = render_template('gamearena_waiting.html',
+                               mac=gamearena_mac,
+                               ip=GAMEARENA_HOST_IP,
+                               url=GAMEARENA_URL,
+                               max_wait=MAX_WAIT_TIME,
+                               eta=boot_eta(find_machine(mac=gamearena_mac)[0]),
+                               wake_id=wake_id)
+    return page
+
+def debug_allowed():
+    # Ne doit être disponible qu'en mode debug explicite ou si ALLOW_DEBUG=1
+    return app.debug or os.environ.get('ALLOW_DEBUG', '0') in ('1', 'true', 'True')
+
+def is_local_request():
+    """True only if the TCP peer, the client and every forwarded hop are loopback addresses.
+    ProxyFix rewrites remote_addr from X-Forwarded-For, so the peer is read from its saved
+    environ: a remote client sending "X-Forwarded-For: 127.0.0.1" is still refused."""
+    peer = (request.environ.get('werkzeug.proxy_fix.orig') or {}).get('REMOTE_ADDR') or request.remote_addr
+    addrs = [peer or '', request.remote_addr or ''] + [a.strip() for a in request.headers.get('X-Forwarded-For', '').split(',') if a.strip()]
+    try:
+        return all(ipaddress.ip_address(a).is_loopback for a in addrs)
+    except ValueError:
+        return False
 
 @app.route('/debug')
 def debug_info():
-    # Ne doit être disponible qu'en mode debug explicite ou si ALLOW_DEBUG=1
-    allow_debug = os.environ.get('ALLOW_DEBUG', '0') in ('1', 'true', 'True')
-    if not (app.debug or allow_debug):
+    if not debug_allowed():
         abort(404)
 
     debug_data = {
@@ -569,38 +2995,171 @@ def debug_info():
 
 @app.route('/debug/ping-stats')
 def debug_ping_stats():
-    allow_debug = os.environ.get('ALLOW_DEBUG', '0') in ('1', 'true', 'True')
-    if not (app.debug or allow_debug):
+    if not debug_allowed():
         abort(404)
 
     with PING_CACHE_LOCK:
         cache_keys = list(PING_CACHE.keys())
-    with PING_RATE_LOCK:
-        rate_summary = {k: len(v) for k, v in PING_RATE_MAP.items()}
-    file_keys = []
-    if PING_CACHE_DIR:
-        try:
-            for fn in os.listdir(PING_CACHE_DIR):
-                if fn.endswith('.json'):
-                    file_keys.append(fn)
-        except Exception:
-            pass
+        cache_stats = dict(PING_CACHE_STATS)
+    lan = {name: STATE.get(f'lan:hosts:{name}') or {} for name in ROUTERS}
 
     return jsonify({
         'ping_cache_ttl': PING_CACHE_TTL,
+        'ping_cache_max': PING_CACHE_MAX,
         'ping_cache_keys': cache_keys,
-        'ping_file_cache_dir': PING_CACHE_DIR,
-        'ping_file_cache_files': file_keys,
+        'ping_cache_stats': cache_stats,
+        'runtime_snapshot': {'path': RUNTIME_SNAPSHOT_PATH, **RUNTIME_SNAPSHOT_STATE},
+        'state': {'backend': STATE.name, 'url': STATE_URL.split('@')[-1], 'entries': STATE.count()},
         'rate_limit': {'limit': PING_RATE_LIMIT, 'window': PING_RATE_WINDOW},
-        'rate_map_counts': rate_summary
+        'lan_browser': {'enabled': LAN_BROWSER_ENABLED, 'ttl': LAN_BROWSER_TTL,
+                        'routers': {name: {'age': round(time.time() - snap['ts'], 2) if snap.get('ts') else None,
+                                           'hosts': len(snap.get('by_mac') or {}), 'error': snap.get('error')}
+                                    for name, snap in lan.items()}},
+        'neigh': {'enabled': NEIGH_PROBE_ENABLED, 'source': NEIGH_CACHE['source'],
+                  'age': round(time.time() - NEIGH_CACHE['ts'], 2), 'entries': len(NEIGH_CACHE['by_ip'])}
     })
 
+# Stack-sampling profiler (sys._current_frames): /debug/profile?seconds=N samples every thread of
+# the worker serving the call; a request sent with "X-Debug-Profile: 1" is sampled on its own and
+# its stacks saved under PROFILE_DIR. Output is collapsed stacks ("frame;frame;... count"), as read
+# by flamegraph.pl and speedscope. Both are gated like /debug and answer to localhost only.
+try:
+    PROFILE_INTERVAL = float(os.environ.get('PROFILE_INTERVAL_MS', '5')) / 1000.0
+    PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '60'))
+except Exception:
+    PROFILE_INTERVAL = 0.005
+    PROFILE_MAX_SECONDS = 60.0
+PROFILE_DIR = os.environ.get('PROFILE_DIR') or os.path.join(STATE_DIR or '/tmp', 'profiles')
+PROFILE_KEEP = 20
+PROFILE_LOCK = Lock()
+# leaf functions of threads parked waiting for work (dropped with ?idle=0)
+PROFILE_IDLE_LEAVES = {'wait', 'select', 'poll', 'sleep', 'accept', 'acquire', '_wait_for_tstate_lock',
+                       'readinto', 'recv_into', 'get', '_worker'}
+
+def collapse_stack(frame):
+    """'outer (file.py:12);...;inner (file.py:40)', by function (first line), root first."""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+def sample_stacks(seconds, interval=PROFILE_INTERVAL, exclude=(), idle=True):
+    """Sample every thread's stack for `seconds`. Returns (Counter of collapsed stacks, samples)."""
+    counts = Counter()
+    samples = 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        names = {t.ident: t.name for t in enumerate_threads()}
+        for ident, frame in sys._current_frames().items():
+            if ident in exclude:
+                continue
+            if not idle and frame.f_code.co_name in PROFILE_IDLE_LEAVES:
+                continue
+            counts[f"{names.get(ident, ident)};{collapse_stack(frame)}"] += 1
+        samples += 1
+        time.sleep(interval)
+    return counts, samples
+
+def format_collapsed(counts):
+    return ''.join(f"{stack} {n}\n" for stack, n in counts.most_common())
+
+@app.route('/debug/profile')
+def debug_profile():
+    """Sample this worker for ?seconds=N (default 5). ?idle=0 drops parked threads,
+    ?format=json returns {samples, interval_ms, stacks} instead of collapsed text.
+    """
+    if not debug_allowed() or not is_local_request():
+        abort(404)
+    try:
+        seconds = min(max(float(request.args.get('seconds', '5')), 0.1), PROFILE_MAX_SECONDS)
+    except ValueError:
+        return jsonify({'error': 'seconds must be a number'}), 400
+    idle = request.args.get('idle', '1') not in ('0', 'false')
+    if not PROFILE_LOCK.acquire(blocking=False):
+        return jsonify({'error': 'a profile is already running in this worker'}), 409
+    try:
+        counts, samples = sample_stacks(seconds, exclude={get_ident()}, idle=idle)
+    finally:
+        PROFILE_LOCK.release()
+    logger.info(f"Profiled pid {os.getpid()} for {seconds}s: {samples} samples, {len(counts)} stacks")
+    if request.args.get('format') == 'json':
+        return jsonify({'pid': os.getpid(), 'seconds': seconds, 'samples': samples,
+                        'interval_ms': PROFILE_INTERVAL * 1000, 'stacks': dict(counts.most_common())})
+    resp = app.make_response(format_collapsed(counts))
+    resp.mimetype = 'text/plain'
+    resp.headers['X-Profile-Samples'] = str(samples)
+    return resp
+
+@app.before_request
+def _start_request_profile():
+    if request.headers.get('X-Debug-Profile') != '1' or not debug_allowed() or not is_local_request():
+        return
+    target, stop, counts = get_ident(), Event(), Counter()
+
+    def run():
+        while not stop.is_set():
+            frame = sys._current_frames().get(target)
+            if frame is not None:
+                counts[collapse_stack(frame)] += 1
+            stop.wait(PROFILE_INTERVAL)
+
+    sampler = Thread(target=run, name='request-profiler', daemon=True)
+    sampler.start()
+    g.request_profile = (stop, counts, sampler)
+
+@app.after_request
+def _finish_request_profile(resp):
+    profile = g.pop('request_profile', None)
+    if profile is None:
+        return resp
+    stop, counts, sampler = profile
+    stop.set()
+    sampler.join(timeout=1)
+    samples = sum(counts.values())
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        name = f"{datetime.now():%Y%m%d-%H%M%S}-{os.getpid()}-{request.path.strip('/').replace('/', '_') or 'root'}.folded"
+        with open(os.path.join(PROFILE_DIR, name), 'w') as f:
+            f.write(format_collapsed(counts))
+        # keep only the PROFILE_KEEP most recent profiles
+        files = sorted(os.listdir(PROFILE_DIR))
+        for old in files[:-PROFILE_KEEP]:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        resp.headers['X-Debug-Profile'] = f"{name}; samples={samples}"
+    except OSError as e:
+        logger.warning(f"Cannot save request profile: {e}")
+    return resp
+
+def config_file_stamp():
+    """Stamp of the Freebox token file (see file_stamp)."""
+    return file_stamp(CONFIG_FILE)
+
+# /health result for a given config file stamp: the token file is only re-parsed when it changes
+HEALTH_CACHE = {'stamp': None, 'result': None}
+HEALTH_CACHE_LOCK = Lock()
+
 @app.route('/health')
 def health_check():
     """Endpoint de santé minimal.
     Retourne 200 si les fichiers de configuration essentiels sont présents et parsables.
     Ne tente PAS d'appeler la Freebox (pour éviter latence/erreurs réseau).
+    Le fichier de token n'est relu que si son mtime change ; ETag + If-None-Match -> 304.
     """
+    stamp = config_file_stamp()
+    with HEALTH_CACHE_LOCK:
+        result = HEALTH_CACHE['result'] if HEALTH_CACHE['stamp'] == stamp else None
+    if result is None:
+        result = check_config_file()
+        with HEALTH_CACHE_LOCK:
+            HEALTH_CACHE.update(stamp=stamp, result=result)
+    if not result['ok']:
+        return jsonify(result), 503
+    return conditional_json('health', make_etag(MACHINES_VERSION, CONFIG_FILE, stamp), lambda: result)
+
+def check_config_file():
+    """Presence and validity of the Freebox token file, as reported by /health."""
     cfg_exists = False
     cfg_ok = False
     cfg_err = None
@@ -629,13 +3188,40 @@ def health_check():
     else:
         cfg_err = 'token file not found'
 
-    return jsonify({
+    return {
         'ok': cfg_ok,
         'config_file_path': CONFIG_FILE,
         'config_file_exists': cfg_exists,
         'config_valid': cfg_ok,
         'config_error': cfg_err
-    }), (200 if cfg_ok else 503)
+    }
+
+# Served workers start their background jobs at boot rather than on the first request: a scheduled
+# pre-wake must fire after a restart even if nobody opens the page. Only the holder of the
+# scheduler lease fires triggers, so every worker can run the loop.
+def _on_sigterm(signum, frame):
+    # stop the wake supervisors and write the snapshot now: atexit only runs once the executor
+    # threads are joined, which may be after gunicorn's graceful timeout has killed the worker.
+    # The save runs in its own (non-daemon) thread: no locks are taken in the signal handler.
+    WAKE_SHUTDOWN.set()
+    Thread(target=save_runtime_snapshot, name='snapshot-save').start()
+    previous = SIGTERM_PREVIOUS_HANDLER
+    if callable(previous):
+        previous(signum, frame)  # gunicorn's graceful stop
+    elif previous == signal.SIG_DFL:
+        raise SystemExit(128 + signum)
+
+SIGTERM_PREVIOUS_HANDLER = None
+
+if serving_process():
+    ensure_scheduler_started()
+    # only served workers write the snapshot: `flask discover` or a tool importing the app must
+    # not overwrite it with their cold state
+    atexit.register(save_runtime_snapshot)
+    if current_thread() is main_thread():
+        # installed after gunicorn's own handlers (the app is loaded after init_signals), chained
+        SIGTERM_PREVIOUS_HANDLER = signal.getsignal(signal.SIGTERM)
+        signal.signal(signal.SIGTERM, _on_sigterm)
 
 if __name__ == '__main__':
     print("🏠 Wake-on-LAN Web Interface")
@@ -643,12 +3229,13 @@ if __name__ == '__main__':
     print(f"Templates dir: {TEMPLATE_DIR}")
     print(f"Static dir: {STATIC_DIR}")
 
-    config = load_config()
-    if config:
-        print(f"   ✅ Freebox token: {config.get('app_token','')[:20]}...")
-        print(f"   ✅ freebox_url: {config.get('freebox_url', DEFAULT_FREEBOX_URL)}")
-    else:
-        print("   ❌ Pas de token trouvé. Exécutez: python3 freebox_auth.py")
+    for router in ROUTERS:
+        config = load_config(router)
+        if config:
+            print(f"   ✅ Freebox token ({router}): {config.get('app_token','')[:20]}...")
+            print(f"   ✅ freebox_url: {get_freebox_base(config)}")
+        else:
+            print(f"   ❌ Pas de token trouvé pour le routeur {router}. Exécutez: python3 freebox_auth.py")
 
     print(f"\n📡 Machines configurées: {len(MACHINES)}")
     for machine_id, machine in MACHINES.items():
@@ -0,0 +1,303 @@
+"""Shared state for wol_app: TTL'd key/value entries, atomic counters and leases.
+
+Backends (picked by open_store from a URL):
+ - memory://            per-process dict (dev server, single worker)
+ - sqlite:///path.db    one SQLite file in WAL mode, shared by every worker on the host
+ - redis://host:6379/0  optional network store (requires the `redis` package)
+
+Values are JSON-serialisable objects. A TTL of None means no expiry.
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+
+try:
+    import redis
+except ImportError:  # optional dependency
+    redis = None
+
+
+class StateStore:
+    """Interface shared by all backends."""
+    name = 'abstract'
+
+    def get(self, key):
+        """Value stored under key, or None when missing or expired."""
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def incr(self, key, amount=1, ttl=None):
+        """Atomically add amount to an integer counter and return the new value. The TTL is only
+        applied when the counter is created, so a window counter expires with its window.
+        """
+        raise NotImplementedError
+
+    def acquire_lease(self, key, owner, ttl):
+        """Take (or renew, for the same owner) an exclusive lease for ttl seconds. Returns True if
+        owner holds the lease afterwards.
+        """
+        raise NotImplementedError
+
+    def release_lease(self, key, owner):
+        """Drop the lease if owner still holds it."""
+        raise NotImplementedError
+
+    def lease_owner(self, key):
+        return self.get(key)
+
+    def purge_expired(self):
+        """Remove expired entries; returns how many were removed."""
+        return 0
+
+    def count(self):
+        """Number of live entries (for /debug)."""
+        return None
+
+    def close(self):
+        pass
+
+
+class MemoryStore(StateStore):
+    name = 'memory'
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[1] is not None and item[1] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        with self._lock:
+            item = self._live(key, time.time())
+            return item[0] if item else None
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (value, time.time() + ttl if ttl is not None else None)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def incr(self, key, amount=1, ttl=None):
+        now = time.time()
+        with self._lock:
+            item = self._live(key, now)
+            if item is None:
+                item = (0, now + ttl if ttl is not None else None)
+            value = int(item[0]) + amount
+            self._data[key] = (value, item[1])
+            return value
+
+    def acquire_lease(self, key, owner, ttl):
+        now = time.time()
+        with self._lock:
+            item = self._live(key, now)
+            if item is not None and item[0] != owner:
+                return False
+            self._data[key] = (owner, now + ttl)
+            return True
+
+    def release_lease(self, key, owner):
+        with self._lock:
+            item = self._live(key, time.time())
+            if item is not None and item[0] == owner:
+                del self._data[key]
+
+    def purge_expired(self):
+        now = time.time()
+        with self._lock:
+            expired = [k for k, (_v, exp) in self._data.items() if exp is not None and exp <= now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def count(self):
+        with self._lock:
+            return len(self._data)
+
+
+class SQLiteStore(StateStore):
+    """One table in a WAL-mode database: readers never block the writer, and every worker on the
+    host sees the same entries. Connections are per thread and re-opened after a fork.
+    """
+    name = 'sqlite'
+
+    def __init__(self, path, busy_timeout=2.0):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self._local = threading.local()
+        # entries may hold the Freebox session token: create the file private before the first
+        # connection, so the -wal/-shm files SQLite derives from its mode are private too
+        try:
+            os.close(os.open(path, os.O_RDWR | os.O_CREAT, 0o600))
+        except OSError:
+            pass
+        conn = self._conn()
+        conn.execute("CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL, exp REAL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS kv_exp ON kv (exp)")
+        # files left by an older version may still be world-readable
+        for name in (path, path + '-wal', path + '-shm'):
+            try:
+                os.chmod(name, 0o600)
+            except OSError:
+                pass
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=self.busy_timeout, isolation_level=None,
+                                   check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _read(self, conn, key, now):
+        row = conn.execute("SELECT value FROM kv WHERE key = ? AND (exp IS NULL OR exp > ?)",
+                           (key, now)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def get(self, key):
+        return self._read(self._conn(), key, time.time())
+
+    def set(self, key, value, ttl=None):
+        exp = time.time() + ttl if ttl is not None else None
+        self._conn().execute("INSERT OR REPLACE INTO kv (key, value, exp) VALUES (?, ?, ?)",
+                             (key, json.dumps(value), exp))
+
+    def delete(self, key):
+        self._conn().execute("DELETE FROM kv WHERE key = ?", (key,))
+
+    def _write_txn(self, fn):
+        # BEGIN IMMEDIATE takes the write lock up front: read-modify-write is atomic across workers
+        conn = self._conn()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            result = fn(conn, time.time())
+            conn.execute("COMMIT")
+            return result
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+
+    def incr(self, key, amount=1, ttl=None):
+        def txn(conn, now):
+            row = conn.execute("SELECT value, exp FROM kv WHERE key = ? AND (exp IS NULL OR exp > ?)",
+                               (key, now)).fetchone()
+            if row:
+                value, exp = int(json.loads(row[0])) + amount, row[1]
+            else:
+                value, exp = amount, (now + ttl if ttl is not None else None)
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, exp) VALUES (?, ?, ?)",
+                         (key, json.dumps(value), exp))
+            return value
+        return self._write_txn(txn)
+
+    def acquire_lease(self, key, owner, ttl):
+        def txn(conn, now):
+            current = self._read(conn, key, now)
+            if current is not None and current != owner:
+                return False
+            conn.execute("INSERT OR REPLACE INTO kv (key, value, exp) VALUES (?, ?, ?)",
+                         (key, json.dumps(owner), now + ttl))
+            return True
+        return self._write_txn(txn)
+
+    def release_lease(self, key, owner):
+        self._conn().execute("DELETE FROM kv WHERE key = ? AND value = ?", (key, json.dumps(owner)))
+
+    def purge_expired(self):
+        cur = self._conn().execute("DELETE FROM kv WHERE exp IS NOT NULL AND exp <= ?", (time.time(),))
+        return cur.rowcount
+
+    def count(self):
+        return self._conn().execute("SELECT COUNT(*) FROM kv WHERE exp IS NULL OR exp > ?",
+                                    (time.time(),)).fetchone()[0]
+
+    def close(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
+
+class RedisStore(StateStore):
+    """Network store for several hosts. Expiry is handled by Redis itself."""
+    name = 'redis'
+
+    _RENEW = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('pexpire', KEYS[1], ARGV[2]) end return 0"
+    _RELEASE = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+
+    def __init__(self, url, prefix='wol:'):
+        if redis is None:
+            raise RuntimeError("redis:// state store requires the 'redis' package (pip install redis)")
+        self._client = redis.Redis.from_url(url, socket_timeout=1.0, socket_connect_timeout=1.0)
+        self._prefix = prefix
+        self._client.ping()
+
+    def _k(self, key):
+        return self._prefix + key
+
+    def get(self, key):
+        raw = self._client.get(self._k(key))
+        return json.loads(raw) if raw is not None else None
+
+    def set(self, key, value, ttl=None):
+        px = int(ttl * 1000) if ttl is not None else None
+        self._client.set(self._k(key), json.dumps(value), px=px)
+
+    def delete(self, key):
+        self._client.delete(self._k(key))
+
+    def incr(self, key, amount=1, ttl=None):
+        pipe = self._client.pipeline()
+        if ttl is not None:
+            # creates the counter with its TTL only if it does not exist yet
+            pipe.set(self._k(key), 0, px=int(ttl * 1000), nx=True)
+        pipe.incrby(self._k(key), amount)
+        return int(pipe.execute()[-1])
+
+    def acquire_lease(self, key, owner, ttl):
+        token = json.dumps(owner)
+        px = int(ttl * 1000)
+        if self._client.set(self._k(key), token, px=px, nx=True):
+            return True
+        return bool(self._client.eval(self._RENEW, 1, self._k(key), token, px))
+
+    def release_lease(self, key, owner):
+        self._client.eval(self._RELEASE, 1, self._k(key), json.dumps(owner))
+
+    def count(self):
+        return sum(1 for _ in self._client.scan_iter(match=self._prefix + '*', count=500))
+
+
+def open_store(url):
+    """Build a store from a URL: memory://, sqlite:///abs/path.db or redis://host:port/db."""
+    parsed = urlparse(url or 'memory://')
+    if parsed.scheme == 'memory':
+        return MemoryStore()
+    if parsed.scheme == 'sqlite':
+        path = parsed.path or (parsed.netloc and '/' + parsed.netloc)
+        if not path:
+            raise ValueError(f"sqlite state store needs a path: {url!r}")
+        return SQLiteStore(path)
+    if parsed.scheme in ('redis', 'rediss', 'unix'):
+        return RedisStore(url)
+    raise ValueError(f"Unknown state store URL: {url!r}")